@@ -0,0 +1,123 @@
+import argparse
+import sys
+import time
+from logic.export_module import export_all_to_dir
+from logic.project import MapProject
+from logic.project_bundle import is_bundle, load_bundle, save_bundle
+
+# Headless counterpart of main.py: runs the whole pipeline without importing Qt.
+#
+#   python cli.py --project saves/tyrrel1.json --out export/
+#   python cli.py --land land.png --boundary bound.png --biome biome.png \
+#                 --heightmap heightmap.png --land-provinces 5000 --out export/
+#   python cli.py --project saves/tyrrel1.json --out export/ --bundle saves/tyrrel1.ogsproj
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Generate and export a map without the GUI.")
+    parser.add_argument("--project",
+                        help="Saved project (saves/*.json or a .ogsproj bundle) to take inputs and settings from.")
+    parser.add_argument("--land", help="Land image path.")
+    parser.add_argument("--boundary", help="Boundary image path.")
+    parser.add_argument("--biome", help="Biome image path.")
+    parser.add_argument("--heightmap", help="Heightmap image path.")
+    parser.add_argument("--land-provinces", type=int,
+                        help="Land province density.")
+    parser.add_argument("--ocean-provinces", type=int,
+                        help="Ocean province density.")
+    parser.add_argument("--land-territories", type=int,
+                        help="Land territory density.")
+    parser.add_argument("--ocean-territories", type=int,
+                        help="Ocean territory density.")
+    parser.add_argument("--river-threshold", type=int,
+                        help="Flow needed for an edge to become a river.")
+    parser.add_argument("--seed", type=int,
+                        help="Random seed; the same seed reproduces the same map.")
+    parser.add_argument("--out", required=True,
+                        help="Directory for the Export All layout.")
+    parser.add_argument("--shape-format", choices=("json", "binary"),
+                        help="Province shapes format (default: SHAPE_EXPORT_FORMAT in config.py).")
+    parser.add_argument("--territory-format", choices=("jsonl", "files"),
+                        help="Territories layout (default: TERRITORY_EXPORT_FORMAT in config.py).")
+    parser.add_argument("--png-compression", choices=("fast", "default", "max"),
+                        help="PNG compression preset (default: PNG_COMPRESSION in config.py).")
+    parser.add_argument("--bundle",
+                        help="Also save the generated project as a .ogsproj bundle.")
+    return parser.parse_args(argv)
+
+
+def build_project(args):
+    if args.project and is_bundle(args.project):
+        project, _ = load_bundle(args.project)
+    elif args.project:
+        project = MapProject.from_file(args.project)
+    else:
+        project = MapProject()
+
+    # Explicit arguments override the saved project
+    inputs = {
+        "land_image_path": args.land,
+        "boundary_image_path": args.boundary,
+        "biome_image_path": args.biome,
+        "heightmap_image_path": args.heightmap,
+    }
+    for key, path in inputs.items():
+        if path:
+            project.load_input(key, path)
+
+    settings = {
+        "land_province_density": args.land_provinces,
+        "ocean_province_density": args.ocean_provinces,
+        "territory_land_density": args.land_territories,
+        "territory_ocean_density": args.ocean_territories,
+        "river_threshold": args.river_threshold,
+        "seed": args.seed,
+    }
+    for key, value in settings.items():
+        if value is not None:
+            project.settings[key] = value
+
+    return project
+
+
+def changes_generation(args):
+    """Whether the arguments override any input or setting the generated results depend on."""
+    overrides = (args.land, args.boundary, args.biome, args.heightmap, args.land_provinces,
+                 args.ocean_provinces, args.land_territories, args.ocean_territories, args.seed)
+    return any(value is not None for value in overrides)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    project = build_project(args)
+
+    # Results loaded from a bundle are exported as they are
+    stages = []
+    if project.territory_data is None or changes_generation(args):
+        stages += [
+            ("provinces", project.generate_provinces),
+            ("territories", project.generate_territories),
+        ]
+    stages.append(("export", lambda: export_all_to_dir(project, args.out, shape_format=args.shape_format,
+                                                             territory_format=args.territory_format,
+                                                             png_compression=args.png_compression)))
+    if args.bundle:
+        stages.append(("bundle", lambda: save_bundle(project, args.bundle)))
+
+    total_start = time.perf_counter()
+    for name, run in stages:
+        start = time.perf_counter()
+        run()
+        print(f"[{name}] {time.perf_counter() - start:.2f}s")
+
+    elapsed = time.perf_counter() - total_start
+    h, w = project.index_map.shape
+    print(f"Done in {elapsed:.2f}s "
+          f"({len(project.province_data)} provinces, "
+          f"{len(project.territory_data)} territories, "
+          f"{h * w / elapsed / 1e6:.2f} Mpx/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -42,6 +42,69 @@ BOUNDARY_COLOR = (0, 0, 0)
 MAX_IMAGE_PIXELS = 300000000
 DISPLAY_SIZE_WIDTH = 1050
 DISPLAY_SIZE_HEIGHT = 900
+PREVIEW_SCALE = 2                # displays keep previews of up to this many pixels per display pixel
+
+# Input images: "memmap" (decoded once into memory-mapped planes on disk
+# and read tile by tile) or "memory" (PIL images held in RAM)
+INGEST_MODE = "memmap"
+INGEST_DIR = None                # None = <system temp dir>/ogs-map-tool
+INGEST_CACHE_BYTES = 8 << 30     # planes kept on disk, least recently used go first; 0 = no limit
+
+# Province growth engine: "frontier" (whole-array rings) or "queue" (per pixel)
+FLOOD_FILL_ENGINE = "frontier"
+
+# Border filling: "tiled" (distance transform per row tile with a halo,
+# bounded memory; labels farther than the halo are grown out 4-connected,
+# so the result only matches "full" within the halo) or "full" (one
+# distance transform over the whole map)
+BORDER_FILL_MODE = "tiled"
+BORDER_TILE_PIXELS = 1 << 21     # pixels per tile, halo not included
+BORDER_HALO = 64                 # rows above and below every tile
+
+# Memory budget of the cached input masks (boundary, land/sea, fill and
+# border masks), shared by province and territory generation
+MASK_CACHE_BYTES = 4 << 30
+
+# Territory engine: "graph" (grows over the province adjacency graph)
+# or "pixel" (floods the full map again at territory density)
+TERRITORY_ENGINE = "graph"
+
+# Shape extraction: "tiled" (row bands traced in worker processes and
+# stitched along the seams) or "serial" (the whole map in one pass)
+SHAPE_ENGINE = "tiled"
+SHAPE_WORKERS = 0                # 0 = one per CPU core
+SHAPE_TILE_PIXELS = 16_000_000   # minimum pixels per band; smaller maps stay in-process
+
+# Province shapes written by Export All: "json" (provinces.json, streamed)
+# or "binary" (provinces.shapes, see logic/shape_io.py)
+SHAPE_EXPORT_FORMAT = "json"
+
+# Territories written by Export All: "jsonl" (territories.jsonl, one line per
+# territory after an offset index, see logic/territory_io.py) or "files"
+# (territories/<id>.json, one file per territory)
+TERRITORY_EXPORT_FORMAT = "jsonl"
+
+# Exported PNGs: zlib preset "fast" (level 1, for iterating), "default"
+# (level 6) or "max" (level 9 with optimize, for release builds), see
+# logic/png_writer.py. PNG_PALETTE writes images of at most 256 colors
+# (e.g. the biome map) as palette PNGs.
+PNG_COMPRESSION = "default"
+PNG_PALETTE = True
+
+# Export All runs its outputs side by side on a thread pool; shapes and
+# rivers go to a worker process on maps of at least EXPORT_PROCESS_PIXELS
+EXPORT_THREADS = 0                   # 0 = one per CPU core
+EXPORT_PROCESS_PIXELS = 16_000_000
+
+# Province biomes: "majority" (most common biome over all province pixels)
+# or "centroid" (the biome pixel under the province centroid)
+BIOME_MODE = "majority"
+
+# River engine: "csr" (NumPy arrays in CSR form) or "dict" (dicts of lists)
+RIVER_ENGINE = "csr"
+
+# Seed of the province and territory color palettes (same seed, same colors)
+COLOR_SEED = 0
 
 # Number Series
 PROVINCE_ID_PREFIX = "prv-"
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+def build_adjacency(index_map, province_data, boundary_mask=None):
+    """
+    Derives the province adjacency graph from the combined index map.
+
+    Every pair of provinces sharing at least one pixel edge is listed once.
+    Returns a dict of NumPy arrays:
+        pairs         (M, 2) province indices, pairs[:, 0] < pairs[:, 1]
+        border_length (M,)   shared pixel edges
+        open_length   (M,)   shared pixel edges not touching boundary_mask
+        coast         (M,)   True where a land province meets an ocean province
+        coastal       (N,)   True for land provinces with an ocean neighbour
+    """
+    n = len(province_data)
+    all_keys = []
+    open_keys = []
+
+    for a, b, blocked in _shifted_pairs(index_map, boundary_mask):
+        touching = (a != b) & (a >= 0) & (b >= 0)
+
+        lo = np.minimum(a[touching], b[touching]).astype(np.int64)
+        hi = np.maximum(a[touching], b[touching]).astype(np.int64)
+        keys = lo * n + hi
+        all_keys.append(keys)
+
+        if blocked is None:
+            open_keys.append(keys)
+        else:
+            open_keys.append(keys[~blocked[touching]])
+
+    pair_keys, border_length = np.unique(np.concatenate(all_keys), return_counts=True)
+    pairs = np.stack((pair_keys // n, pair_keys % n), axis=1)
+
+    # Open pairs are a subset of all pairs, so their positions always exist
+    open_pair_keys, open_counts = np.unique(np.concatenate(open_keys), return_counts=True)
+    open_length = np.zeros(pair_keys.size, np.int64)
+    open_length[np.searchsorted(pair_keys, open_pair_keys)] = open_counts
+
+    is_ocean = np.array([p["province_type"] == "ocean" for p in province_data], bool)
+    coast = is_ocean[pairs[:, 0]] != is_ocean[pairs[:, 1]]
+
+    coastal = np.zeros(n, bool)
+    coastal[pairs[coast].ravel()] = True
+    coastal &= ~is_ocean
+
+    return {
+        "pairs": pairs,
+        "border_length": border_length,
+        "open_length": open_length,
+        "coast": coast,
+        "coastal": coastal,
+    }
+
+
+def _shifted_pairs(index_map, boundary_mask):
+    """Yields (left, right, blocked) views for horizontal and vertical neighbours."""
+    for a_sl, b_sl in (
+        ((slice(None), slice(None, -1)), (slice(None), slice(1, None))),
+        ((slice(None, -1), slice(None)), (slice(1, None), slice(None))),
+    ):
+        blocked = None
+        if boundary_mask is not None:
+            blocked = boundary_mask[a_sl] | boundary_mask[b_sl]
+        yield index_map[a_sl], index_map[b_sl], blocked
+
+
+def adjacency_lists(pairs, count):
+    """Converts unique pairs into CSR form: neighbours of i are indices[indptr[i]:indptr[i + 1]]."""
+    src = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    dst = np.concatenate((pairs[:, 1], pairs[:, 0]))
+    order = np.argsort(src, kind="stable")
+
+    indptr = np.zeros(count + 1, np.int64)
+    np.cumsum(np.bincount(src, minlength=count), out=indptr[1:])
+    return indptr, dst[order]
+
+
+def territory_neighbors(adjacency, province_data, territory_data):
+    """Lists the neighbouring territory ids of every territory, in territory order."""
+    pid_to_index = {p["province_id"]: i for i, p in enumerate(province_data)}
+    owner = np.full(len(province_data), -1, np.int64)
+    for t, terr in enumerate(territory_data):
+        for pid in terr.get("province_ids", []):
+            owner[pid_to_index[pid]] = t
+
+    pairs = owner[adjacency["pairs"]]
+    pairs = pairs[(pairs[:, 0] != pairs[:, 1]) & (pairs >= 0).all(axis=1)]
+    pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+
+    neighbors = [[] for _ in territory_data]
+    for a, b in pairs.tolist():
+        neighbors[a].append(territory_data[b]["territory_id"])
+        neighbors[b].append(territory_data[a]["territory_id"])
+    return neighbors
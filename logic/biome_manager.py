@@ -1,11 +1,41 @@
 import json
 import os
-import math
+import threading
+import numpy as np
+from logic.image_store import pack_rgb
+
+# Lookup table entry for colors that have not been resolved yet
+UNRESOLVED = -2
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_biome_manager(config_path="biomes.json"):
+    """
+    Returns the shared BiomeManager for config_path.
+    Managers are kept across generation runs and reloaded when the file changes.
+    """
+    path = os.path.abspath(config_path)
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+
+    with _managers_lock:
+        cached = _managers.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, BiomeManager(path))
+            _managers[path] = cached
+        return cached[1]
+
 
 class BiomeManager:
     def __init__(self, config_path="biomes.json"):
         self.biomes = []
         self.load_biomes(config_path)
+        self._colors = np.array([b['color'] for b in self.biomes], np.int64).reshape(-1, 3)
+
+        # Packed 24-bit color -> biome index, filled in as colors are looked up
+        self._lut = None
+        self._lut_lock = threading.Lock()
 
     def load_biomes(self, path):
         if not os.path.exists(path):
@@ -26,24 +56,44 @@ class BiomeManager:
         Finds the biome matching the given color within a tolerance.
         Returns the biome dict or None.
         """
-        target_color = (r, g, b)
-        
-        # 1. Exact Match
-        for biome in self.biomes:
-            if biome['color_tuple'] == target_color:
-                return biome
-
-        # 2. Nearest Neighbor (Euclidean distance) if no exact match
-        # Only if we want to support lossy compression artifacts or slight mismatches.
-        best_biome = None
-        min_dist = float('inf')
-
-        for biome in self.biomes:
-            br, bg, bb = biome['color_tuple']
-            dist = math.sqrt((r - br)**2 + (g - bg)**2 + (b - bb)**2)
-            if dist < min_dist:
-                min_dist = dist
-                best_biome = biome
-
-        # Always return the closest match
-        return best_biome
+        index = self.lookup(np.array([[r, g, b]]))[0]
+        return self.biomes[index] if index >= 0 else None
+
+    def lookup(self, colors):
+        """
+        Resolves an (..., 3) array of RGB samples to biome indices in one call.
+
+        An exact color match wins; otherwise the nearest biome color
+        (Euclidean distance, first biome on ties) is used. Returns -1
+        everywhere when no biomes are loaded.
+        """
+        return self.lookup_packed(pack_rgb(colors))
+
+    def lookup_packed(self, packed):
+        """Like lookup, for packed 0xRRGGBB colors (e.g. from a ColorPlane)."""
+        packed = np.asarray(packed).astype(np.int64)
+        if not self.biomes:
+            return np.full(packed.shape, -1, np.int64)
+
+        keys, inverse = np.unique(packed.ravel(), return_inverse=True)
+
+        with self._lut_lock:
+            if self._lut is None:
+                self._lut = np.full(1 << 24, UNRESOLVED, np.int16)
+
+            missing = keys[self._lut[keys] == UNRESOLVED]
+            if missing.size:
+                self._lut[missing] = self._nearest(missing)
+            result = self._lut[keys]
+
+        return result[inverse].astype(np.int64).reshape(packed.shape)
+
+    def _nearest(self, packed, chunk=65536):
+        """Nearest biome index for packed colors; exact matches have distance 0."""
+        out = np.empty(packed.size, np.int16)
+        for start in range(0, packed.size, chunk):
+            part = packed[start:start + chunk]
+            rgb = np.stack(((part >> 16) & 255, (part >> 8) & 255, part & 255), axis=1)
+            dist = ((rgb[:, None, :] - self._colors[None, :, :]) ** 2).sum(axis=2)
+            out[start:start + chunk] = np.argmin(dist, axis=1)
+        return out
@@ -0,0 +1,180 @@
+import config
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+from logic.progress import as_progress
+
+# Rows copied per step in the full mode, so progress keeps moving
+PROGRESS_ROWS = 256
+
+# Directions of the dilation fallback: (1, 0), (-1, 0), (0, 1), (0, -1)
+NEIGHBOURS = ((0, 1), (0, -1), (1, 0), (-1, 0))
+
+
+def fill_borders(labels, domains, progress=None):
+    """
+    Resolves the borders of a partition that holds several domains (land
+    and sea) in one label map, in place.
+
+    domains is a list of (border_mask, domain_mask) pairs: every border
+    pixel takes the nearest label inside its own domain. Pixels that are
+    still unlabelled afterwards take the nearest label of any domain.
+    """
+    progress = as_progress(progress)
+    steps = len(domains) + 1
+    for i, (border_mask, domain_mask) in enumerate(domains):
+        fill_from_nearest(labels, border_mask, progress.sub(i / steps, (i + 1) / steps), domain_mask)
+    fill_from_nearest(labels, None, progress.sub(1 - 1 / steps, 1.0))
+    progress.update(1.0)
+
+
+def check_filled(labels, what):
+    """Raises if fill_borders left any pixel of labels unlabelled (-1)."""
+    missing = int(np.count_nonzero(labels < 0))
+    if missing:
+        raise RuntimeError(f"{missing} {what} pixels are still unlabelled after filling the borders.")
+
+
+def fill_from_nearest(labels, targets=None, progress=None, sources=None):
+    """
+    Gives every unlabelled (-1) target pixel the label of the nearest
+    labelled pixel, in place. targets=None fills every unlabelled pixel,
+    sources (a bool mask) limits the labelled pixels that may be copied.
+
+    config.BORDER_FILL_MODE picks the method:
+        "full"   one Euclidean distance transform over the whole map. Needs
+                 a float and two int64 planes of the map size on top.
+        "tiled"  the same transform per row tile, with BORDER_HALO extra
+                 rows above and below. It matches "full" only for pixels
+                 whose nearest label lies within the halo, which covers
+                 thin borders. Pixels farther away are filled by growing
+                 the labels (including the ones just filled) outwards,
+                 4-connected, through the remaining targets, so they get
+                 the nearest label by steps rather than by Euclidean
+                 distance; whatever that cannot reach falls back to the
+                 full transform.
+                 Extra memory is two bool planes plus one tile.
+    """
+    progress = as_progress(progress)
+    source = labels >= 0
+    if sources is not None:
+        source &= sources
+    if not source.any():
+        return
+    if targets is None:
+        targets = labels < 0
+    if not targets.any():
+        return
+
+    if not labels.flags.c_contiguous:
+        raise ValueError("fill_from_nearest needs a C-contiguous label array.")
+
+    if config.BORDER_FILL_MODE == "full":
+        _fill_full(labels, source, targets, progress)
+    else:
+        _fill_tiled(labels, source, targets, progress)
+
+
+def _fill_full(labels, source, targets, progress):
+    _, (ny, nx) = distance_transform_edt(~source, return_indices=True)
+    progress.update(0.5)
+
+    h = labels.shape[0]
+    for y0 in range(0, h, PROGRESS_ROWS):
+        y1 = min(y0 + PROGRESS_ROWS, h)
+        bm = targets[y0:y1] & (labels[y0:y1] < 0)
+        labels[y0:y1][bm] = labels[ny[y0:y1][bm], nx[y0:y1][bm]]
+        progress.update(0.5 + 0.5 * y1 / h)
+
+
+def _fill_tiled(labels, source, targets, progress):
+    h, w = labels.shape
+    halo = config.BORDER_HALO
+    rows = max(1, config.BORDER_TILE_PIXELS // max(w, 1))
+
+    # Targets too far from any label for their tile; filled by dilation below
+    pending = None
+
+    for y0 in range(0, h, rows):
+        y1 = min(y0 + rows, h)
+        todo = targets[y0:y1] & (labels[y0:y1] < 0)
+
+        if todo.any():
+            a = max(0, y0 - halo)
+            b = min(h, y1 + halo)
+            window = source[a:b]
+
+            far = todo
+            if window.any():
+                dist, (ny, nx) = distance_transform_edt(~window, return_indices=True)
+                dist = dist[y0 - a:y1 - a]
+                ny = ny[y0 - a:y1 - a]
+                nx = nx[y0 - a:y1 - a]
+
+                # Within the halo the window holds the true nearest label
+                # (the window always spans the full width)
+                near = todo if (a == 0 and b == h) else todo & (dist <= halo)
+                labels[y0:y1][near] = labels[a + ny[near], nx[near]]
+                far = todo & ~near
+                del dist, ny, nx
+
+            if far.any():
+                if pending is None:
+                    pending = np.zeros((h, w), bool)
+                pending[y0:y1] = far
+
+        progress.update(0.8 * y1 / h)
+
+    if pending is not None:
+        # Targets filled above pass their label on as well
+        seeds = (source | targets) & (labels >= 0)
+        _dilate_into(labels, seeds, pending, progress.sub(0.8, 0.95))
+        del seeds
+
+        # Pending pixels no label can grow into (cut off by pixels that are
+        # neither source nor target) still get their exact nearest label
+        if pending.any():
+            _fill_full(labels, source, pending, progress.sub(0.95, 1.0))
+    progress.update(1.0)
+
+
+def _dilate_into(labels, seeds, pending, progress):
+    """
+    Grows the labels of the seed pixels into the pending pixels one ring at
+    a time (first claim wins). Pixels it reaches are cleared from pending.
+    """
+    h, w = labels.shape
+    flat = labels.reshape(-1)
+    open_px = pending.reshape(-1)
+    total = max(1, int(np.count_nonzero(open_px)))
+
+    # Start from every seed pixel next to a pending one
+    border = np.zeros((h, w), bool)
+    border[:, :-1] |= pending[:, 1:]
+    border[:, 1:] |= pending[:, :-1]
+    border[:-1, :] |= pending[1:, :]
+    border[1:, :] |= pending[:-1, :]
+    border &= seeds
+    frontier = np.flatnonzero(border)
+    del border
+
+    done = 0
+    while frontier.size:
+        fy, fx = np.divmod(frontier, w)
+        cand = []
+        owner = []
+        for dy, dx in NEIGHBOURS:
+            ok = (fy + dy >= 0) & (fy + dy < h) & (fx + dx >= 0) & (fx + dx < w)
+            c = frontier[ok] + dy * w + dx
+            keep = open_px[c]
+            cand.append(c[keep])
+            owner.append(frontier[ok][keep])
+        cand = np.concatenate(cand)
+        owner = np.concatenate(owner)
+
+        cand, first = np.unique(cand, return_index=True)
+        flat[cand] = flat[owner[first]]
+        open_px[cand] = False
+        frontier = cand
+
+        done += cand.size
+        progress.update(done / total)
@@ -0,0 +1,133 @@
+import config
+import threading
+import numpy as np
+
+# Ocean colors come from this box, land colors from everything outside it
+OCEAN_RANGE = ((0, 60), (0, 80), (100, 180))
+
+# Colors never handed out (black is the background of rendered maps)
+RESERVED_COLORS = ((0, 0, 0),)
+
+FEISTEL_ROUNDS = 4
+
+# Size of the permuted domain per palette (even, at least the palette size)
+PALETTE_BITS = {"land": 24, "ocean": 20}
+
+
+class ColorAllocator:
+    """
+    Hands out unique, reproducible RGB colors in batches.
+
+    Every palette is walked in the order of a seeded permutation, so the
+    k-th color of a palette only depends on the seed and k. allocate()
+    reserves consecutive ranges under a lock, which makes one allocator
+    safe to share between threads; palette_colors() is a plain function
+    for worker processes that are given their start offsets up front.
+    """
+
+    def __init__(self, seed=None):
+        self.seed = config.COLOR_SEED if seed is None else seed
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def allocate(self, ptype, count):
+        """Returns the next count colors for ptype ("ocean" or land) as a (count, 3) uint8 array."""
+        palette = _palette_name(ptype)
+        with self._lock:
+            start = self._next.get(palette, 0)
+            self._next[palette] = start + count
+        return palette_colors(ptype, start, count, self.seed)
+
+
+def palette_colors(ptype, start, count, seed):
+    """Colors start .. start+count-1 of the seeded ptype palette, as a (count, 3) uint8 array."""
+    palette = _palette_name(ptype)
+    bits = PALETTE_BITS[palette]
+    size = _palette_size(palette)
+    decode = _decode_ocean if palette == "ocean" else _decode_land
+    if start + count > size:
+        raise ValueError(
+            f"Not enough unique {palette} colors: {start + count} requested, {size} available.")
+
+    keys = _feistel_keys(seed, palette)
+    end = start + count
+
+    # Walk the permuted domain in chunks until enough valid colors were seen
+    found = []
+    n_found = 0
+    pos = 0
+    domain = 1 << bits
+    while n_found < end and pos < domain:
+        step = min(max(2 * (end - n_found), 4096), domain - pos)
+        colors = decode(_permute(np.arange(pos, pos + step, dtype=np.uint64), bits, keys))
+        colors = colors[_allowed(colors, palette)]
+        found.append(colors)
+        n_found += len(colors)
+        pos += step
+
+    return np.concatenate(found)[start:end].astype(np.uint8)
+
+
+def _palette_name(ptype):
+    return "ocean" if ptype == "ocean" else "land"
+
+
+def _feistel_keys(seed, palette):
+    rng = np.random.default_rng([seed, list(PALETTE_BITS).index(palette)])
+    return rng.integers(0, 1 << 32, FEISTEL_ROUNDS, dtype=np.uint64)
+
+
+def _permute(x, bits, keys):
+    """Balanced Feistel network: a bijection on [0, 2**bits) for even bits."""
+    half = np.uint64(bits // 2)
+    mask = np.uint64((1 << (bits // 2)) - 1)
+    left = x >> half
+    right = x & mask
+    for k in keys:
+        mixed = (right ^ k) * np.uint64(0x9E3779B97F4A7C15)
+        left, right = right, left ^ ((mixed >> np.uint64(29)) & mask)
+    return (left << half) | right
+
+
+def _decode_land(v):
+    return np.stack(((v >> np.uint64(16)) & np.uint64(255),
+                     (v >> np.uint64(8)) & np.uint64(255),
+                     v & np.uint64(255)), axis=1).astype(np.int64)
+
+
+def _decode_ocean(v):
+    (r0, r1), (g0, g1), (b0, b1) = OCEAN_RANGE
+    v = v.astype(np.int64)
+    valid = v < (r1 - r0) * (g1 - g0) * (b1 - b0)
+    r, rest = np.divmod(v, (g1 - g0) * (b1 - b0))
+    g, b = np.divmod(rest, b1 - b0)
+    colors = np.stack((r0 + r, g0 + g, b0 + b), axis=1)
+    colors[~valid] = -1
+    return colors
+
+
+def _in_ocean_range(colors):
+    inside = np.ones(len(colors), bool)
+    for channel, (lo, hi) in enumerate(OCEAN_RANGE):
+        inside &= (colors[:, channel] >= lo) & (colors[:, channel] < hi)
+    return inside
+
+
+def _allowed(colors, palette):
+    if palette == "ocean":
+        ok = colors[:, 0] >= 0
+    else:
+        ok = ~_in_ocean_range(colors)
+    for reserved in RESERVED_COLORS:
+        ok &= (colors != reserved).any(axis=1)
+    return ok
+
+
+def _palette_size(palette):
+    (r0, r1), (g0, g1), (b0, b1) = OCEAN_RANGE
+    ocean = (r1 - r0) * (g1 - g0) * (b1 - b0)
+    ocean_reserved = int(_in_ocean_range(np.array(RESERVED_COLORS)).sum())
+    if palette == "ocean":
+        return ocean - ocean_reserved
+    return (1 << 24) - ocean - (len(RESERVED_COLORS) - ocean_reserved)
+
@@ -1,18 +1,40 @@
 import os
 import json
-from PyQt6.QtWidgets import QFileDialog
 import csv
-from logic.shape_extractor import extract_shapes
+import time
+import numpy as np
+from logic.adjacency import territory_neighbors
+from logic.pipeline import run_in_process, run_jobs
+from logic.png_writer import save_png
+from logic.progress import GenerationCancelled, as_progress
+from logic.river_generator import river_flow, threshold_rivers
+from logic.shape_extractor import extract_shape_arrays
+from logic.shape_io import write_shapes_binary, write_shapes_json
+from logic.territory_io import write_territories_jsonl
 
+# The dialog based exports import Qt lazily, so the *_to_path / *_to_dir
+# functions stay usable on machines without PyQt (see cli.py).
+# They ask for the destination on the GUI thread and hand the actual writing
+# to main_layout.run_task, which returns immediately; on_success gets the
+# written path once it is done.
+
+# File extension of every province shapes format
+SHAPE_FORMATS = {"json": ".json", "binary": ".shapes"}
+
+# Territory layouts of Export All: one file per territory or one bundled file
+TERRITORY_FORMATS = {"jsonl": "territories.jsonl", "files": "territories/"}
+
+
+def export_image(parent_layout, image, text, on_success=None):
+    from PyQt6.QtWidgets import QFileDialog
 
-def export_image(parent_layout, image, text):
     if image:
         try:
             path, _ = QFileDialog.getSaveFileName(
                 parent_layout, text, "", "PNG Files (*.png)")
             if not path:
                 return None
-            image.save(path)
+            parent_layout.run_task(text, lambda progress: save_png(image, path, progress=progress), on_success)
             return path
 
         except Exception as error:
@@ -20,8 +42,10 @@ def export_image(parent_layout, image, text):
             return None
 
 
-def export_provinces_csv(main_layout):
-    metadata = getattr(main_layout, "province_data", None)
+def export_provinces_csv(main_layout, on_success=None):
+    from PyQt6.QtWidgets import QFileDialog
+
+    metadata = main_layout.project.province_data
     if not metadata:
         print("No province data to export.")
         return
@@ -31,11 +55,14 @@ def export_provinces_csv(main_layout):
     if not path:
         return None
 
-    return export_provinces_csv_to_path(main_layout, path)
+    project = main_layout.project
+    main_layout.run_task("Export Province CSV",
+                         lambda progress: export_provinces_csv_to_path(project, path), on_success)
+    return path
 
 
-def export_provinces_csv_to_path(main_layout, path):
-    metadata = getattr(main_layout, "province_data", None)
+def export_provinces_csv_to_path(project, path):
+    metadata = project.province_data
     if not metadata:
         return None
 
@@ -43,20 +70,24 @@ def export_provinces_csv_to_path(main_layout, path):
         with open(path, "w", newline="") as f:
             w = csv.writer(f, delimiter=';')
             w.writerow(["province_id", "R", "G", "B",
-                       "province_type", "x", "y", "Biome_R", "Biome_G", "Biome_B", "Biome_ID", "Biome_Name"])
+                       "province_type", "x", "y", "Biome_R", "Biome_G", "Biome_B", "Biome_ID", "Biome_Name",
+                        "Biome_Coverage"])
             for d in metadata:
                 w.writerow([d["province_id"], d["R"], d["G"], d["B"],
                             d["province_type"], round(d["x"], 2), round(d["y"], 2),
                             d.get("Biome_R", 0), d.get("Biome_G", 0), d.get("Biome_B", 0),
-                            d.get("Biome_ID", ""), d.get("Biome_Name", "")])
+                            d.get("Biome_ID", ""), d.get("Biome_Name", ""),
+                            d.get("Biome_Coverage", "")])
         return path
     except Exception as e:
         print("Error saving province data:", e)
         return None
 
 
-def export_territories_csv(main_layout):
-    metadata = getattr(main_layout, "territory_data", None)
+def export_territories_csv(main_layout, on_success=None):
+    from PyQt6.QtWidgets import QFileDialog
+
+    metadata = main_layout.project.territory_data
     if not metadata:
         print("No territory data to export.")
         return
@@ -66,11 +97,14 @@ def export_territories_csv(main_layout):
     if not path:
         return None
 
-    return export_territories_csv_to_path(main_layout, path)
+    project = main_layout.project
+    main_layout.run_task("Export Territory CSV",
+                         lambda progress: export_territories_csv_to_path(project, path), on_success)
+    return path
 
 
-def export_territories_csv_to_path(main_layout, path):
-    metadata = getattr(main_layout, "territory_data", None)
+def export_territories_csv_to_path(project, path):
+    metadata = project.territory_data
     if not metadata:
         return None
 
@@ -88,7 +122,38 @@ def export_territories_csv_to_path(main_layout, path):
         return None
 
 
-def export_territories_json(main_layout):
+def export_adjacency_csv_to_path(project, path):
+    adjacency = project.get_adjacency()
+    if adjacency is None:
+        return None
+
+    metadata = project.province_data
+    kinds = {False: "land", True: "ocean"}
+
+    try:
+        with open(path, "w", newline="") as f:
+            w = csv.writer(f, delimiter=';')
+            w.writerow(["province_a", "province_b", "border_length",
+                        "open_border_length", "adjacency_type"])
+            for (a, b), length, open_length, coast in zip(
+                    adjacency["pairs"].tolist(),
+                    adjacency["border_length"].tolist(),
+                    adjacency["open_length"].tolist(),
+                    adjacency["coast"].tolist()):
+                if coast:
+                    kind = "coast"
+                else:
+                    kind = kinds[metadata[a]["province_type"] == "ocean"]
+                w.writerow([metadata[a]["province_id"], metadata[b]["province_id"],
+                            length, open_length, kind])
+        return path
+    except Exception as e:
+        print("Error saving adjacency data:", e)
+        return None
+
+
+def export_territories_json(main_layout, on_success=None):
+    from PyQt6.QtWidgets import QFileDialog
 
     # Ask user for export directory
     export_dir = QFileDialog.getExistingDirectory(
@@ -102,22 +167,20 @@ def export_territories_json(main_layout):
         print("Territory export cancelled.")
         return None
 
-    return export_territories_to_dir(main_layout, export_dir)
-
+    project = main_layout.project
+    main_layout.run_task("Export Territory JSON",
+                         lambda progress: export_territories_to_dir(project, export_dir, progress), on_success)
+    return export_dir
 
-def export_territories_to_dir(main_layout, export_dir):
-    territories = main_layout.territory_data
 
-    for terr in territories:
-        tid = terr["territory_id"]
-        provinces = terr.get("province_ids", [])
+def export_territories_to_dir(project, export_dir, progress=None):
+    progress = as_progress(progress)
+    territories = _territory_records(project)
 
-        data = {
-            "territory_id": tid,
-            "provinces": provinces
-        }
+    for i, data in enumerate(territories):
+        progress.update(i / len(territories))
 
-        filename = os.path.join(export_dir, f"{tid}.json")
+        filename = os.path.join(export_dir, f"{data['territory_id']}.json")
 
         with open(filename, "w", encoding="utf-8") as f:
             json.dump(data, f, indent=4)
@@ -126,86 +189,145 @@ def export_territories_to_dir(main_layout, export_dir):
     return export_dir
 
 
-def export_province_shapes_json(main_layout):
-    index_map = getattr(main_layout.province_image_display, "_index_map", None)
-    metadata = getattr(main_layout, "province_data", None)
+def export_territories_jsonl_to_path(project, path):
+    """Writes every territory into one JSON lines file with an offset index (see territory_io)."""
+    territories = _territory_records(project)
+    write_territories_jsonl(path, territories)
+    print(f"Exported {len(territories)} territories to: {path}")
+    return path
+
+
+def _territory_records(project):
+    territories = project.territory_data
+    neighbors = territory_neighbors(project.get_adjacency(), project.province_data, territories)
+    return [{
+        "territory_id": terr["territory_id"],
+        "provinces": terr.get("province_ids", []),
+        "neighbors": neighbors[i]
+    } for i, terr in enumerate(territories)]
+
+
+def export_province_shapes_json(main_layout, on_success=None):
+    from PyQt6.QtWidgets import QFileDialog
+
+    index_map = main_layout.project.index_map
+    metadata = main_layout.project.province_data
 
     if index_map is None or metadata is None:
         print("No province data or index map available.")
         return
 
     path, _ = QFileDialog.getSaveFileName(
-        main_layout, "Export Province Shapes JSON", "", "JSON Files (*.json)")
+        main_layout, "Export Province Shapes", "", "JSON Files (*.json);;Binary Shapes (*.shapes)")
     if not path:
         return None
 
-    return export_province_shapes_to_path(main_layout, path)
+    project = main_layout.project
+    shape_format = "binary" if path.lower().endswith(SHAPE_FORMATS["binary"]) else "json"
+    main_layout.run_task("Export Province Shapes",
+                         lambda progress: export_province_shapes_to_path(project, path, progress, shape_format),
+                         on_success)
+    return path
 
 
-def export_province_shapes_to_path(main_layout, path):
-    index_map = getattr(main_layout.province_image_display, "_index_map", None)
-    metadata = getattr(main_layout, "province_data", None)
+def export_province_shapes_to_path(project, path, progress=None, shape_format="json"):
+    """Writes the province shapes with river flags, as JSON or binary (see SHAPE_FORMATS)."""
+    progress = as_progress(progress)
 
     print("Extracting shapes... this may take a moment.")
     try:
-        # Use cached shape data if available and fresh?
-        # For now, let's prefer the cached data if it exists (so we get rivers)
-        # If we re-run extract_shapes, we lose river data unless we re-run river gen.
-        
-        shape_data = getattr(main_layout, "shape_data", None)
-        river_edges = getattr(main_layout, "river_edges", set())
-        
-        if shape_data is None:
-             print("Generating fresh shapes for export...")
-             shape_data = extract_shapes(index_map, metadata)
-        
-        # Check for Heightmap and River Settings
-        heightmap = getattr(main_layout.heightmap_image_display, "image", None)
-        # Since ImageDisplay stores pixmap, we should use get_image() if available or check internal
-        # The MainWindow stores heightmap_image_display
-        heightmap = main_layout.heightmap_image_display.get_image()
-        
-        river_edges = set()
-        if heightmap:
-            try:
-                from logic.river_generator import generate_rivers
-                threshold = main_layout.river_threshold_slider.value()
-                print(f"Auto-generating rivers on export... (Threshold: {threshold})")
-                
-                # Metadata is already loaded as 'metadata'
-                river_edges, _ = generate_rivers(shape_data, heightmap, metadata, threshold)
-            except Exception as e:
-                print(f"Error generating rivers: {e}")
-
-        # Add river info
-        river_count = 0
-        if river_edges:
-            print(f"Found {len(river_edges)} river edges to export.")
-            for edge in shape_data["edges"]:
-                if edge["id"] in river_edges:
-                    edge["is_river"] = True
-                    river_count += 1
-                else:
-                    edge["is_river"] = False
-        else:
-            print("No river edges found (or Heightmap missing).")
-            for edge in shape_data["edges"]:
-                edge["is_river"] = False
-
-        print(f"Exporting {len(shape_data['edges'])} edges, {river_count} marked as rivers.")
-                    
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(shape_data, f) # Minify? indent=None default
-        print(f"Exported shapes to {path}")
-        return path
+        return _export_project_shapes(project, path, shape_format, progress)
+    except GenerationCancelled:
+        raise
     except Exception as e:
         print(f"Error exporting shapes: {e}")
         return None
 
 
+def _write_province_shapes(path, shapes, river_edges, shape_format, progress):
+    # Add river info (edge ids are positions in the edge arrays)
+    n_edges = len(shapes["edge_vertices"])
+    is_river = np.zeros(n_edges, bool)
+    if river_edges:
+        print(f"Found {len(river_edges)} river edges to export.")
+        is_river[np.fromiter(river_edges, np.int64, len(river_edges))] = True
+    else:
+        print("No river edges found (or Heightmap missing).")
+
+    print(f"Exporting {n_edges} edges, {int(is_river.sum())} marked as rivers.")
+    if shape_format == "binary":
+        write_shapes_binary(path, shapes, is_river)
+    else:
+        write_shapes_json(path, shapes, is_river, progress)
+
+
+def _export_shapes_job(index_map, province_data, heightmap, shapes, flow, threshold,
+                       path, shape_format, progress, blurred=None):
+    """
+    Shapes and rivers as one job, which may run in a worker process:
+    extracts whatever is not given (None), writes path and returns
+    (shapes, flow) for the project to keep.
+    """
+    if shapes is None:
+        print("Generating fresh shapes for export...")
+        shapes = extract_shape_arrays(index_map, province_data, progress.sub(0.0, 0.6))
+
+    river_edges = set()
+    if heightmap is not None:
+        try:
+            print(f"Auto-generating rivers on export... (Threshold: {threshold})")
+            if flow is None:
+                flow = river_flow(shapes, heightmap, province_data, blurred)
+            river_edges = threshold_rivers(*flow, threshold)
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            print(f"Error generating rivers: {e}")
+
+    progress.update(0.8)
+    _write_province_shapes(path, shapes, river_edges, shape_format, progress.sub(0.8, 1.0))
+    progress.update(1.0)
+    return shapes, flow
+
+
+def _export_project_shapes(project, path, shape_format, progress):
+    """
+    Runs _export_shapes_job for the project, in a worker process on maps of
+    at least EXPORT_PROCESS_PIXELS. Shapes and river flow are kept on the
+    project, so exporting again (or after a new river threshold) does not
+    extract them again.
+    """
+    import config
+
+    if project.index_map is None:
+        return None
+
+    generation = project.index_generation
+    heightmap = project.heightmap_image
+    flow = project.get_river_flow()
+    args = (project.index_map, project.province_data, heightmap, project.shape_arrays,
+            flow, project.settings["river_threshold"], path, shape_format)
+
+    if project.index_map.size >= config.EXPORT_PROCESS_PIXELS:
+        shapes, flow = run_in_process(_export_shapes_job, args, progress)
+    else:
+        blurred = project.get_blurred_heightmap() if flow is None else None
+        shapes, flow = _export_shapes_job(*args, progress, blurred)
+
+    # Unless the provinces changed meanwhile
+    if project.index_generation == generation and project.heightmap_image is heightmap:
+        if project.shape_arrays is None:
+            project.shape_arrays = shapes
+        if flow is not None and project.get_river_flow() is None:
+            project.set_river_flow(*flow)
+    print(f"Exported shapes to {path}")
+    return path
+
+
 def export_all_project(main_layout):
     import config
-    
+    from PyQt6.QtWidgets import QFileDialog, QInputDialog
+
     # 1. Ask for root directory
     root_dir = QFileDialog.getExistingDirectory(
         main_layout,
@@ -216,65 +338,124 @@ def export_all_project(main_layout):
     if not root_dir:
         return
 
+    formats = list(SHAPE_FORMATS)
+    shape_format, ok = QInputDialog.getItem(
+        main_layout, "Export All", "Province shapes format:", formats,
+        formats.index(config.SHAPE_EXPORT_FORMAT), False)
+    if not ok:
+        return
+
+    formats = list(TERRITORY_FORMATS)
+    territory_format, ok = QInputDialog.getItem(
+        main_layout, "Export All", "Territories format:", formats,
+        formats.index(config.TERRITORY_EXPORT_FORMAT), False)
+    if not ok:
+        return
+
+    project = main_layout.project
+    main_layout.run_task("Export All",
+                         lambda progress: export_all_to_dir(project, root_dir, progress,
+                                                            shape_format, territory_format))
+    return root_dir
+
+
+def export_all_to_dir(project, root_dir, progress=None, shape_format=None, territory_format=None,
+                      png_compression=None):
+    """
+    Writes every output of the project under root_dir, master.json last.
+    The outputs are independent jobs run side by side on a thread pool
+    (PNG encoding releases the GIL, see png_writer); shapes and rivers move
+    to a worker process on large maps. Prints the time each output took;
+    outputs that failed are left out of master.json.
+    """
+    import config
+
+    progress = as_progress(progress)
+    shape_format = shape_format or config.SHAPE_EXPORT_FORMAT
+    territory_format = territory_format or config.TERRITORY_EXPORT_FORMAT
+
     # 2. Structure
     map_data_dir = os.path.join(root_dir, "map_data")
     territories_dir = os.path.join(map_data_dir, "territories")
-    
-    os.makedirs(map_data_dir, exist_ok=True)
-    os.makedirs(territories_dir, exist_ok=True)
-
-    provinces_path = os.path.join(map_data_dir, "provinces.json")
-
-    # 3. Export Data
-    # Images
     images_dir = os.path.join(map_data_dir, "images")
-    os.makedirs(images_dir, exist_ok=True)
-    
-    if main_layout.province_image_display.get_image():
-        main_layout.province_image_display.get_image().save(os.path.join(images_dir, "province_map.png"))
-        
-    if main_layout.territory_image_display.get_image():
-        main_layout.territory_image_display.get_image().save(os.path.join(images_dir, "territory_map.png"))
-        
-    if main_layout.biome_map_display.get_image():
-        main_layout.biome_map_display.get_image().save(os.path.join(images_dir, "biome_map.png"))
-
-    # CSVs
     csv_dir = os.path.join(map_data_dir, "data")
-    os.makedirs(csv_dir, exist_ok=True)
-    
-    export_provinces_csv_to_path(main_layout, os.path.join(csv_dir, "provinces.csv"))
-    export_territories_csv_to_path(main_layout, os.path.join(csv_dir, "territories.csv"))
-
-    # Export Province Shapes
-    export_province_shapes_to_path(main_layout, provinces_path)
-    
-    # Export Territories
-    export_territories_to_dir(main_layout, territories_dir)
-
-    # 4. Master JSON
-    master_data = {
-        "version": config.VERSION,
-        "provinces_path": "map_data/provinces.json",
-        "territories_path": "map_data/territories/",
-        "files": {
-             "provinces": "map_data/provinces.json",
-             "territories_dir": "map_data/territories",
-             "images": {
-                 "province_map": "map_data/images/province_map.png",
-                 "territory_map": "map_data/images/territory_map.png",
-                 "biome_map": "map_data/images/biome_map.png"
-             },
-             "data": {
-                 "provinces_csv": "map_data/data/provinces.csv",
-                 "territories_csv": "map_data/data/territories.csv"
-             }
-        }
-    }
-    
+    for directory in (map_data_dir, images_dir, csv_dir):
+        os.makedirs(directory, exist_ok=True)
+    if territory_format == "files":
+        os.makedirs(territories_dir, exist_ok=True)
+
+    territories_file = TERRITORY_FORMATS[territory_format]
+
+    provinces_file = "provinces" + SHAPE_FORMATS[shape_format]
+    provinces_path = os.path.join(map_data_dir, provinces_file)
+
+    # 3. Export Data, as jobs {name: (task, weight, needs)}
+    jobs = {}
+    images = {"province_map": "province_map.png",
+              "territory_map": "territory_map.png",
+              "biome_map": "biome_map.png"}
+    for attr, filename in (("province_image", images["province_map"]),
+                           ("territory_image", images["territory_map"]),
+                           ("biome_map_image", images["biome_map"])):
+        image = getattr(project, attr)
+        if image:
+            jobs[filename] = (lambda p, image=image, filename=filename: save_png(
+                image, os.path.join(images_dir, filename), png_compression, p), 2, ())
+
+    csv_files = {"provinces_csv": "provinces.csv",
+                 "territories_csv": "territories.csv",
+                 "adjacency_csv": "adjacency.csv"}
+    if project.province_data is not None:
+        jobs["provinces.csv"] = (lambda p: export_provinces_csv_to_path(
+            project, os.path.join(csv_dir, "provinces.csv")), 1, ())
+
+    if project.index_map is not None:
+        # Built once up front; the adjacency CSV and the territory files share it
+        jobs["adjacency"] = (lambda p: project.get_adjacency(), 1, ())
+        jobs["adjacency.csv"] = (lambda p: export_adjacency_csv_to_path(
+            project, os.path.join(csv_dir, "adjacency.csv")), 1, ("adjacency",))
+        jobs[provinces_file] = (lambda p: export_province_shapes_to_path(
+            project, provinces_path, p, shape_format), 8, ())
+
+    if project.territory_data is not None:
+        jobs["territories.csv"] = (lambda p: export_territories_csv_to_path(
+            project, os.path.join(csv_dir, "territories.csv")), 1, ())
+        if territory_format == "files":
+            jobs[territories_file] = (lambda p: export_territories_to_dir(
+                project, territories_dir, p), 1, ("adjacency",))
+        else:
+            jobs[territories_file] = (lambda p: export_territories_jsonl_to_path(
+                project, os.path.join(map_data_dir, territories_file)), 1, ("adjacency",))
+
+    start = time.perf_counter()
+    timings, failed = run_jobs(jobs, progress, config.EXPORT_THREADS or os.cpu_count() or 1)
+    print(f"[all outputs] {time.perf_counter() - start:.2f}s")
+    if failed:
+        print(f"Not exported: {', '.join(sorted(failed))}")
+
+    # 4. Master JSON, listing only the files that were written
+    master_data = {"version": config.VERSION}
+    files = {}
+    if provinces_file in timings:
+        master_data["provinces_path"] = f"map_data/{provinces_file}"
+        master_data["provinces_format"] = shape_format
+        files["provinces"] = f"map_data/{provinces_file}"
+    if territories_file in timings:
+        master_data["territories_path"] = f"map_data/{territories_file}"
+        master_data["territories_format"] = territory_format
+        files["territories"] = f"map_data/{territories_file}"
+        if territory_format == "files":
+            files["territories_dir"] = "map_data/territories"
+    files["images"] = {key: f"map_data/images/{filename}"
+                       for key, filename in images.items() if filename in timings}
+    files["data"] = {key: f"map_data/data/{filename}"
+                     for key, filename in csv_files.items() if filename in timings}
+    master_data["files"] = files
+
     master_path = os.path.join(root_dir, "master.json")
     with open(master_path, "w", encoding="utf-8") as f:
         json.dump(master_data, f, indent=4)
         
     print(f"Export All completed to {root_dir}")
+    return root_dir
 
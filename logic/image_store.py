@@ -0,0 +1,279 @@
+import config
+import hashlib
+import os
+import tempfile
+import numpy as np
+from PIL import Image
+from logic.import_module import open_image
+from logic.progress import as_progress
+
+# Rows handled per step when decoding into a plane and when building masks
+INGEST_ROWS = 1024
+
+# Part of every plane's cache key; bumped when the plane layout changes
+PLANE_VERSION = 2
+
+
+class ColorPlane:
+    """
+    An RGB image with one value per pixel, so a color test is one comparison.
+
+    values holds packed 0xRRGGBB colors (uint32), or for palette images the
+    palette index of every pixel (uint8) with the packed colors in palette.
+    values may be a memory-mapped plane; it is only read in row strips.
+    """
+
+    def __init__(self, values, palette=None):
+        self.values = values
+        self.palette = palette
+        self.shape = values.shape
+
+    def mask(self, color):
+        """Bool mask of the pixels equal to the RGB color."""
+        key = pack_rgb(color)
+        mask = np.empty(self.shape, bool)
+        if self.palette is None:
+            for y0 in range(0, self.shape[0], INGEST_ROWS):
+                np.equal(self.values[y0:y0 + INGEST_ROWS], key, out=mask[y0:y0 + INGEST_ROWS])
+            return mask
+
+        # Palettes may hold the same color twice
+        hits = np.flatnonzero(self.palette == key)
+        if hits.size == 0:
+            mask[:] = False
+            return mask
+        for y0 in range(0, self.shape[0], INGEST_ROWS):
+            rows = self.values[y0:y0 + INGEST_ROWS]
+            if hits.size == 1:
+                np.equal(rows, hits[0], out=mask[y0:y0 + INGEST_ROWS])
+            else:
+                mask[y0:y0 + INGEST_ROWS] = np.isin(rows, hits)
+        return mask
+
+    def packed(self, y0=0, y1=None):
+        """Packed colors of rows y0 .. y1-1."""
+        rows = self.values[y0:y1]
+        return rows if self.palette is None else self.palette[rows]
+
+    def sample(self, ys, xs):
+        """Packed colors at the pixels (ys, xs)."""
+        values = self.values[ys, xs]
+        return values if self.palette is None else self.palette[values]
+
+
+def pack_rgb(rgb):
+    """(..., 3) RGB values (or one color) as packed 0xRRGGBB uint32 values."""
+    rgb = np.asarray(rgb)
+    return (
+        (rgb[..., 0].astype(np.uint32) << 16)
+        | (rgb[..., 1].astype(np.uint32) << 8)
+        | rgb[..., 2].astype(np.uint32)
+    )
+
+
+def unpack_rgb(packed):
+    """Packed 0xRRGGBB values as an (..., 3) int64 array."""
+    packed = np.asarray(packed).astype(np.int64)
+    return np.stack(((packed >> 16) & 255, (packed >> 8) & 255, packed & 255), axis=-1)
+
+
+def color_plane(image):
+    """
+    The ColorPlane of an input: planes pass through, PIL images and
+    (h, w[, c]) arrays are packed in row strips. Grey values v become (v, v, v).
+    """
+    if isinstance(image, ColorPlane):
+        return image
+    if not isinstance(image, np.ndarray):
+        if image.mode == "P":
+            return ColorPlane(np.array(image, copy=False), _pil_palette(image))
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGB")
+        image = np.array(image, copy=False)
+
+    h, w = image.shape[:2]
+    values = np.empty((h, w), np.uint32)
+    for y0 in range(0, h, INGEST_ROWS):
+        rows = image[y0:y0 + INGEST_ROWS]
+        if rows.ndim == 2:
+            values[y0:y0 + INGEST_ROWS] = rows.astype(np.uint32) * 0x010101
+        else:
+            values[y0:y0 + INGEST_ROWS] = pack_rgb(rows[..., :3])
+    return ColorPlane(values)
+
+
+def ingest_image(path, mode="RGB", progress=None):
+    """
+    Decodes the image at path once into memory-mapped planes under
+    config.INGEST_DIR, strip by strip, and releases the decoded image right
+    after. Later calls for the same unchanged file map the planes without
+    decoding, and the generators only page in the rows they are reading.
+
+    mode "RGB" returns a ColorPlane (packed colors, or palette indices for
+    "P" images); mode "L" returns an (h, w) uint8 array.
+    """
+    progress = as_progress(progress)
+    plane_path = _plane_path(path, mode)
+    palette_path = plane_path[:-len(".npy")] + ".palette.npy"
+    if os.path.exists(plane_path):
+        # Marks the plane as recently used for _evict_planes
+        os.utime(plane_path)
+    else:
+        _decode_to_plane(path, mode, plane_path, palette_path, progress)
+        _evict_planes(plane_path)
+    progress.update(1.0)
+
+    values = np.load(plane_path, mmap_mode="r")
+    if mode == "L":
+        return values
+    palette = np.load(palette_path) if os.path.exists(palette_path) else None
+    return ColorPlane(values, palette)
+
+
+def image_key(image):
+    """
+    Identity of an input for result caches: the backing file of a memory-
+    mapped plane (mapping the same file again gives the same key),
+    otherwise the object itself by id. Keep a reference to (or a weakref of)
+    object-keyed inputs, so a recycled id is never taken for the same image.
+    """
+    if image is None:
+        return None
+    values = getattr(image, "values", image)
+    if isinstance(values, np.memmap) and values.filename:
+        return ("file", values.filename)
+    return ("object", id(image))
+
+
+def image_size(image):
+    """(w, h) of a PIL image or an (h, w) array such as a ColorPlane."""
+    if isinstance(image, Image.Image):
+        return image.size
+    h, w = image.shape[:2]
+    return w, h
+
+
+def preview_image(image, max_size):
+    """
+    A copy of an input (ColorPlane, (h, w) array or PIL image) downsampled
+    by nearest neighbour to fit max_size (w, h), for display. Planes are
+    read with a row and column stride, so only the sampled rows are paged in.
+    """
+    w, h = image_size(image)
+    step = max(-(-w // max_size[0]), -(-h // max_size[1]), 1)
+
+    if isinstance(image, Image.Image):
+        return image.resize((max(w // step, 1), max(h // step, 1)), Image.NEAREST)
+    if isinstance(image, ColorPlane):
+        rows = image.values[::step, ::step]
+        rgb = unpack_rgb(rows if image.palette is None else image.palette[rows])
+        return Image.fromarray(rgb.astype(np.uint8))
+    return Image.fromarray(np.ascontiguousarray(image[::step, ::step]))
+
+
+def image_array(image, mode):
+    """A PIL image converted to mode as an array; arrays (planes) pass through."""
+    if isinstance(image, np.ndarray):
+        return image
+    return np.array(image.convert(mode), copy=False)
+
+
+def _plane_dir():
+    folder = config.INGEST_DIR or os.path.join(tempfile.gettempdir(), "ogs-map-tool")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def _plane_path(path, mode):
+    # Keyed on the file's identity, so an edited image is decoded again
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{mode}|{PLANE_VERSION}"
+    name = hashlib.sha1(key.encode()).hexdigest()[:20]
+    return os.path.join(_plane_dir(), f"{name}.{mode.lower()}.npy")
+
+
+def _evict_planes(keep):
+    """
+    Deletes the least recently used planes (and their palettes) until the
+    plane folder fits config.INGEST_CACHE_BYTES; keep is never deleted.
+    """
+    budget = config.INGEST_CACHE_BYTES
+    if not budget:
+        return
+
+    folder = os.path.dirname(keep)
+    planes = []
+    total = 0
+    for name in os.listdir(folder):
+        if not name.endswith(".npy") or name.endswith(".palette.npy"):
+            continue
+        plane_path = os.path.join(folder, name)
+        palette_path = plane_path[:-len(".npy")] + ".palette.npy"
+        try:
+            st = os.stat(plane_path)
+            size = st.st_size + (os.path.getsize(palette_path) if os.path.exists(palette_path) else 0)
+        except OSError:
+            continue
+        planes.append((st.st_mtime, plane_path, palette_path, size))
+        total += size
+
+    for _, plane_path, palette_path, size in sorted(planes):
+        if total <= budget:
+            break
+        if plane_path == keep:
+            continue
+        try:
+            os.remove(plane_path)
+        except OSError:
+            # Still mapped by a project (Windows does not delete open files)
+            continue
+        if os.path.exists(palette_path):
+            os.remove(palette_path)
+        total -= size
+
+
+def _pil_palette(image):
+    rgb = np.array(image.getpalette("RGB") or [], np.uint8).reshape(-1, 3)
+    # Indices past the stored palette decode as black, like PIL does
+    padded = np.zeros((256, 3), np.uint8)
+    padded[:len(rgb)] = rgb[:256]
+    return pack_rgb(padded)
+
+
+def _decode_to_plane(path, mode, plane_path, palette_path, progress):
+    image = open_image(path)
+    part_path = f"{plane_path}.{os.getpid()}.part"
+    try:
+        w, h = image.size
+        palette = None
+        if mode == "L":
+            dtype = np.uint8
+        elif image.mode == "P":
+            dtype = np.uint8
+            palette = _pil_palette(image)
+        else:
+            dtype = np.uint32
+
+        plane = np.lib.format.open_memmap(part_path, mode="w+", dtype=dtype, shape=(h, w))
+        for y0 in range(0, h, INGEST_ROWS):
+            y1 = min(y0 + INGEST_ROWS, h)
+            strip = image.crop((0, y0, w, y1))
+            if mode == "L":
+                plane[y0:y1] = np.asarray(strip.convert("L"))
+            elif palette is not None:
+                plane[y0:y1] = np.asarray(strip)
+            else:
+                plane[y0:y1] = pack_rgb(np.asarray(strip.convert("RGB")))
+            progress.update(y1 / h)
+        plane.flush()
+        del plane
+
+        # Publish the finished plane in one step; readers never see a partial
+        # file, and the palette is in place before its index plane
+        if palette is not None:
+            np.save(palette_path, palette)
+        os.replace(part_path, plane_path)
+    finally:
+        image.close()
+        if os.path.exists(part_path):
+            os.remove(part_path)
@@ -0,0 +1,160 @@
+import config
+import threading
+import weakref
+import numpy as np
+from collections import OrderedDict
+from logic.image_store import color_plane, image_key
+
+# Value of every province type in the domain map (0 is blocked)
+DOMAIN_CODES = {"land": 1, "ocean": 2}
+
+
+class MaskCache:
+    """
+    Preprocessed masks of the (boundary, land) inputs, shared by the province
+    and territory generators and kept between runs.
+
+    Entries are keyed on the identity of the inputs: the backing file of a
+    memory-mapped plane, otherwise the image object itself (held weakly, so
+    a replaced image is never matched by a recycled id). The least recently
+    used entries are evicted once the cached arrays exceed
+    config.MASK_CACHE_BYTES; an entry larger than the budget is not kept.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, boundary_image, land_image):
+        key = (image_key(boundary_image), image_key(land_image))
+        refs = (_ref(boundary_image), _ref(land_image))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and _alive(entry):
+                self._entries.move_to_end(key)
+                return entry["masks"]
+
+        masks = build_masks(boundary_image, land_image)
+        # Some masks are the same array (e.g. land_fill is land_mask without boundaries)
+        arrays = {id(a): a for a in masks.values() if a is not None}
+        size = sum(a.nbytes for a in arrays.values())
+
+        with self._lock:
+            self._entries[key] = {"masks": masks, "refs": refs, "nbytes": size}
+            self._entries.move_to_end(key)
+            self._evict()
+        return masks
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def nbytes(self):
+        with self._lock:
+            return sum(e["nbytes"] for e in self._entries.values())
+
+    def _evict(self):
+        # Entries of images that no longer exist can never be hit again
+        for key in [k for k, e in self._entries.items() if not _alive(e)]:
+            del self._entries[key]
+
+        total = sum(e["nbytes"] for e in self._entries.values())
+        while self._entries and total > config.MASK_CACHE_BYTES:
+            _, entry = self._entries.popitem(last=False)
+            total -= entry["nbytes"]
+
+
+_cache = MaskCache()
+
+
+def get_masks(boundary_image, land_image):
+    """Cached build_masks(boundary_image, land_image); the arrays are read-only."""
+    return _cache.get(boundary_image, land_image)
+
+
+def clear_masks():
+    _cache.clear()
+
+
+def build_masks(boundary_image, land_image):
+    """
+    Everything the generators derive from the boundary and land inputs, as a
+    dict of read-only arrays:
+        boundary_mask             boundary pixels (None without a boundary image)
+        land_mask, sea_mask       land and sea pixels
+        land_fill, sea_fill       where land and sea regions may grow
+        land_border, sea_border   boundary pixels on land and on sea
+        domain                    uint8 map: 0 blocked, 1 land fill, 2 sea fill
+    """
+    if boundary_image is None and land_image is None:
+        raise ValueError(
+            "Need at least boundary OR ocean image to determine map size.")
+
+    boundary_mask = build_boundary_mask(boundary_image)
+
+    if land_image is not None:
+        sea_mask = is_sea_color(land_image)
+        land_mask = ~sea_mask
+    else:
+        sea_mask = np.zeros(boundary_mask.shape, dtype=bool)
+        land_mask = np.ones(boundary_mask.shape, dtype=bool)
+
+    # Borders are only filled inside their own domain; the combined map
+    # never reads land labels on sea pixels or the other way round
+    if boundary_mask is None:
+        land_fill = land_mask
+        land_border = np.zeros_like(land_mask)
+
+        sea_fill = sea_mask
+        sea_border = np.zeros_like(sea_mask)
+    else:
+        land_fill = land_mask & ~boundary_mask
+        land_border = boundary_mask & land_mask
+
+        sea_fill = sea_mask & ~boundary_mask
+        sea_border = boundary_mask & sea_mask
+
+    masks = {
+        "boundary_mask": boundary_mask,
+        "land_mask": land_mask,
+        "sea_mask": sea_mask,
+        "land_fill": land_fill,
+        "sea_fill": sea_fill,
+        "land_border": land_border,
+        "sea_border": sea_border,
+        "domain": build_domain(land_fill, sea_fill),
+    }
+    for a in masks.values():
+        if a is not None:
+            a.flags.writeable = False
+    return masks
+
+
+def is_sea_color(image):
+    return color_plane(image).mask(config.OCEAN_COLOR)
+
+
+def build_boundary_mask(boundary_image):
+    if boundary_image is None:
+        return None
+    return color_plane(boundary_image).mask(config.BOUNDARY_COLOR)
+
+
+def build_domain(land_fill, sea_fill):
+    """uint8 map of where regions may grow: 0 nowhere, 1 land, 2 sea."""
+    domain = np.zeros(land_fill.shape, np.uint8)
+    domain[land_fill] = DOMAIN_CODES["land"]
+    domain[sea_fill] = DOMAIN_CODES["ocean"]
+    return domain
+
+
+def _alive(entry):
+    return all(r is None or r() is not None for r in entry["refs"])
+
+
+def _ref(image):
+    # File-backed planes are matched by path; anything else by a live object
+    if image is None or image_key(image)[0] == "file":
+        return None
+    return weakref.ref(image)
@@ -0,0 +1,106 @@
+import multiprocessing
+import queue
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from logic.progress import GenerationCancelled, Progress, ProgressGroup
+
+# Progress queue and cancel event of a run_in_process worker (see _init_worker)
+_updates = None
+_stop = None
+
+
+def run_jobs(jobs, progress, workers):
+    """
+    Runs jobs {name: (task, weight, needs)} on a thread pool, each one as
+    soon as the jobs named in needs have finished. task(progress) gets a
+    Progress of its own; they add up to progress by weight.
+    A job fails when its task raises or returns None (nothing written);
+    it is reported and skips the jobs that need it.
+    Returns ({name: seconds} of the jobs that finished, set of the others).
+    """
+    group = ProgressGroup(progress, {name: job[1] for name, job in jobs.items()})
+    waiting = dict(jobs)
+    running = {}
+    timings = {}
+    failed = set()
+
+    def timed(name, task):
+        start = time.perf_counter()
+        result = task(group.part(name))
+        return result, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            while waiting or running:
+                for name, (task, _, needs) in list(waiting.items()):
+                    if any(need in failed for need in needs):
+                        del waiting[name]
+                        failed.add(name)
+                        print(f"[{name}] skipped")
+                    elif all(need in timings for need in needs):
+                        del waiting[name]
+                        running[pool.submit(timed, name, task)] = name
+
+                done, _ = wait(running, timeout=0.2, return_when=FIRST_COMPLETED)
+                progress.check()
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        result, seconds = future.result()
+                    except GenerationCancelled:
+                        raise
+                    except Exception as e:
+                        failed.add(name)
+                        print(f"[{name}] failed: {e}")
+                        continue
+                    group.finish(name)
+                    if result is None:
+                        failed.add(name)
+                        print(f"[{name}] nothing written")
+                        continue
+                    timings[name] = seconds
+                    print(f"[{name}] {seconds:.2f}s")
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+    return timings, failed
+
+
+def run_in_process(function, args, progress):
+    """
+    Runs function(*args, progress) in a spawned worker process and returns
+    its result. Progress comes back through a queue; cancelling progress
+    cancels the worker at its next update.
+    """
+    # Spawned, since forking a process that runs Qt threads is unsafe
+    context = multiprocessing.get_context("spawn")
+    updates = context.Queue()
+    stop = context.Event()
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=context,
+                             initializer=_init_worker, initargs=(updates, stop)) as pool:
+        future = pool.submit(_call_with_progress, function, args)
+        try:
+            while True:
+                done, _ = wait([future], timeout=0.2)
+                try:
+                    while True:
+                        progress.update(updates.get_nowait())
+                except queue.Empty:
+                    pass
+                if done:
+                    return future.result()
+                progress.check()
+        except BaseException:
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+def _init_worker(updates, stop):
+    global _updates, _stop
+    _updates, _stop = updates, stop
+
+
+def _call_with_progress(function, args):
+    return function(*args, Progress(lambda value: _updates.put(value / 100.0), _stop))
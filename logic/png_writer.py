@@ -0,0 +1,64 @@
+import os
+import time
+import numpy as np
+from PIL import Image
+from logic.image_store import pack_rgb, unpack_rgb
+from logic.progress import as_progress
+
+# zlib settings of every PNG_COMPRESSION preset (see config.py)
+PNG_PRESETS = {
+    "fast": {"compress_level": 1},
+    "default": {"compress_level": 6},
+    "max": {"compress_level": 9, "optimize": True},
+}
+
+# Pixels converted to palette indices per step
+PALETTE_CHUNK = 4_000_000
+
+
+def save_png(image, path, compression=None, progress=None):
+    """
+    Saves image as a PNG with the zlib settings of the compression preset
+    (config.PNG_COMPRESSION by default). RGB images of at most 256 colors,
+    such as biome maps, are written as palette (P mode) PNGs with the exact
+    same colors. Prints the encode time and file size.
+    """
+    import config
+
+    progress = as_progress(progress)
+    compression = compression or config.PNG_COMPRESSION
+    start = time.perf_counter()
+
+    if config.PNG_PALETTE:
+        image = palette_image(image) or image
+    progress.update(0.3)
+
+    image.save(path, "PNG", **PNG_PRESETS[compression])
+    progress.update(1.0)
+
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(path)
+    print(f"Saved {path} ({image.mode}, {compression}): {size / 1e6:.2f} MB in {seconds:.2f}s")
+    return path
+
+
+def palette_image(image):
+    """image as a P mode image with a palette of its exact colors, or None if it has more than 256."""
+    if image.mode != "RGB":
+        return None
+    colors = image.getcolors(256)
+    if colors is None:
+        return None
+
+    palette = np.sort(pack_rgb([rgb for _, rgb in colors]))
+    pixels = np.asarray(image)
+    h, w = pixels.shape[:2]
+    indices = np.empty((h, w), np.uint8)
+    rows = max(PALETTE_CHUNK // max(w, 1), 1)
+    for r0 in range(0, h, rows):
+        indices[r0:r0 + rows] = np.searchsorted(palette, pack_rgb(pixels[r0:r0 + rows]))
+
+    # putpalette turns the L image into a P image
+    result = Image.fromarray(indices)
+    result.putpalette(unpack_rgb(palette).astype(np.uint8).ravel().tobytes())
+    return result
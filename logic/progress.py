@@ -0,0 +1,83 @@
+import threading
+
+
+class GenerationCancelled(Exception):
+    """Raised from inside a running stage once its cancel event is set."""
+
+
+class Progress:
+    """
+    Reports the progress of one stage as a fraction from 0.0 to 1.0.
+
+    The callback receives whole percentages of the overall task and is only
+    called when that percentage changes, so it is cheap to update from tight
+    loops. Every update also checks the cancel event, which is how long
+    running stages get interrupted.
+    """
+
+    def __init__(self, callback=None, cancel_event=None, start=0.0, end=100.0):
+        self.callback = callback
+        self.cancel_event = cancel_event
+        self.start = start
+        self.end = end
+        self._last = None
+
+    def sub(self, start, end):
+        """Returns a Progress covering the [start, end] part of this one."""
+        span = self.end - self.start
+        return Progress(
+            self.callback,
+            self.cancel_event,
+            self.start + span * start,
+            self.start + span * end
+        )
+
+    def check(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise GenerationCancelled()
+
+    def update(self, fraction):
+        self.check()
+        if self.callback is None:
+            return
+
+        fraction = min(max(fraction, 0.0), 1.0)
+        value = int(self.start + (self.end - self.start) * fraction)
+        if value != self._last:
+            self._last = value
+            self.callback(value)
+
+
+class ProgressGroup:
+    """
+    Combines parts of a task that run at the same time (on a thread pool)
+    into one Progress, each part counting by its weight.
+    """
+
+    def __init__(self, progress, weights):
+        self.progress = progress
+        self.weights = dict(weights)
+        self.total = sum(self.weights.values()) or 1.0
+        self.done = dict.fromkeys(self.weights, 0.0)
+        self._lock = threading.Lock()
+
+    def part(self, name):
+        """Returns the Progress of part name."""
+        return Progress(lambda value: self._set(name, value / 100.0), self.progress.cancel_event)
+
+    def finish(self, name):
+        self._set(name, 1.0)
+
+    def _set(self, name, fraction):
+        with self._lock:
+            self.done[name] = fraction
+            self.progress.update(sum(self.weights[n] * f for n, f in self.done.items()) / self.total)
+
+
+def as_progress(progress):
+    """Accepts None, a Progress or a plain callback taking a percentage."""
+    if progress is None:
+        return Progress()
+    if isinstance(progress, Progress):
+        return progress
+    return Progress(progress)
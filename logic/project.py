@@ -0,0 +1,263 @@
+import config
+import json
+import os
+import weakref
+import numpy as np
+from logic.import_module import open_image
+from logic.image_store import image_key, ingest_image
+from logic.adjacency import build_adjacency
+from logic.mask_cache import get_masks
+from logic.province_generator import build_province_map
+from logic.river_generator import blurred_heightmap, river_flow, threshold_rivers
+from logic.shape_extractor import extract_shape_arrays, shapes_from_arrays
+from logic.territory_generator import build_territory_map
+
+INPUT_KEYS = (
+    "land_image_path",
+    "boundary_image_path",
+    "biome_image_path",
+    "heightmap_image_path",
+)
+
+# Plane mode of every input when it is ingested into a memory-mapped plane
+INPUT_MODES = {
+    "land_image_path": "RGB",
+    "boundary_image_path": "RGB",
+    "biome_image_path": "RGB",
+    "heightmap_image_path": "L",
+}
+
+DEFAULT_SETTINGS = {
+    "land_province_density": config.LAND_PROVINCES_DEFAULT,
+    "ocean_province_density": config.OCEAN_PROVINCES_DEFAULT,
+    "river_threshold": 10,
+    "territory_land_density": config.LAND_TERRITORIES_DEFAULT,
+    "territory_ocean_density": config.OCEAN_TERRITORIES_DEFAULT,
+    "seed": None,  # None = different provinces and territories on every run
+}
+
+
+def prepare_input(key, path, progress=None):
+    """
+    The slow part of MapProject.load_input: decodes the input into its planes
+    (INGEST_MODE "memmap") or a loaded PIL image without touching a project,
+    so it can run off the GUI thread. Returns the input for load_input, which
+    then only maps the finished planes.
+    """
+    if config.INGEST_MODE == "memmap":
+        return ingest_image(path, INPUT_MODES[key], progress)
+    image = open_image(path)
+    image.load()
+    return image
+
+
+class MapProject:
+    """
+    Inputs, settings and generation results of one map, independent of the UI.
+    The MainWindow owns one of these; the command line tool builds its own.
+    """
+
+    def __init__(self):
+        # INPUTS
+        self.land_image = None
+        self.boundary_image = None
+        self.biome_image = None
+        self.heightmap_image = None
+        self.input_paths = dict.fromkeys(INPUT_KEYS)
+        self.settings = dict(DEFAULT_SETTINGS)
+
+        # PROVINCE RESULTS
+        self.province_image = None
+        self.biome_map_image = None
+        self.province_data = None
+        self.index_map = None
+        self.index_generation = 0  # bumped whenever the province partition changes
+        self.adjacency = None
+
+        # TERRITORY RESULTS
+        self.territory_image = None
+        self.territory_data = None
+        self.terrain_province_map = None
+
+        # SHAPE RESULTS
+        self.shape_arrays = None  # flat arrays, see shape_extractor.shapes_to_arrays
+        self.shape_data = None    # the same graph as dicts, built on first use
+        self.river_edges = None
+
+        # Kept between runs so a changed setting only redoes what it affects
+        self._province_cache = {}
+        self._river_flows = {}  # heightmap key -> (heightmap ref, edge_flow, bad_edges)
+        self._blurred_heightmap = None  # of the current heightmap, see get_blurred_heightmap
+
+    @classmethod
+    def from_state(cls, state):
+        """Builds a project from a saved project state (saves/*.json)."""
+        project = cls()
+        project.settings.update(state.get("settings", {}))
+        for key, path in state.get("inputs", {}).items():
+            if path and os.path.exists(path):
+                project.load_input(key, path)
+            elif path:
+                print(f"Input file not found: {path}")
+        return project
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r") as f:
+            return cls.from_state(json.load(f))
+
+    def set_input(self, key, image):
+        """Sets an input image by its project state key, e.g. "land_image_path"."""
+        if key not in INPUT_KEYS:
+            raise KeyError(f"Unknown input: {key}")
+        setattr(self, key[:-len("_path")], image)
+        self.input_paths[key] = None
+        if key == "heightmap_image_path":
+            self._blurred_heightmap = None
+
+    def load_input(self, key, path, image=None, progress=None):
+        """
+        Loads an input image from disk. With config.INGEST_MODE "memmap" the
+        input becomes a memory-mapped plane (see image_store.ingest_image),
+        otherwise a PIL image; image is the input prepare_input already made.
+        """
+        if image is None:
+            image = prepare_input(key, path, progress)
+        self.set_input(key, image)
+        self.input_paths[key] = path
+        return image
+
+    def generate_provinces(self, progress=None):
+        province_image, biome_map_image, metadata, index_map = build_province_map(
+            self.boundary_image,
+            self.land_image,
+            self.biome_image,
+            self.settings["land_province_density"],
+            self.settings["ocean_province_density"],
+            progress,
+            self.settings.get("seed"),
+            self._province_cache
+        )
+
+        # Shapes and river flow only depend on the partition, so they are
+        # kept when a run gives the same provinces again
+        if not self._same_partition(index_map, metadata):
+            self.index_generation += 1
+            self.shape_arrays = None
+            self.shape_data = None
+            self._river_flows = {}
+
+        self.province_image = province_image
+        self.biome_map_image = biome_map_image
+        self.province_data = metadata
+        self.index_map = index_map
+        self.adjacency = None
+
+        # Everything else derived from the old provinces is stale now
+        self.territory_image = None
+        self.territory_data = None
+        self.terrain_province_map = None
+        self.river_edges = None
+
+        return province_image, biome_map_image, metadata, index_map
+
+    def generate_territories(self, progress=None):
+        if self.province_data is None:
+            raise ValueError("Provinces must be generated before territories.")
+
+        territory_image, metadata, terrain_province_map = build_territory_map(
+            self.boundary_image,
+            self.land_image,
+            self.province_image,
+            self.province_data,
+            self.settings["territory_land_density"],
+            self.settings["territory_ocean_density"],
+            progress,
+            self.index_map,
+            self.get_adjacency(),
+            self.settings.get("seed")
+        )
+
+        self.territory_image = territory_image
+        self.territory_data = metadata
+        self.terrain_province_map = terrain_province_map
+
+        return territory_image, metadata
+
+    def get_adjacency(self):
+        """Province adjacency of the current provinces, built on first use."""
+        if self.adjacency is None and self.index_map is not None:
+            self.adjacency = build_adjacency(
+                self.index_map,
+                self.province_data,
+                get_masks(self.boundary_image, self.land_image)["boundary_mask"]
+            )
+        return self.adjacency
+
+    def get_shape_arrays(self, progress=None):
+        """Province shapes of the current provinces as flat arrays, extracted on first use."""
+        if self.shape_arrays is None and self.index_map is not None:
+            self.shape_arrays = extract_shape_arrays(self.index_map, self.province_data, progress)
+        return self.shape_arrays
+
+    def get_shapes(self, progress=None):
+        """Province shapes of the current provinces as vertex, edge and province dicts."""
+        if self.shape_data is None and self.get_shape_arrays(progress) is not None:
+            self.shape_data = shapes_from_arrays(self.shape_arrays)
+        return self.shape_data
+
+    def get_rivers(self):
+        """
+        River edge IDs of the current shapes at the current river_threshold.
+        The flow is kept for the shapes and heightmap it was computed from,
+        so a new threshold only filters it again.
+        """
+        if self.shape_arrays is None or self.heightmap_image is None:
+            return set()
+
+        flow = self.get_river_flow()
+        if flow is None:
+            flow = river_flow(self.shape_arrays, self.heightmap_image, self.province_data,
+                              self.get_blurred_heightmap())
+            self.set_river_flow(*flow)
+
+        self.river_edges = threshold_rivers(*flow, self.settings["river_threshold"])
+        return self.river_edges
+
+    def get_blurred_heightmap(self):
+        """The blurred heightmap rivers flow over, kept until the heightmap changes."""
+        if self._blurred_heightmap is None and self.heightmap_image is not None:
+            self._blurred_heightmap = blurred_heightmap(self.heightmap_image)
+        return self._blurred_heightmap
+
+    def get_river_flow(self):
+        """(edge_flow, bad_edges) of the current shapes and heightmap, or None if not computed."""
+        if self.heightmap_image is None:
+            return None
+        entry = self._river_flows.get(image_key(self.heightmap_image))
+        if entry is None or (entry[0] is not None and entry[0]() is not self.heightmap_image):
+            return None
+        return entry[1], entry[2]
+
+    def set_river_flow(self, edge_flow, bad_edges):
+        """
+        Keeps a river flow computed (or saved) for the current shapes and
+        heightmap. Flows are kept per heightmap until the partition changes.
+        Without a heightmap there is no flow to keep.
+        """
+        if self.heightmap_image is None:
+            return
+        key = image_key(self.heightmap_image)
+        ref = None if key[0] == "file" else weakref.ref(self.heightmap_image)
+        self._river_flows[key] = (ref, edge_flow, bad_edges)
+
+    def _same_partition(self, index_map, metadata):
+        old_map, old_data = self.index_map, self.province_data
+        if old_map is None or old_data is None or old_map.shape != index_map.shape:
+            return False
+        if len(old_data) != len(metadata):
+            return False
+        if any(a["province_id"] != b["province_id"] or a["province_type"] != b["province_type"]
+               for a, b in zip(old_data, metadata)):
+            return False
+        return np.array_equal(old_map, index_map)
@@ -0,0 +1,215 @@
+import json
+import os
+import struct
+import zipfile
+import numpy as np
+from PIL import Image
+from logic.progress import as_progress
+from logic.project import MapProject
+from logic.shape_extractor import SHAPE_ARRAYS
+
+# Extension of project bundles; plain .json projects only hold paths and settings
+BUNDLE_EXTENSION = ".ogsproj"
+BUNDLE_FORMAT = "ogs-map-tool project"
+BUNDLE_VERSION = 1
+
+# Result images kept in a bundle, by MapProject attribute
+BUNDLE_IMAGES = ("province_image", "biome_map_image", "territory_image")
+
+# Size of a zip local file header before its name and extra field
+_LOCAL_HEADER = struct.Struct("<4s5HIIIHH")
+
+
+def is_bundle(path):
+    return path.lower().endswith(BUNDLE_EXTENSION)
+
+
+def save_bundle(project, path, state=None):
+    """
+    Saves inputs, settings and every generation result of the project as one
+    file: an uncompressed zip of manifest.json (settings, input paths and
+    metadata) and .npy arrays (index map, result images, shape graph and
+    river flow). state is the UI project state to keep along with it.
+    Afterwards the project's index map and shape arrays are maps of the saved
+    file, as if loaded from it; saving back over that file again is fine.
+    """
+    # Windows cannot replace a file that is still mapped
+    release_bundle(project, path)
+    generation = project.index_generation
+
+    arrays = {}
+    results = {
+        "province_data": project.province_data,
+        "territory_data": project.territory_data,
+        "terrain_province_map": project.terrain_province_map,
+    }
+
+    if project.index_map is not None:
+        arrays["index_map"] = project.index_map
+    for attr in BUNDLE_IMAGES:
+        image = getattr(project, attr)
+        if image is not None:
+            arrays[attr] = np.asarray(image)
+
+    if project.shape_arrays is not None:
+        results["shape_province_ids"] = project.shape_arrays["province_ids"]
+        for name in SHAPE_ARRAYS:
+            arrays[name] = project.shape_arrays[name]
+
+        # The flow only holds for the heightmap file it came from, so a
+        # heightmap without a file keeps no flow
+        heightmap_path = project.input_paths["heightmap_image_path"]
+        flow = project.get_river_flow() if heightmap_path else None
+        if flow is not None:
+            edge_flow, bad_edges = flow
+            arrays["flow_edges"] = np.fromiter(edge_flow.keys(), np.int64, len(edge_flow))
+            arrays["flow_values"] = np.fromiter(edge_flow.values(), float, len(edge_flow))
+            arrays["bad_edges"] = np.fromiter(bad_edges, np.int64, len(bad_edges))
+            results["river_heightmap"] = _file_stamp(heightmap_path)
+
+    manifest = {
+        "format": BUNDLE_FORMAT,
+        "version": BUNDLE_VERSION,
+        "settings": project.settings,
+        # Absolute, so the bundle opens from any working directory
+        "inputs": {key: input_path and os.path.abspath(input_path)
+                   for key, input_path in project.input_paths.items()},
+        "state": state,
+        "results": results,
+    }
+
+    # Written next to the target and moved in one step, so a failed save
+    # never leaves half a bundle behind
+    part_path = f"{path}.part"
+    try:
+        with zipfile.ZipFile(part_path, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+            zf.writestr("manifest.json", json.dumps(manifest))
+            for name, array in arrays.items():
+                with zf.open(f"{name}.npy", "w", force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+        os.replace(part_path, path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    # Maps of the new file, unless the provinces changed meanwhile
+    if project.index_generation == generation:
+        with zipfile.ZipFile(path) as zf:
+            members = {info.filename[:-len(".npy")]: info
+                       for info in zf.infolist() if info.filename.endswith(".npy")}
+        if "index_map" in members:
+            project.index_map = _map_member(path, members["index_map"])
+        if project.shape_arrays is not None and "vertex_xy" in members:
+            project.shape_arrays = dict(project.shape_arrays, **{
+                name: _map_member(path, members[name]) for name in SHAPE_ARRAYS})
+    return path
+
+
+def release_bundle(project, path):
+    """
+    Copies the arrays the project maps from the bundle at path into memory,
+    so nothing of the project keeps the file open. Returns whether there
+    were any. Other references to them (e.g. the UI's tooltip map) must be
+    dropped by their owners.
+    """
+    path = os.path.abspath(path)
+    released = False
+    if _mapped_from(project.index_map, path):
+        project.index_map = np.array(project.index_map)
+        released = True
+    if project.shape_arrays is not None:
+        mapped = [name for name in SHAPE_ARRAYS if _mapped_from(project.shape_arrays[name], path)]
+        if mapped:
+            project.shape_arrays = dict(project.shape_arrays, **{
+                name: np.array(project.shape_arrays[name]) for name in mapped})
+            released = True
+    return released
+
+
+def load_bundle(path, progress=None):
+    """
+    Opens a bundle written by save_bundle. The arrays are memory-mapped
+    straight from the bundle file (its members are stored uncompressed),
+    so even large maps open without reading them; loading the inputs is
+    what takes the time and what progress follows.
+    Returns (project, state); state is None for bundles saved without one.
+    """
+    progress = as_progress(progress)
+    with zipfile.ZipFile(path) as zf:
+        manifest = json.loads(zf.read("manifest.json"))
+        if manifest.get("format") != BUNDLE_FORMAT:
+            raise ValueError(f"Not a project bundle: {path}")
+        if manifest.get("version", 0) > BUNDLE_VERSION:
+            raise ValueError(f"Project bundle version {manifest['version']} is newer than this tool.")
+        arrays = {
+            info.filename[:-len(".npy")]: _map_member(path, info)
+            for info in zf.infolist() if info.filename.endswith(".npy")
+        }
+
+    project = MapProject()
+    project.settings.update(manifest.get("settings", {}))
+    inputs = manifest.get("inputs", {})
+    for i, (key, input_path) in enumerate(inputs.items()):
+        if input_path and os.path.exists(input_path):
+            project.load_input(key, input_path, progress=progress.sub(i / len(inputs), (i + 1) / len(inputs)))
+        elif input_path:
+            print(f"Input file not found: {input_path}")
+
+    results = manifest.get("results", {})
+    project.province_data = results.get("province_data")
+    project.territory_data = results.get("territory_data")
+    project.terrain_province_map = results.get("terrain_province_map")
+    project.index_map = arrays.get("index_map")
+
+    # Images are copied out of the map; PIL keeps RGB pixels in its own layout
+    for attr in BUNDLE_IMAGES:
+        if attr in arrays:
+            setattr(project, attr, Image.fromarray(np.asarray(arrays[attr])))
+
+    if "vertex_xy" in arrays:
+        project.shape_arrays = {name: arrays[name] for name in SHAPE_ARRAYS}
+        project.shape_arrays["province_ids"] = results["shape_province_ids"]
+
+        heightmap_path = project.input_paths["heightmap_image_path"]
+        stamp = results.get("river_heightmap")
+        if ("flow_edges" in arrays and stamp is not None and project.heightmap_image is not None
+                and stamp == _file_stamp(heightmap_path)):
+            edge_flow = dict(zip(arrays["flow_edges"].tolist(), arrays["flow_values"].tolist()))
+            project.set_river_flow(edge_flow, set(arrays["bad_edges"].tolist()))
+
+    return project, manifest.get("state")
+
+
+def _map_member(path, info):
+    """Memory-maps the .npy member info of the zip file at path."""
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f"Compressed bundle member: {info.filename}")
+
+    with open(path, "rb") as f:
+        # The local header's extra field may differ from the central directory's
+        f.seek(info.header_offset)
+        header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+        f.seek(info.header_offset + _LOCAL_HEADER.size + header[-2] + header[-1])
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    if 0 in shape:
+        return np.zeros(shape, dtype)
+    return np.memmap(path, dtype, "r", offset, shape, "F" if fortran else "C")
+
+
+def _mapped_from(array, path):
+    return (isinstance(array, np.memmap) and array.filename is not None
+            and os.path.abspath(array.filename) == path)
+
+
+def _file_stamp(path):
+    if not path or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
@@ -2,242 +2,219 @@ import config
 import numpy as np
 from collections import deque
 from PIL import Image
-from scipy.ndimage import distance_transform_edt
 from logic.numb_gen import NumberSeries
-from logic.biome_manager import BiomeManager
+from logic.biome_manager import get_biome_manager
+from logic.border_fill import check_filled, fill_borders
+from logic.color_allocator import ColorAllocator
+from logic.image_store import color_plane, pack_rgb, unpack_rgb
+from logic.mask_cache import DOMAIN_CODES, get_masks
+from logic.progress import as_progress
+from logic.seed_sampler import generate_jitter_seeds
+
+# Fill mask of every province type (see mask_cache.build_masks)
+DOMAIN_FILLS = {"land": "land_fill", "ocean": "sea_fill"}
+
+# Province fields written by the biome resolution
+BIOME_FIELDS = ("Biome_R", "Biome_G", "Biome_B", "Biome_ID", "Biome_Name", "Biome_Coverage")
+
+# How often the long running loops report progress
+PROGRESS_INTERVAL = 65536
+PROGRESS_ROWS = 256
+
+# Majority-vote biome resolution: pixels per strip, and the largest
+# (province x color) table counted densely instead of through np.unique
+BIOME_STRIP_PIXELS = 1 << 22
+BIOME_DENSE_LIMIT = 1 << 22
+
+
+def build_province_map(boundary_image, land_image, biome_image,
+                       land_points, sea_points, progress=None, seed=None, cache=None):
+    """
+    Generates provinces from the input images without touching the UI.
+    The same seed (and inputs) always gives the same provinces.
+    Returns (province_image, biome_map_image, metadata, combined_indices).
+
+    Passing the same cache dict on every call makes runs incremental: land
+    and sea are only partitioned again when their own density, the seed
+    or the inputs changed, and biomes are only resolved again when the
+    land provinces changed. The result equals a full run.
+    """
+    progress = as_progress(progress)
+    progress.update(0.0)
+
+    # MASKS (shared with the territory generator and kept between runs)
+    masks = get_masks(boundary_image, land_image)
+    domain = masks["domain"]
+
+    allocator = ColorAllocator()
 
-used_colors = set()
-
-
-def generate_province_map(main_layout):
-    used_colors.clear()
-    main_layout.progress.setVisible(True)
-    main_layout.progress.setValue(10)
-
-    boundary_image = main_layout.boundary_image_display.get_image()
-    land_image = main_layout.land_image_display.get_image()
-    biome_image = main_layout.biome_image_display.get_image()
-
-    if boundary_image is None and land_image is None:
-        raise ValueError(
-            "Need at least boundary OR ocean image to determine map size.")
-
-    # BOUNDARY MASK
-    if boundary_image is not None:
-        b_arr = np.array(boundary_image, copy=False)
-
-        if b_arr.ndim == 3:
-            r, g, b = config.BOUNDARY_COLOR
-            boundary_mask = (
-                (b_arr[..., 0] == r) &
-                (b_arr[..., 1] == g) &
-                (b_arr[..., 2] == b)
-            )
-        else:
-            (val,) = config.BOUNDARY_COLOR[:1]
-            boundary_mask = (b_arr == val)
-
-        map_h, map_w = boundary_mask.shape
-
-    else:
-        boundary_mask = None
-
-    # LAND / SEA MASKS
-    if land_image is not None:
-        o_arr = np.array(land_image, copy=False)
-        sea_mask = is_sea_color(o_arr)
-        land_mask = ~sea_mask
-
-        if boundary_mask is None:
-            map_h, map_w = sea_mask.shape
-    else:
-        if boundary_mask is None:
-            raise ValueError("Could not determine map size.")
-
-        sea_mask = np.zeros((map_h, map_w), dtype=bool)
-        land_mask = np.ones((map_h, map_w), dtype=bool)
-
-    if boundary_mask is None:
-        land_fill = land_mask
-        land_border = sea_mask
-
-        sea_fill = sea_mask
-        sea_border = land_mask
+    # PREPARE BIOME DATA
+    # One packed color per pixel (greyscale maps count as RGB, alpha is dropped)
+    biome_plane = None
+    if biome_image is not None:
+        biome_plane = color_plane(biome_image)
+
+    progress.update(0.05)
+
+    # WHAT CHANGED SINCE THE CACHED RUN
+    if land_image is None:
+        sea_points = 0
+
+    cache = {} if cache is None else cache
+    points = {"land": land_points, "ocean": sea_points}
+    keys = {ptype: (n, seed, config.FLOOD_FILL_ENGINE) for ptype, n in points.items()}
+    if cache.get("masks") is not masks or (seed is None and cache.get("keys") == keys):
+        # New inputs, or an unseeded run with nothing changed (rolls new provinces)
+        cache.clear()
+    stale = [ptype for ptype in keys if cache.get("keys", {}).get(ptype) != keys[ptype]]
+    meta = {ptype: [dict(d) for d in part] for ptype, part in cache.get("meta", {}).items()}
+
+    # GENERATE PROVINCES (stale domains grow in one pass over the shared map)
+    if len(stale) == len(keys):
+        pmap = np.full(domain.shape, -1, np.int32)
     else:
-        land_fill = land_mask & ~boundary_mask
-        land_border = boundary_mask | sea_mask
+        pmap = _grown_partition(cache, domain, stale)
 
-        sea_fill = sea_mask & ~boundary_mask
-        sea_border = boundary_mask | land_mask
-
-    # CREATE NUMBER SERIES
-    series = NumberSeries(
-        config.PROVINCE_ID_PREFIX,
-        config.PROVINCE_ID_START,
-        config.PROVINCE_ID_END
+    # Land and sea draw from their own random streams, so either one can be
+    # partitioned again without touching the other
+    streams = dict(zip(keys, np.random.SeedSequence(seed).spawn(len(keys))))
+    seeds, ptypes, colors = seed_provinces(
+        masks, [(ptype, points[ptype], np.random.default_rng(streams[ptype])) for ptype in stale], allocator
     )
 
-    # PREPARE BIOME DATA
-    biome_arr = None
-    if biome_image is not None:
-        biome_arr = np.array(biome_image, copy=False)
-        # Ensure it has 3 channels for RGB
-        if biome_arr.ndim == 2:
-             # If grayscale, convert to essentially RGB by stacking
-             biome_arr = np.stack((biome_arr,)*3, axis=-1)
-        elif biome_arr.shape[2] > 3:
-             # Drop alpha if present
-             biome_arr = biome_arr[..., :3]
-
-    # GENERATE PROVINCES
-    land_points = main_layout.land_slider.value()
-    sea_points = main_layout.ocean_slider.value()
-
-    land_map, land_meta, next_index = create_province_map(
-        land_fill, land_border, land_points, 0, "land", series, biome_arr
+    n_land = ptypes.count("land") if "land" in stale else len(meta["land"])
+    if "land" in stale and "ocean" not in stale:
+        # Sea indices follow the land indices
+        old_n_land = len(meta.get("land", []))
+        if n_land != old_n_land:
+            pmap[pmap >= old_n_land] += n_land - old_n_land
+
+    start_index = 0 if "land" in stale else n_land
+    pmap, grown = create_province_map(masks, seeds, ptypes, colors, _province_series(), start_index, pmap,
+                                      progress.sub(0.05, 0.45))
+    for ptype in stale:
+        meta[ptype] = [d for d in grown if d["province_type"] == ptype]
+
+    # Province IDs follow the index order: land first, then sea
+    series = _province_series()
+    metadata = meta["land"] + meta["ocean"]
+    for d in metadata:
+        d["province_id"] = series.get_id()
+
+    # Fill pixels no province reached; they are resolved with the borders
+    unreached = np.flatnonzero((domain != 0) & (pmap < 0))
+
+    progress.update(0.45)
+
+    # RESOLVE BORDERS (each domain from its own provinces, then leftovers)
+    combined_indices = pmap
+    fill_borders(combined_indices, [(masks["land_border"], masks["land_mask"]),
+                                    (masks["sea_border"], masks["sea_mask"])],
+                 progress.sub(0.45, 0.65))
+    check_filled(combined_indices, "province")
+
+    # Shared Biome Manager (its color lookup table survives between runs)
+    biome_manager = get_biome_manager("biomes.json")
+
+    # Resolve Biomes (land provinces keep theirs while their pixels are unchanged)
+    keep_biomes = (
+        "land" not in stale
+        and cache.get("biome_image") is biome_image
+        and cache.get("biome_mode") == config.BIOME_MODE
+        and unreached.size == 0
+        and cache["unreached"].size == 0
     )
-
-    main_layout.progress.setValue(50)
-
-    if sea_points > 0 and land_image is not None:
-        sea_map, sea_meta, _ = create_province_map(
-            sea_fill, sea_border, sea_points, next_index, "ocean", series, biome_arr
-        )
+    if biome_plane is None:
+        _clear_biomes(metadata)
+    elif keep_biomes:
+        for d in meta["ocean"] if "ocean" in stale else []:
+            _set_ocean_biome(d)
+    elif config.BIOME_MODE == "majority":
+        _resolve_biomes_majority(metadata, biome_plane, biome_manager, combined_indices,
+                                 progress.sub(0.65, 0.75))
     else:
-        sea_map = np.full((map_h, map_w), -1, np.int32)
-        sea_meta = []
-
-    metadata = land_meta + sea_meta
-
-    # NOTE: combine_maps was removed/refactored here.
-    # The return statement above was sending province_image which is no longer computed there.
-    # We need to restructure this block slightly.
-    # The previous block was:
-    # province_image = combine_maps(...)
-    # main_layout.province_image_display.set_image(province_image)
-    # ...
-    # return province_image, metadata
-    
-    # Let's target the combine_maps call instead.
-
-    main_layout.button_gen_territories.setEnabled(True)
+        _resolve_biomes(metadata, biome_plane, biome_manager)
 
-    # Initialize Biome Manager
-    biome_manager = BiomeManager("biomes.json")
-    
-    # Resolve Biomes
-    if biome_arr is not None:
-         _resolve_biomes(metadata, biome_arr, biome_manager)
+    progress.update(0.75)
 
-    # COMBINE MAPS (Create the grid of IDs)
-    combined_indices = create_visual_index_grid(
-        land_map, sea_map, land_mask, sea_mask
-    )
+    cache.update(masks=masks, keys=keys, meta=meta, index_map=combined_indices, unreached=unreached,
+                 biome_image=biome_image, biome_mode=config.BIOME_MODE)
 
     # RENDER PROVINCE MAP
-    province_image = render_visual_map(combined_indices, metadata, "R", "G", "B")
+    province_image = render_visual_map(combined_indices, metadata, "R", "G", "B",
+                                       progress.sub(0.75, 0.875))
 
     # RENDER BIOME MAP
-    biome_map_image = render_visual_map(combined_indices, metadata, "Biome_R", "Biome_G", "Biome_B")
-
-    main_layout.province_image_display.set_image(province_image)
-    if hasattr(main_layout, 'biome_map_display'):
-        main_layout.biome_map_display.set_image(biome_map_image)
-        
-    main_layout.province_data = metadata
-
-    main_layout.progress.setValue(100)
-    main_layout.button_exp_prov_img.setEnabled(True)
-    if hasattr(main_layout, 'button_exp_biome_map'):
-        main_layout.button_exp_biome_map.setEnabled(True)
-
-    main_layout.button_exp_prov_csv.setEnabled(True)
-    if hasattr(main_layout, 'button_exp_prov_shapes'):
-        main_layout.button_exp_prov_shapes.setEnabled(True)
-        
-    main_layout.button_gen_territories.setEnabled(True)
-
-    return province_image, metadata, combined_indices
-
-
-# BASIC UTILITIES
-def is_sea_color(arr):
-    r, g, b = config.OCEAN_COLOR
-    return (arr[..., 0] == r) & (arr[..., 1] == g) & (arr[..., 2] == b)
+    biome_map_image = render_visual_map(combined_indices, metadata, "Biome_R", "Biome_G", "Biome_B",
+                                        progress.sub(0.875, 1.0))
 
+    return province_image, biome_map_image, metadata, combined_indices
 
-def _color_from_id(index: int, ptype: str, used_colors=used_colors):
-    rng = np.random.default_rng(index + 1)
 
-    while True:
-        if ptype == "ocean":
-            r = rng.integers(0, 60)
-            g = rng.integers(0, 80)
-            b = rng.integers(100, 180)
-        else:
-            r, g, b = map(int, rng.integers(0, 256, 3))
-
-        color = (int(r), int(g), int(b))
-        if color not in used_colors:
-            used_colors.add(color)
-            return color
-
-
-def generate_jitter_seeds(mask: np.ndarray, num_points: int):
-    if num_points <= 0:
-        return []
-
-    h, w = mask.shape
-    grid = max(1, int(np.sqrt(num_points)))
-
-    cell_h = h / grid
-    cell_w = w / grid
-    rng = np.random.default_rng()
+def seed_provinces(masks, domains, allocator):
+    """
+    Seeds and colors for the (ptype, num_points, rng) domains, in order.
+    Returns (seeds, ptypes, colors) with one entry per seed.
+    """
     seeds = []
+    ptypes = []
+    colors = []
+    for ptype, num_points, rng in domains:
+        fill_mask = masks[DOMAIN_FILLS[ptype]]
+        if num_points <= 0 or not fill_mask.any():
+            continue
+        found = generate_jitter_seeds(fill_mask, num_points, rng)
+        found = [(x, y) for x, y in found if fill_mask[y, x]]
+        seeds += found
+        ptypes += [ptype] * len(found)
+        colors += allocator.allocate(ptype, len(found)).tolist()
+    return seeds, ptypes, colors
+
+
+def create_province_map(masks, seeds, ptypes, colors, series, start_index=0, pmap=None, progress=None):
+    """
+    Grows all seeds in one pass over a shared index map (masks comes from
+    mask_cache.get_masks), numbering them from start_index. pmap is an
+    existing map to grow into; pixels of other domains keep their labels.
+    Returns (index_map, metadata); border pixels are still -1.
+    """
+    progress = as_progress(progress)
+    domain = masks["domain"]
+    if pmap is None:
+        pmap = np.full(domain.shape, -1, np.int32)
+    if not seeds:
+        return pmap, []
 
-    for gy in range(grid):
-        y0 = int(gy * cell_h)
-        y1 = int((gy + 1) * cell_h)
-
-        for gx in range(grid):
-            x0 = int(gx * cell_w)
-            x1 = int((gx + 1) * cell_w)
-
-            cell = mask[y0:y1, x0:x1]
-            ys, xs = np.where(cell)
-
-            if xs.size == 0:
-                continue
-
-            i = rng.integers(xs.size)
-            seeds.append((x0 + xs[i], y0 + ys[i]))
-
-    return seeds
-
+    engine = FLOOD_FILL_ENGINES[config.FLOOD_FILL_ENGINE]
+    pmap, metadata = engine(domain, seeds, start_index, ptypes, series, colors, progress, pmap)
+    finalize_metadata(metadata)
 
-def create_province_map(fill_mask, border_mask, num_points, start_index, ptype, series, biome_arr=None):
-    if num_points <= 0 or not fill_mask.any():
-        empty = np.full(fill_mask.shape, -1, np.int32)
-        return empty, [], start_index
+    return pmap, list(metadata.values())
 
-    seeds = generate_jitter_seeds(fill_mask, num_points)
-    seeds = [(x, y) for x, y in seeds if fill_mask[y, x]]
 
-    if not seeds:
-        empty = np.full(fill_mask.shape, -1, np.int32)
-        return empty, [], start_index
+def _province_series():
+    return NumberSeries(
+        config.PROVINCE_ID_PREFIX,
+        config.PROVINCE_ID_START,
+        config.PROVINCE_ID_END
+    )
 
-    pmap, metadata = flood_fill(fill_mask, seeds, start_index, ptype, series)
-    assign_borders(pmap, border_mask)
-    finalize_metadata(metadata, biome_arr)
 
-    next_index = len(metadata)
-    return pmap, list(metadata.values()), next_index
+def _grown_partition(cache, domain, stale):
+    """The cached index map as it was right after growth, with the stale domains cleared."""
+    pmap = cache["index_map"].copy()
+    pmap[domain == 0] = -1
+    pmap.ravel()[cache["unreached"]] = -1
+    for ptype in stale:
+        pmap[domain == DOMAIN_CODES[ptype]] = -1
+    return pmap
 
 
-def flood_fill(fill_mask, seeds, start_index, ptype, series):
-    h, w = fill_mask.shape
-    pmap = np.full((h, w), -1, np.int32)
+def flood_fill(domain, seeds, start_index, ptypes, series, colors, progress=None, pmap=None):
+    progress = as_progress(progress)
+    h, w = domain.shape
+    if pmap is None:
+        pmap = np.full((h, w), -1, np.int32)
 
     metadata = {}
     q = deque()
@@ -250,48 +227,136 @@ def flood_fill(fill_mask, seeds, start_index, ptype, series):
 
         pmap[sy, sx] = index
 
-        r, g, b = _color_from_id(index, ptype)
+        r, g, b = colors[i]
         metadata[index] = {
             "province_id": pid,
-            "province_type": ptype,
+            "province_type": ptypes[i],
             "R": r, "G": g, "B": b,
             "sum_x": sx,
             "sum_y": sy,
             "count": 1
         }
 
-        q.append((sx, sy, index))
+        q.append((sx, sy, index, domain[sy, sx]))
+
+    total = max(1, int(np.count_nonzero(domain)))
+    done = 0
 
     while q:
-        x, y, index = q.popleft()
+        x, y, index, own = q.popleft()
         d = metadata[index]
 
+        done += 1
+        if done % PROGRESS_INTERVAL == 0:
+            progress.update(done / total)
+
         for dx, dy in neighbors:
             nx = x + dx
             ny = y + dy
 
             if 0 <= nx < w and 0 <= ny < h:
-                if pmap[ny, nx] == -1 and fill_mask[ny, nx]:
+                if pmap[ny, nx] == -1 and domain[ny, nx] == own:
                     pmap[ny, nx] = index
                     d["sum_x"] += nx
                     d["sum_y"] += ny
                     d["count"] += 1
-                    q.append((nx, ny, index))
+                    q.append((nx, ny, index, own))
 
     return pmap, metadata
 
 
-def assign_borders(pmap, border_mask):
-    valid = pmap >= 0
-    if not valid.any() or not border_mask.any():
-        return
+def flood_fill_frontier(domain, seeds, start_index, ptypes, series, colors, progress=None, pmap=None):
+    """
+    Grows all seeds at once, one ring per step, using whole-array operations.
+    A seed only spreads through pixels of its own domain value.
+
+    Produces the same pmap and metadata as flood_fill: within a ring, a pixel
+    goes to the first frontier pixel (in queue order) that reaches it, with
+    neighbours tried in the same direction order as the queue version.
+    """
+    progress = as_progress(progress)
+    h, w = domain.shape
+    if pmap is None:
+        pmap = np.full((h, w), -1, np.int32)
+    flat_map = pmap.ravel()
+    flat_domain = np.ascontiguousarray(domain).ravel()
+    total = max(1, int(np.count_nonzero(flat_domain)))
+    done = len(seeds)
+
+    metadata = {}
+    frontier = np.empty(len(seeds), np.intp)
+
+    for i, (sx, sy) in enumerate(seeds):
+        index = start_index + i
+        pid = series.get_id()
+
+        frontier[i] = sy * w + sx
+        flat_map[frontier[i]] = index
+
+        r, g, b = colors[i]
+        metadata[index] = {
+            "province_id": pid,
+            "province_type": ptypes[i],
+            "R": r, "G": g, "B": b,
+        }
+
+    while frontier.size:
+        fy, fx = np.divmod(frontier, w)
+
+        # Same order as the queue version: (1, 0), (-1, 0), (0, 1), (0, -1)
+        cand = np.empty((frontier.size, 4), np.intp)
+        inside = np.empty((frontier.size, 4), bool)
+        cand[:, 0] = frontier + 1
+        inside[:, 0] = fx < w - 1
+        cand[:, 1] = frontier - 1
+        inside[:, 1] = fx > 0
+        cand[:, 2] = frontier + w
+        inside[:, 2] = fy < h - 1
+        cand[:, 3] = frontier - w
+        inside[:, 3] = fy > 0
+
+        cand = cand.ravel()
+        keep = np.flatnonzero(inside.ravel())
+        keep = keep[flat_map[cand[keep]] == -1]
+        keep = keep[flat_domain[cand[keep]] == flat_domain[frontier[keep // 4]]]
+
+        # First claim (in frontier order) wins each contested pixel
+        _, first = np.unique(cand[keep], return_index=True)
+        first.sort()
+        winners = keep[first]
+
+        next_frontier = cand[winners]
+        flat_map[next_frontier] = flat_map[frontier[winners // 4]]
+        frontier = next_frontier
+
+        done += frontier.size
+        progress.update(done / total)
+
+    _accumulate_centroids(pmap, metadata, start_index, len(seeds))
+    return pmap, metadata
+
+
+def _accumulate_centroids(pmap, metadata, start_index, count):
+    ys, xs = np.nonzero((pmap >= start_index) & (pmap < start_index + count))
+    labels = pmap[ys, xs] - start_index
+    counts = np.bincount(labels, minlength=count)
+    sum_x = np.bincount(labels, weights=xs, minlength=count)
+    sum_y = np.bincount(labels, weights=ys, minlength=count)
+
+    for index, d in metadata.items():
+        i = index - start_index
+        d["sum_x"] = int(sum_x[i])
+        d["sum_y"] = int(sum_y[i])
+        d["count"] = int(counts[i])
+
 
-    _, (ny, nx) = distance_transform_edt(~valid, return_indices=True)
-    bm = border_mask
-    pmap[bm] = pmap[ny[bm], nx[bm]]
+FLOOD_FILL_ENGINES = {
+    "queue": flood_fill,
+    "frontier": flood_fill_frontier,
+}
 
 
-def finalize_metadata(metadata, biome_arr):
+def finalize_metadata(metadata):
     for d in metadata.values():
         c = d["count"]
         d["x"] = d["sum_x"] / c
@@ -299,65 +364,189 @@ def finalize_metadata(metadata, biome_arr):
         del d["sum_x"], d["sum_y"], d["count"]
 
 
-def _resolve_biomes(metadata, biome_arr, biome_manager):
-    h, w, _ = biome_arr.shape
-    for d in metadata:
-        # Coordinates are (y, x) in array
-        ix, iy = int(d["x"]), int(d["y"])
-        
-        # Defaults
+def _resolve_biomes(metadata, biome_plane, biome_manager):
+    """Samples the biome map at every province centroid and resolves all samples in one lookup."""
+    h, w = biome_plane.shape
+    if not metadata:
+        return
+
+    # Coordinates are (y, x) in array; astype truncates like int()
+    ix = np.array([d["x"] for d in metadata]).astype(np.int64)
+    iy = np.array([d["y"] for d in metadata]).astype(np.int64)
+    is_ocean = np.array([d["province_type"] == "ocean" for d in metadata], bool)
+    sampled = ~is_ocean & (ix >= 0) & (ix < w) & (iy >= 0) & (iy < h)
+
+    packed = np.zeros(len(metadata), np.uint32)
+    packed[sampled] = biome_plane.sample(iy[sampled], ix[sampled])
+    packed[is_ocean] = pack_rgb(config.OCEAN_COLOR)
+    colors = unpack_rgb(packed)
+
+    biome_index = np.full(len(metadata), -1, np.int64)
+    biome_index[sampled] = biome_manager.lookup_packed(packed[sampled])
+
+    biomes = biome_manager.biomes
+    for d, (r, g, b), is_sampled, is_sea, index in zip(
+        metadata, colors.tolist(), sampled.tolist(), is_ocean.tolist(), biome_index.tolist()
+    ):
+        d["Biome_R"] = r
+        d["Biome_G"] = g
+        d["Biome_B"] = b
+        d["Biome_ID"] = "unknown"
+        d["Biome_Name"] = "Unknown"
+
+        if is_sea:
+            d["Biome_ID"] = "ocean"
+            d["Biome_Name"] = "Ocean"
+        elif is_sampled and index >= 0:
+            d["Biome_ID"] = biomes[index]["id"]
+            d["Biome_Name"] = biomes[index]["name"]
+
+
+def _resolve_biomes_majority(metadata, biome_plane, biome_manager, index_map, progress=None):
+    """
+    Picks the biome covering most of every province's pixels.
+
+    Packed 24-bit colors are numbered through a palette table,
+    then (province, color) pixel counts are reduced in row strips. Colors
+    resolving to the same biome vote together; the province takes the most
+    common color of the winning biome. Biome_Coverage is the winning biome's
+    share of the province's pixels.
+    """
+    progress = as_progress(progress)
+    n = len(metadata)
+    if n == 0:
+        return
+
+    # Only the part the index map and the biome map have in common is counted
+    h = min(index_map.shape[0], biome_plane.shape[0])
+    w = min(index_map.shape[1], biome_plane.shape[1])
+    is_ocean = np.array([d["province_type"] == "ocean" for d in metadata], bool)
+    rows = max(1, BIOME_STRIP_PIXELS // max(w, 1))
+
+    def strips():
+        for y0 in range(0, h, rows):
+            y1 = min(y0 + rows, h)
+            idx = index_map[y0:y1, :w]
+            packed = biome_plane.packed(y0, y1)[:, :w]
+            valid = idx >= 0
+            yield y1, idx[valid], packed[valid]
+
+    # Pass 1: palette of the colors used by provinces (ocean provinces are
+    # counted too; masking them out costs more than it saves)
+    present = np.zeros(1 << 24, bool)
+    for y1, _, packed in strips():
+        present[packed] = True
+        progress.update(0.3 * y1 / h)
+    palette = np.flatnonzero(present)
+    del present
+    n_colors = max(palette.size, 1)
+
+    color_id = np.zeros(1 << 24, np.int32)
+    color_id[palette] = np.arange(palette.size, dtype=np.int32)
+
+    # Pass 2: pixel counts per (province, color)
+    dense = n * n_colors <= BIOME_DENSE_LIMIT
+    key_type = np.int32 if n * n_colors < 2 ** 31 else np.int64
+    counts = np.zeros(n * n_colors, np.int64) if dense else None
+    parts_key, parts_count = [], []
+    for y1, idx, packed in strips():
+        key = idx.astype(key_type) * n_colors + color_id[packed]
+        if dense:
+            counts += np.bincount(key, minlength=n * n_colors)
+        else:
+            key, c = np.unique(key, return_counts=True)
+            parts_key.append(key)
+            parts_count.append(c)
+        progress.update(0.3 + 0.6 * y1 / h)
+    del color_id
+
+    if dense:
+        pair_key = np.flatnonzero(counts)
+        pair_count = counts[pair_key]
+    elif parts_key:
+        pair_key, inverse = np.unique(np.concatenate(parts_key), return_inverse=True)
+        pair_count = np.bincount(inverse, weights=np.concatenate(parts_count)).astype(np.int64)
+    else:
+        pair_key = pair_count = np.zeros(0, np.int64)
+    pair_prov, pair_color = np.divmod(pair_key, n_colors)
+
+    # Colors of the same biome vote together (every color is its own group
+    # when no biomes are loaded)
+    group = biome_manager.lookup_packed(palette) if biome_manager.biomes else np.arange(palette.size)
+    pair_group = group[pair_color]
+
+    n_groups = int(group.max(initial=0)) + 1
+    total = np.bincount(pair_prov, weights=pair_count, minlength=n)
+    group_key, inverse = np.unique(pair_prov * n_groups + pair_group, return_inverse=True)
+    group_count = np.bincount(inverse, weights=pair_count)
+    group_prov, group_id = np.divmod(group_key, n_groups)
+
+    # Winning group per province: most pixels, lowest group on ties
+    order = np.lexsort((group_id, -group_count, group_prov))
+    first = order[np.unique(group_prov[order], return_index=True)[1]]
+    win_group = np.full(n, -1, np.int64)
+    win_group[group_prov[first]] = group_id[first]
+    win_count = np.zeros(n)
+    win_count[group_prov[first]] = group_count[first]
+
+    # Most common color of the winning group, lowest color on ties
+    in_win = pair_group == win_group[pair_prov]
+    order = np.lexsort((pair_color[in_win], -pair_count[in_win], pair_prov[in_win]))
+    provs = pair_prov[in_win][order]
+    first = np.unique(provs, return_index=True)[1]
+    win_color = np.full(n, -1, np.int64)
+    win_color[provs[first]] = palette[pair_color[in_win][order][first]]
+
+    coverage = np.divide(win_count, total, out=np.zeros(n), where=total > 0)
+
+    biomes = biome_manager.biomes
+    for d, sea, color, grp, cov in zip(
+        metadata, is_ocean.tolist(), win_color.tolist(), win_group.tolist(), coverage.tolist()
+    ):
         d["Biome_R"] = 0
         d["Biome_G"] = 0
         d["Biome_B"] = 0
         d["Biome_ID"] = "unknown"
         d["Biome_Name"] = "Unknown"
+        d["Biome_Coverage"] = 0.0
 
-        if d["province_type"] == "ocean":
-            d["Biome_ID"] = "ocean"
-            d["Biome_Name"] = "Ocean"
-            r, g, b = config.OCEAN_COLOR
-            d["Biome_R"] = int(r)
-            d["Biome_G"] = int(g)
-            d["Biome_B"] = int(b)
+        if sea:
+            _set_ocean_biome(d)
             continue
 
-        if 0 <= iy < h and 0 <= ix < w:
-            r, g, b = biome_arr[iy, ix]
-            d["Biome_R"] = int(r)
-            d["Biome_G"] = int(g)
-            d["Biome_B"] = int(b)
-            
-            biome = biome_manager.get_biome(int(r), int(g), int(b))
-            if biome:
-                d["Biome_ID"] = biome["id"]
-                d["Biome_Name"] = biome["name"]
-
-
-def create_visual_index_grid(land_map, sea_map, land_mask, sea_mask):
-    if land_map is not None and land_map.size > 0:
-        h, w = land_map.shape
-    else:
-        h, w = sea_map.shape
+        if color < 0:
+            continue
 
-    combined = np.full((h, w), -1, np.int32)
+        d["Biome_R"] = (color >> 16) & 255
+        d["Biome_G"] = (color >> 8) & 255
+        d["Biome_B"] = color & 255
+        d["Biome_Coverage"] = round(cov, 4)
+        if biomes:
+            d["Biome_ID"] = biomes[grp]["id"]
+            d["Biome_Name"] = biomes[grp]["name"]
 
-    if land_map is not None:
-        lm = (land_map >= 0) & land_mask
-        combined[lm] = land_map[lm]
+    progress.update(1.0)
 
-    if sea_map is not None:
-        sm = (sea_map >= 0) & sea_mask
-        combined[sm] = sea_map[sm]
 
-    if (combined >= 0).any():
-        valid = combined >= 0
-        _, (ny, nx) = distance_transform_edt(~valid, return_indices=True)
-        missing = combined < 0
-        combined[missing] = combined[ny[missing], nx[missing]]
-        
-    return combined
+def _set_ocean_biome(d):
+    r, g, b = config.OCEAN_COLOR
+    d["Biome_R"] = int(r)
+    d["Biome_G"] = int(g)
+    d["Biome_B"] = int(b)
+    d["Biome_ID"] = "ocean"
+    d["Biome_Name"] = "Ocean"
+    if config.BIOME_MODE == "majority":
+        d["Biome_Coverage"] = 1.0
 
-def render_visual_map(combined, metadata, r_key, g_key, b_key):
+
+def _clear_biomes(metadata):
+    for d in metadata:
+        for key in BIOME_FIELDS:
+            d.pop(key, None)
+
+
+def render_visual_map(combined, metadata, r_key, g_key, b_key, progress=None):
+    progress = as_progress(progress)
     h, w = combined.shape
     out = np.zeros((h, w, 3), np.uint8)
 
@@ -365,25 +554,20 @@ def render_visual_map(combined, metadata, r_key, g_key, b_key):
         return Image.fromarray(out)
         
     # Create LUT
-    # Metadata is list of dicts. But indices in combined map correspond to list order?
-    # Yes, create_province_map uses 'start_index' and increments.
-    # And pmap is filled with 'index'.
-    # In generate_province_map:
-    # land_map starts at 0.
-    # sea_map starts at next_index.
-    # metadata = land_meta + sea_meta
-    # So combined indices should map perfectly to metadata list indices.
+    # create_province_map numbers the seeds 0, 1, 2, ... (land first, then
+    # sea) and metadata keeps that order, so combined indices map directly
+    # to metadata list indices.
     
     color_lut = np.zeros((len(metadata), 3), np.uint8)
 
     for index, d in enumerate(metadata):
         color_lut[index] = (d.get(r_key, 0), d.get(g_key, 0), d.get(b_key, 0))
 
-    valid = combined >= 0
-    out[valid] = color_lut[combined[valid]]
+    for y0 in range(0, h, PROGRESS_ROWS):
+        y1 = min(y0 + PROGRESS_ROWS, h)
+        rows = combined[y0:y1]
+        valid = rows >= 0
+        out[y0:y1][valid] = color_lut[rows[valid]]
+        progress.update(y1 / h)
 
     return Image.fromarray(out)
-
-# Deprecating old combine_maps to avoid confusion, or keeping it as wrapper if needed? 
-# It's better to remove it since we replaced its usage.
-
@@ -1,23 +1,72 @@
+import config
+import itertools
 import numpy as np
 import collections
+from logic.image_store import image_array
+
 
 def generate_rivers(shape_data, heightmap_image, province_data, river_threshold=10):
     """
-    Generates rivers based on shape data (graph) and heightmap.
+    Generates rivers with the engine selected by config.RIVER_ENGINE.
+    Returns (river_edges, edge_flow).
+    """
+    edge_flow, bad_edges = river_flow(shape_data, heightmap_image, province_data)
+    return threshold_rivers(edge_flow, bad_edges, river_threshold), edge_flow
+
+
+def river_flow(shape_data, heightmap_image, province_data, blurred=None):
+    """
+    The part of river generation that does not depend on the threshold:
+    (edge_flow, bad_edges). Keep it to try other thresholds with threshold_rivers.
+    blurred is blurred_heightmap(heightmap_image) if the caller keeps it.
+    """
+    engine = RIVER_ENGINES[config.RIVER_ENGINE]
+    return engine(shape_data, heightmap_image, province_data, blurred)
+
+
+def threshold_rivers(edge_flow, bad_edges, river_threshold=10):
+    """Edge IDs carrying at least river_threshold flow, without the bad edges."""
+    # strict check: must meet threshold AND not be bad edge
+    return {eid for eid, flow in edge_flow.items()
+            if flow >= river_threshold and eid not in bad_edges}
+
+
+def blurred_heightmap(heightmap_image):
+    """
+    The heightmap as floats with the Gaussian blur rivers flow over
+    (read-only). MapProject keeps it while its heightmap is loaded.
+    """
+    from scipy.ndimage import gaussian_filter
+
+    base_hm_arr = np.array(image_array(heightmap_image, 'L'), dtype=float)
+
+    # Gaussian Blur for gradients - Increased to 3.0 for smoother, longer flow
+    hm_arr = gaussian_filter(base_hm_arr, sigma=3.0)
+    hm_arr.flags.writeable = False
+    return hm_arr
+
+
+def river_flow_dict(shape_data, heightmap_image, province_data, blurred=None):
+    """
+    Accumulates river flow based on shape data (graph) and heightmap.
     Restricts river sources to high-elevation land.
     
     Args:
-        shape_data (dict): Output from extract_shapes.
-        heightmap_image (PIL.Image): Grayscale heightmap.
+        shape_data (dict): Output from extract_shapes (or its flat arrays).
+        heightmap_image (PIL.Image or array): Grayscale heightmap.
         province_data (list): Metadata list matching shape_data['provinces'].
-        river_threshold (int): Flow threshold.
+        blurred (array): blurred_heightmap(heightmap_image), if already made.
         
     Returns:
-        river_edges (set): Set of edge IDs that are rivers.
-        flow_map (dict): values of flow for edges.
+        edge_flow (dict): values of flow for edges.
+        bad_edges (set): edge IDs touching Ocean, which are never rivers.
     """
     if not shape_data or heightmap_image is None:
-        return set(), {}
+        return {}, set()
+
+    if "vertex_xy" in shape_data:
+        from logic.shape_extractor import shapes_from_arrays
+        shape_data = shapes_from_arrays(shape_data)
         
     vertices = shape_data['vertices']
     edges = shape_data['edges']
@@ -58,13 +107,8 @@ def generate_rivers(shape_data, heightmap_image, province_data, river_threshold=
         v_is_land[vid] = any(flags)
 
     # --- 1. Map Vertex Heights ---
-    from scipy.ndimage import gaussian_filter
-    
-    base_hm_arr = np.array(heightmap_image.convert('L'), dtype=float)
-    h_h, h_w = base_hm_arr.shape
-    
-    # Gaussian Blur for gradients - Increased to 3.0 for smoother, longer flow
-    hm_arr = gaussian_filter(base_hm_arr, sigma=3.0)
+    hm_arr = blurred if blurred is not None else blurred_heightmap(heightmap_image)
+    h_h, h_w = hm_arr.shape
     
     # Scaling logic
     max_vx = max(v['x'] for v in vertices) if vertices else 0
@@ -169,13 +213,181 @@ def generate_rivers(shape_data, heightmap_image, province_data, river_threshold=
                     max_flow = edge_flow[eid]
             
     print(f"DEBUG: Max Flow accumulated: {max_flow}")
-            
-    # --- 5. Filter Rivers ---
-    river_edges = set()
-    for eid, flow in edge_flow.items():
-        # strict check: must meet threshold AND not be bad edge
-        if flow >= river_threshold:
-            if not edge_is_bad.get(eid, False):
-                river_edges.add(eid)
-            
-    return river_edges, edge_flow
+
+    bad_edges = {eid for eid, bad in edge_is_bad.items() if bad}
+    return edge_flow, bad_edges
+
+
+def _graph_arrays(shape_data):
+    """(edge_ids, v1, v2, province edge counts, province edge ids, vertex x, vertex y) of either shape form."""
+    if "vertex_xy" in shape_data:
+        # Flat arrays: vertex and edge ids are list positions
+        vertex_xy = np.asarray(shape_data["vertex_xy"], np.int64)
+        edge_vertices = np.asarray(shape_data["edge_vertices"], np.int64)
+        return (
+            np.arange(len(edge_vertices)),
+            edge_vertices[:, 0],
+            edge_vertices[:, 1],
+            np.diff(np.asarray(shape_data["province_starts"], np.int64)),
+            np.asarray(shape_data["province_edges"], np.int64),
+            vertex_xy[:, 0].astype(float),
+            vertex_xy[:, 1].astype(float),
+        )
+
+    vertices = shape_data['vertices']
+    edges = shape_data['edges']
+    provinces = shape_data['provinces']
+    n_v = len(vertices)
+    n_e = len(edges)
+
+    counts = np.fromiter((len(p['edges']) for p in provinces), np.int64, len(provinces))
+    return (
+        np.fromiter((e['id'] for e in edges), np.int64, n_e),
+        np.fromiter((e['v1'] for e in edges), np.int64, n_e),
+        np.fromiter((e['v2'] for e in edges), np.int64, n_e),
+        counts,
+        np.fromiter(itertools.chain.from_iterable(p['edges'] for p in provinces), np.int64,
+                    int(counts.sum())),
+        np.fromiter((v['x'] for v in vertices), float, n_v),
+        np.fromiter((v['y'] for v in vertices), float, n_v),
+    )
+
+
+def river_flow_csr(shape_data, heightmap_image, province_data, blurred=None):
+    """
+    Same flow as river_flow_dict, computed on NumPy arrays.
+
+    The vertex graph is kept in CSR form: the incidences of every vertex are
+    sorted by edge order, so steepest descent is a per-row reduction with the
+    same tie-breaking as the dict engine. Flow is accumulated over the
+    downstream forest in topological order, one wave of vertices at a time.
+    Vertex ids are list positions, as extract_shapes numbers them.
+    Takes the shapes as dicts or as flat arrays (shapes_to_arrays).
+    """
+    if not shape_data or heightmap_image is None:
+        return {}, set()
+
+    edge_ids, ev1, ev2, counts, inc_eid, vx, vy = _graph_arrays(shape_data)
+    n_v = vx.size
+    n_e = edge_ids.size
+    n_p = counts.size
+
+    # --- 0. Identify Land Vertices & Edges ---
+    # Province/edge incidences; an edge listed by any Ocean province is "bad"
+    prov_ocean = np.zeros(n_p, bool)
+    if province_data:
+        n_typed = min(len(province_data), n_p)
+        prov_ocean[:n_typed] = [
+            province_data[i].get("province_type", "Land") == "Ocean" for i in range(n_typed)
+        ]
+    inc_ocean = np.repeat(prov_ocean, counts)
+
+    # Edge positions of the incidences (ids missing from the edge list are skipped)
+    id_order = np.argsort(edge_ids, kind="stable")
+    at = np.minimum(np.searchsorted(edge_ids[id_order], inc_eid), max(n_e - 1, 0))
+    found = edge_ids[id_order][at] == inc_eid if n_e else np.zeros(inc_eid.size, bool)
+    inc_pos = id_order[at[found]]
+    inc_ocean = inc_ocean[found]
+
+    edge_is_bad = np.zeros(n_e, bool)
+    edge_is_bad[inc_pos[inc_ocean]] = True
+
+    v_is_land = np.zeros(n_v, bool)
+    land_pos = inc_pos[~inc_ocean]
+    v_is_land[ev1[land_pos]] = True
+    v_is_land[ev2[land_pos]] = True
+
+    # --- 1. Map Vertex Heights ---
+    hm_arr = blurred if blurred is not None else blurred_heightmap(heightmap_image)
+    h_h, h_w = hm_arr.shape
+
+    max_vx = vx.max() if n_v else 0
+    max_vy = vy.max() if n_v else 0
+
+    scale_x = h_w / (max_vx + 1) if max_vx > 0 else 1.0
+    scale_y = h_h / (max_vy + 1) if max_vy > 0 else 1.0
+    need_scale = abs(scale_x - 1.0) > 0.01 or abs(scale_y - 1.0) > 0.01
+
+    if need_scale:
+        print(f"DEBUG: Scaling Heightmap Lookups: {scale_x:.2f}, {scale_y:.2f}")
+        vx *= scale_x
+        vy *= scale_y
+
+    # astype truncates like int() does
+    xi = np.clip(vx.astype(np.int64), 0, h_w - 1)
+    yi = np.clip(vy.astype(np.int64), 0, h_h - 1)
+    v_heights = hm_arr[yi, xi]
+    land_heights = v_heights[v_is_land]
+
+    source_threshold_height = 0
+    if land_heights.size:
+        source_threshold_height = np.percentile(land_heights, 60)
+        print(f"DEBUG: Land Height Stats - Min: {land_heights.min():.1f}, Max: {land_heights.max():.1f}, Source Threshold (60%): {source_threshold_height:.1f}")
+    else:
+        print("DEBUG: No Land Vertices found.")
+
+    # --- 2. Build Adjacency Graph (CSR) ---
+    # Row v holds (neighbour, edge position) of every edge at v, in edge order
+    src = np.concatenate((ev1, ev2))
+    dst = np.concatenate((ev2, ev1))
+    inc_edge = np.tile(np.arange(n_e), 2)
+    order = np.lexsort((inc_edge, src))
+    src, dst, inc_edge = src[order], dst[order], inc_edge[order]
+
+    indptr = np.zeros(n_v + 1, np.int64)
+    np.cumsum(np.bincount(src, minlength=n_v), out=indptr[1:])
+
+    # --- 3. Calculate Flow Direction ---
+    # Steepest descent per row; the first of equal drops wins
+    drop = v_heights[src] - v_heights[dst]
+    drop[~((drop > 0.0001) & v_is_land[src])] = -np.inf
+
+    best = np.full(n_v, -np.inf)
+    rows = np.flatnonzero(indptr[1:] > indptr[:-1])
+    if rows.size:
+        best[rows] = np.maximum.reduceat(drop, indptr[rows])
+
+    hit = np.flatnonzero((drop == best[src]) & np.isfinite(drop))
+    down_vids, first = np.unique(src[hit], return_index=True)
+    downstream = np.full(n_v, -1, np.int64)
+    downstream[down_vids] = dst[hit[first]]
+    down_edge = np.full(n_v, -1, np.int64)
+    down_edge[down_vids] = inc_edge[hit[first]]
+
+    # --- 4. Accumulate Flow ---
+    v_flow = np.where(v_is_land & (v_heights >= source_threshold_height), 1.0, 0.0)
+    sources_count = int(np.count_nonzero(v_flow))
+    print(f"DEBUG: River Sources: {sources_count} vertices")
+
+    # Every vertex drains strictly downhill, so the downstream links form a
+    # forest. A vertex passes its flow on once all of its upstream are done.
+    has_down = downstream >= 0
+    pending = np.bincount(downstream[has_down], minlength=n_v)
+    wave = np.flatnonzero(has_down & (pending == 0))
+    while wave.size:
+        targets = downstream[wave]
+        np.add.at(v_flow, targets, v_flow[wave])
+        np.subtract.at(pending, targets, 1)
+        targets = np.unique(targets)
+        wave = targets[(pending[targets] == 0) & has_down[targets]]
+
+    # Same insertion order as the dict engine: highest vertices first
+    flowing = np.flatnonzero(has_down & (v_flow > 0))
+    flowing = flowing[np.argsort(-v_heights[flowing], kind="stable")]
+    flow_pos = down_edge[flowing]
+    flow_val = v_flow[flowing]
+
+    edge_flow = collections.defaultdict(float)
+    edge_flow.update(zip(edge_ids[flow_pos].tolist(), flow_val.tolist()))
+
+    max_flow = flow_val.max() if flow_val.size else 0
+    print(f"DEBUG: Max Flow accumulated: {max_flow}")
+
+    bad_edges = set(edge_ids[edge_is_bad].tolist())
+    return edge_flow, bad_edges
+
+
+RIVER_ENGINES = {
+    "dict": river_flow_dict,
+    "csr": river_flow_csr,
+}
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+def generate_jitter_seeds(mask: np.ndarray, num_points: int, seed=None):
+    """
+    Picks exactly min(num_points, valid pixels) distinct seed pixels inside mask.
+
+    The map is cut into a grid of roughly num_points cells that hold valid
+    pixels, and the valid pixels are ranked cell by cell in serpentine
+    order (row by row inside a cell). That ranking is split into num_points
+    equal strata and one random pixel is drawn from each, so seeds are
+    spread like jittered grid points but partly filled cells never lose one.
+
+    seed is anything np.random.default_rng accepts (None, an int or a
+    Generator). Returns a list of (x, y) tuples.
+    """
+    if num_points <= 0:
+        return []
+
+    h, w = mask.shape
+    rng = np.random.default_rng(seed)
+
+    # Valid pixels per cell, counted one band of cell rows at a time
+    n_cells = num_points * h * w / max(int(np.count_nonzero(mask)), 1)
+    grid_y = int(min(max(round(np.sqrt(n_cells * h / w)), 1), h))
+    grid_x = int(min(max(round(n_cells / grid_y), 1), w))
+    x_edges = np.arange(grid_x + 1) * w // grid_x
+    y_edges = np.arange(grid_y + 1) * h // grid_y
+    cell_counts = np.empty((grid_y, grid_x), np.int64)
+    for cy in range(grid_y):
+        columns = np.count_nonzero(mask[y_edges[cy]:y_edges[cy + 1]], axis=0)
+        cell_counts[cy] = np.add.reduceat(columns, x_edges[:-1])
+
+    # Cells in ranking order: serpentine, every other row of cells reversed
+    cell_counts[1::2] = cell_counts[1::2, ::-1]
+    cum = np.cumsum(cell_counts.ravel())
+    total = int(cum[-1])
+    count = min(num_points, total)
+    if count == 0:
+        return []
+
+    # One rank per stratum [lo, hi); strata are at least one pixel wide
+    bounds = np.arange(count + 1, dtype=np.int64) * total // count
+    lo = bounds[:-1]
+    ranks = lo + (rng.random(count) * (bounds[1:] - lo)).astype(np.int64)
+    cell = np.searchsorted(cum, ranks, side="right")
+    local = ranks - (cum[cell] - cell_counts.ravel()[cell])
+    cys, cxs = np.divmod(cell, grid_x)
+    cxs = np.where(cys % 2 == 1, grid_x - 1 - cxs, cxs)
+
+    # Ranks are sorted, so the seeds of a band of cells are one run
+    xs = np.empty(count, np.int64)
+    ys = np.empty(count, np.int64)
+    band_starts = np.searchsorted(cys, np.arange(grid_y + 1))
+    for cy in range(grid_y):
+        s0, s1 = band_starts[cy], band_starts[cy + 1]
+        if s0 == s1:
+            continue
+        y0, y1 = y_edges[cy], y_edges[cy + 1]
+        band = np.asarray(mask[y0:y1], bool)
+        cx = cxs[s0:s1]
+
+        # The row of the local-th valid pixel inside each chosen cell
+        row_cum = np.cumsum(np.add.reduceat(band, x_edges[:-1], axis=1, dtype=np.int64), axis=0)
+        rows = np.count_nonzero(row_cum[:, cx] <= local[s0:s1], axis=0)
+        before = np.where(rows > 0, row_cum[np.maximum(rows - 1, 0), cx], 0)
+        row_local = local[s0:s1] - before
+
+        # and its column inside that row of the cell
+        x0 = x_edges[cx]
+        width = x_edges[cx + 1] - x0
+        offsets = np.arange(int(width.max()))
+        window = band[rows[:, None], np.minimum(x0[:, None] + offsets, w - 1)] & (offsets < width[:, None])
+        xs[s0:s1] = x0 + np.argmax(np.cumsum(window, axis=1) > row_local[:, None], axis=1)
+        ys[s0:s1] = y0 + rows
+
+    return list(zip(xs.tolist(), ys.tolist()))
@@ -1,191 +1,377 @@
+import os
+import config
 import numpy as np
-from collections import defaultdict
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from logic.progress import as_progress
 
-def extract_shapes(index_map, metadata):
+# Directions of a segment as seen from one of its end points, in the order
+# edges are traced from a node: 0=Right, 1=Down, 2=Left, 3=Up
+RIGHT, DOWN, LEFT, UP = 0, 1, 2, 3
+
+# Array entries of the flat shape graph (see shapes_to_arrays)
+SHAPE_ARRAYS = ("vertex_xy", "edge_vertices", "province_starts", "province_edges")
+
+
+def extract_shapes(index_map, metadata, progress=None):
+    """The shape graph of extract_shape_arrays as lists of vertex, edge and province dicts."""
+    return shapes_from_arrays(extract_shape_arrays(index_map, metadata, progress))
+
+
+def extract_shape_arrays(index_map, metadata, progress=None):
     """
-    Extracts topological shapes (Vertices, Edges, Provinces) from the index map.
+    Extracts topological shapes (Vertices, Edges, Provinces) from the index
+    map, as the flat arrays described in shapes_to_arrays.
+
+    Boundaries run along the pixel grid. Grid points where three or four
+    boundary segments meet are vertices, and every chain of segments between
+    two vertices is an edge. Closed loops without any vertex (islands) get a
+    vertex forced onto their top-left corner.
+
+    Vertices are numbered row by row. Edges are numbered in the order a
+    node-by-node trace would find them: by start vertex, then by direction
+    (Right, Down, Left, Up), followed by the islands in scan order.
+
+    With config.SHAPE_ENGINE = "tiled" the map is traced in row bands by a
+    process pool and the bands are stitched along their seams afterwards.
+    The result is the same as tracing the whole map at once.
     """
+    progress = as_progress(progress)
     h, w = index_map.shape
-    
+
+    bands = _split_rows(h, w)
+    tiles = _trace_bands(index_map, bands, progress.sub(0.0, 0.6))
+
+    # Global segment ids: all H segments row by row, then all V segments,
+    # so every band owns one contiguous block of each
+    n_h_tile = [t["h_pos"].size for t in tiles]
+    n_v_tile = [t["v_pos"].size for t in tiles]
+    n_h = sum(n_h_tile)
+    n_segs = n_h + sum(n_v_tile)
+    h_off = np.cumsum([0] + n_h_tile[:-1])
+    v_off = n_h + np.cumsum([0] + n_v_tile[:-1])
+
+    h_pos = np.concatenate([t["h_pos"] for t in tiles])
+    v_pos = np.concatenate([t["v_pos"] for t in tiles])
+    hy, hx = np.divmod(h_pos, w)
+    vy, vx = np.divmod(v_pos, w + 1)
+    node_points = np.concatenate([t["node_points"] for t in tiles])
+
+    def to_global(k, local):
+        return np.where(local < n_h_tile[k], h_off[k] + local, v_off[k] + local - n_h_tile[k])
+
+    # Chains of every band, then merged where they continue across a seam
+    chain = np.empty(n_segs, np.int64)
+    chain_off = 0
+    for k, t in enumerate(tiles):
+        local = t["chain"] + chain_off
+        chain[h_off[k]:h_off[k] + n_h_tile[k]] = local[:n_h_tile[k]]
+        chain[v_off[k]:v_off[k] + n_v_tile[k]] = local[n_h_tile[k]:]
+        chain_off += t["n_chains"]
+
+    seam_point = np.concatenate([t["seam_point"] for t in tiles])
+    seam_seg = np.concatenate([to_global(k, t["seam_seg"]) for k, t in enumerate(tiles)])
+    linked = chain[seam_seg[np.argsort(seam_point, kind="stable")]].reshape(-1, 2)
+
+    graph = coo_matrix(
+        (np.ones(linked.shape[0], np.int8), (linked[:, 0], linked[:, 1])),
+        shape=(chain_off, chain_off)
+    )
+    n_chains, merged = connected_components(graph, directed=False)
+    chain = merged[chain]
+    progress.update(0.65)
+
+    # Edges between vertices: every chain has exactly two stubs at nodes.
+    # The stub with the smaller (vertex, direction) key starts the edge.
+    stub_point = np.concatenate([t["stub_point"] for t in tiles])
+    stub_dir = np.concatenate([t["stub_dir"] for t in tiles])
+    stub_seg = np.concatenate([to_global(k, t["stub_seg"]) for k, t in enumerate(tiles)])
+    del tiles
+
+    stub_key = np.searchsorted(node_points, stub_point) * 4 + stub_dir
+    stub_chain = chain[stub_seg]
+    order = np.lexsort((stub_key, stub_chain))
+    stub_key = stub_key[order].reshape(-1, 2)
+    stub_seg = stub_seg[order].reshape(-1, 2)
+
+    path_order = np.argsort(stub_key[:, 0])
+    path_v1 = stub_key[path_order, 0] // 4
+    path_v2 = stub_key[path_order, 1] // 4
+    path_seg = stub_seg[path_order, 0]
+
+    # Islands: chains without stubs, found in scan order of their top-left
+    # H segment, which also gets the forced vertex
+    has_stub = np.zeros(n_chains, bool)
+    has_stub[stub_chain] = True
+    h_chains, first_h = np.unique(chain[:n_h], return_index=True)
+    loop_seg = np.sort(first_h[~has_stub[h_chains]])
+
+    n_nodes = node_points.size
+    loop_v = np.arange(n_nodes, n_nodes + loop_seg.size)
+    progress.update(0.75)
+
+    # Vertices
+    ny, nx = np.divmod(node_points, w + 1)
+    vertex_xy = np.column_stack((np.concatenate((nx, hx[loop_seg])),
+                                 np.concatenate((ny, hy[loop_seg])))).astype(np.int64)
+
+    # Edges
+    edge_vertices = np.column_stack((np.concatenate((path_v1, loop_v)),
+                                     np.concatenate((path_v2, loop_v)))).astype(np.int64)
+
+    # Provinces on both sides of every edge (constant along an edge)
+    edge_seg = np.concatenate((path_seg, loop_seg))
+    p1, p2 = _segment_sides(index_map, edge_seg, n_h, hy, hx, vy, vx)
+    progress.update(0.9)
+
+    edge_ids = np.arange(edge_seg.size)
+    owner = np.concatenate((p1, p2))
+    owned = np.concatenate((edge_ids, edge_ids))
+    keep = owner >= 0
+    owner = owner[keep]
+    owned = owned[keep]
+    order = np.lexsort((owned, owner))
+    counts = np.bincount(owner, minlength=len(metadata))
+    province_starts = np.zeros(len(metadata) + 1, np.int64)
+    np.cumsum(counts[:len(metadata)], out=province_starts[1:])
+
+    progress.update(1.0)
+    return {
+        "vertex_xy": vertex_xy,
+        "edge_vertices": edge_vertices,
+        "province_starts": province_starts,
+        "province_edges": owned[order][:province_starts[-1]].astype(np.int64),
+        "province_ids": [d.get("province_id", f"chk-{i}") for i, d in enumerate(metadata)],
+    }
+
+
+def shapes_to_arrays(shape_data):
+    """
+    The shape graph as a dict of flat arrays. Vertex and edge ids are
+    list positions, as extract_shapes numbers them.
+        vertex_xy        (n_vertices, 2) x, y of every vertex
+        edge_vertices    (n_edges, 2) v1, v2 of every edge
+        province_starts  (n_provinces + 1) offsets into province_edges
+        province_edges   edge ids of every province, one after another
+        province_ids     list with the id of every province
+    """
+    vertices = shape_data["vertices"]
+    edges = shape_data["edges"]
+    provinces = shape_data["provinces"]
+
+    vertex_xy = np.array([(v["x"], v["y"]) for v in vertices], np.int64).reshape(-1, 2)
+    edge_vertices = np.array([(e["v1"], e["v2"]) for e in edges], np.int64).reshape(-1, 2)
+    counts = np.fromiter((len(p["edges"]) for p in provinces), np.int64, len(provinces))
+    province_starts = np.zeros(len(provinces) + 1, np.int64)
+    np.cumsum(counts, out=province_starts[1:])
+    province_edges = np.fromiter(
+        (eid for p in provinces for eid in p["edges"]), np.int64, int(province_starts[-1])
+    )
+
+    return {
+        "vertex_xy": vertex_xy,
+        "edge_vertices": edge_vertices,
+        "province_starts": province_starts,
+        "province_edges": province_edges,
+        "province_ids": [p["id"] for p in provinces],
+    }
+
+
+def shapes_from_arrays(arrays):
+    """The shape_data dict (lists of dicts) of the arrays from shapes_to_arrays."""
+    province_ids = arrays["province_ids"]
+    vert_x, vert_y = np.asarray(arrays["vertex_xy"]).T.tolist()
+    v1, v2 = np.asarray(arrays["edge_vertices"]).T.tolist()
+    starts = np.asarray(arrays["province_starts"]).tolist()
+    province_edges = np.asarray(arrays["province_edges"]).tolist()
+
+    return {
+        "vertices": [{"id": i, "x": x, "y": y} for i, (x, y) in enumerate(zip(vert_x, vert_y))],
+        "edges": [{"id": i, "v1": a, "v2": b} for i, (a, b) in enumerate(zip(v1, v2))],
+        "provinces": [{"id": pid, "edges": province_edges[starts[i]:starts[i + 1]]}
+                      for i, pid in enumerate(province_ids)],
+    }
+
+
+def _split_rows(h, w):
+    """Row bands [(r0, r1), ...] to trace, one band unless the tiled engine is on."""
+    if config.SHAPE_ENGINE != "tiled":
+        return [(0, h)]
+
+    n_bands = min(_worker_count() * 2, h, h * w // max(config.SHAPE_TILE_PIXELS, 1))
+    edges = np.linspace(0, h, max(n_bands, 1) + 1).astype(int)
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+
+def _worker_count():
+    return config.SHAPE_WORKERS or os.cpu_count() or 1
+
+
+def _trace_bands(index_map, bands, progress):
+    """Runs _trace_band for every band, in worker processes when there are several."""
+    h = index_map.shape[0]
+
+    def band_args(r0, r1):
+        top = max(r0 - 1, 0)
+        return index_map[top:min(r1 + 1, h)], top, r0, r1, h
+
+    workers = min(_worker_count(), len(bands))
+    if workers <= 1:
+        tiles = []
+        for k, (r0, r1) in enumerate(bands):
+            tiles.append(_trace_band(*band_args(r0, r1)))
+            progress.update((k + 1) / len(bands))
+        return tiles
+
+    # Spawned workers, since forking a process that runs Qt threads is unsafe
+    tiles = [None] * len(bands)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {pool.submit(_trace_band, *band_args(r0, r1)): k for k, (r0, r1) in enumerate(bands)}
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tiles[futures[future]] = future.result()
+                progress.update(1 - len(pending) / len(bands))
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+    return tiles
+
+
+def _trace_band(band, top, r0, r1, h):
+    """
+    Traces the boundary graph of index map rows [r0, r1).
+
+    band holds those rows plus one halo row on each side (where the map has
+    one), starting at map row top. The band owns the H segments and grid
+    points of rows r0..r1-1 (the last band also row h) and the V segments of
+    pixel rows r0..r1-1. Segment ids are local: owned H segments first, then
+    owned V segments, both in scan order. Positions and points are global.
+
+    Segments are chained wherever both ends at a degree-2 point belong to
+    the band; ends whose partner lies in the neighbouring band are returned
+    as seam ends for the stitching step.
+    """
+    bh, w = band.shape
+    H_segs, V_segs = _boundary_segments(band, top == 0, top + bh == h)
+
+    # Node degrees: boundary segments to the left, right, above and below
+    # every grid point
+    H_pad = np.zeros((bh + 1, w + 2), dtype=np.uint8)
+    H_pad[:, 1:-1] = H_segs
+    V_pad = np.zeros((bh + 2, w + 1), dtype=np.uint8)
+    V_pad[1:-1, :] = V_segs
+
+    deg = H_pad[:, :-1] + H_pad[:, 1:] + V_pad[:-1, :] + V_pad[1:, :]
+    is_node = (deg != 2) & (deg != 0)
+    del H_pad, V_pad, deg
+
+    # Owned grid rows g0..g1-1 and pixel rows g0..p1-1, in band coordinates
+    g0 = r0 - top
+    p1 = r1 - top
+    g1 = p1 + 1 if r1 == h else p1
+    node_points = np.flatnonzero(is_node[g0:g1]) + r0 * (w + 1)
+
+    # Segment ends: the grid point they touch, the direction of the segment
+    # seen from that point and the local segment id
+    h_pos = np.flatnonzero(H_segs[g0:g1]) + r0 * w
+    v_pos = np.flatnonzero(V_segs[g0:p1]) + r0 * (w + 1)
+    hy, hx = np.divmod(h_pos, w)
+    vy, vx = np.divmod(v_pos, w + 1)
+    n_h = h_pos.size
+    n_segs = n_h + v_pos.size
+
+    h_ids = np.arange(n_h)
+    v_ids = np.arange(n_h, n_segs)
+    end_point = np.concatenate((
+        hy * (w + 1) + hx,          # left end of H segment
+        hy * (w + 1) + hx + 1,      # right end of H segment
+        vy * (w + 1) + vx,          # top end of V segment
+        (vy + 1) * (w + 1) + vx,    # bottom end of V segment
+    ))
+    end_dir = np.repeat(np.array([RIGHT, LEFT, DOWN, UP], np.int64),
+                        [n_h, n_h, v_pos.size, v_pos.size])
+    end_seg = np.concatenate((h_ids, h_ids, v_ids, v_ids))
+    end_at_node = is_node.ravel()[end_point - top * (w + 1)]
+    del is_node
+
+    # Successor table: at every degree-2 point the two segments continue
+    # each other. Points with a single end here continue in the next band.
+    link = np.flatnonzero(~end_at_node)
+    link = link[np.argsort(end_point[link], kind="stable")]
+    link_point = end_point[link]
+    first = np.flatnonzero(link_point[1:] == link_point[:-1])
+    paired = np.zeros(link.size, bool)
+    paired[first] = True
+    paired[first + 1] = True
+    seam = link[~paired]
+
+    a = end_seg[link[first]]
+    b = end_seg[link[first + 1]]
+    graph = coo_matrix((np.ones(a.size, np.int8), (a, b)), shape=(n_segs, n_segs))
+    n_chains, chain = connected_components(graph, directed=False)
+
+    stub = np.flatnonzero(end_at_node)
+    return {
+        "h_pos": h_pos,
+        "v_pos": v_pos,
+        "node_points": node_points,
+        "chain": chain.astype(np.int64),
+        "n_chains": n_chains,
+        "stub_point": end_point[stub],
+        "stub_dir": end_dir[stub],
+        "stub_seg": end_seg[stub],
+        "seam_point": end_point[seam],
+        "seam_seg": end_seg[seam],
+    }
+
+
+def _boundary_segments(index_map, top=True, bottom=True):
+    h, w = index_map.shape
+
     # Identify Segments
     # H_segs: boundary between (y-1, *) and (y, *)
-    H_segs = np.zeros((h + 1, w), dtype=bool) 
+    H_segs = np.zeros((h + 1, w), dtype=bool)
     # V_segs: boundary between (*, x-1) and (*, x)
-    V_segs = np.zeros((h, w + 1), dtype=bool) 
-    
+    V_segs = np.zeros((h, w + 1), dtype=bool)
+
     # Internal boundaries
     H_segs[1:-1, :] = index_map[:-1, :] != index_map[1:, :]
     V_segs[:, 1:-1] = index_map[:, :-1] != index_map[:, 1:]
-    
-    # Frame boundaries
-    H_segs[0, :] = True
-    H_segs[h, :] = True
+
+    # Frame boundaries (top and bottom only where the rows are the map's own)
+    H_segs[0, :] = top
+    H_segs[h, :] = bottom
     V_segs[:, 0] = True
     V_segs[:, w] = True
-    
-    # Padded access for ease
-    H_pad = np.zeros((h+1, w+2), dtype=bool)
-    H_pad[:, 1:-1] = H_segs
-    V_pad = np.zeros((h+2, w+1), dtype=bool)
-    V_pad[1:-1, :] = V_segs
-    
-    node_indices = []
-    final_vertices = {}
-    
-    # Find Nodes (degree != 2)
-    for y in range(h + 1):
-        for x in range(w + 1):
-            deg = 0
-            if H_pad[y, x]: deg += 1
-            if H_pad[y, x+1]: deg += 1
-            if V_pad[y, x]: deg += 1
-            if V_pad[y+1, x]: deg += 1
-            
-            if deg != 2:
-                vid = len(final_vertices)
-                final_vertices[(y, x)] = vid
-                node_indices.append((y, x))
-                
-    final_edges = []
-    edge_id_counter = 0
-    adj_provinces = defaultdict(set) # map ID -> set of edge IDs
-    
-    visited_h = np.zeros_like(H_segs, dtype=bool)
-    visited_v = np.zeros_like(V_segs, dtype=bool)
-    
-    def get_provinces_for_seg(cy, cx, cdir):
-        # cdir: 0=R, 1=D, 2=L, 3=U
-        # Return p1, p2 (ids) bounding this segment
-        p1, p2 = -1, -1
-        if cdir == 0: # H_seg(cy, cx)
-             p1 = -1 if cy == 0 else index_map[cy-1, cx]
-             p2 = -1 if cy == h else index_map[cy, cx]
-        elif cdir == 1: # V_seg(cy, cx)
-             p1 = -1 if cx == 0 else index_map[cy, cx-1]
-             p2 = -1 if cx == w else index_map[cy, cx]
-        elif cdir == 2: # H_seg(cy, cx-1)
-             p1 = -1 if cy == 0 else index_map[cy-1, cx-1]
-             p2 = -1 if cy == h else index_map[cy, cx-1]
-        elif cdir == 3: # V_seg(cy-1, cx)
-             p1 = -1 if cx == 0 else index_map[cy-1, cx-1]
-             p2 = -1 if cx == w else index_map[cy-1, cx]
-        return p1, p2
-
-    def trace(start_y, start_x, start_dir):
-        cy, cx = start_y, start_x
-        cdir = start_dir
-        
-        # Determine provinces for this edge (constant along simple edge between nodes?)
-        # Actually provinces can change if we pass a T-junction, but a T-junction must be a NODE.
-        # So between two Nodes, the provinces bounding the edge must be constant.
-        p1, p2 = get_provinces_for_seg(cy, cx, cdir)
-        
-        while True:
-            # Mark visited
-            if cdir == 0: 
-                if visited_h[cy, cx]: break
-                visited_h[cy, cx] = True
-                nx, ny = cx + 1, cy
-            elif cdir == 1: 
-                if visited_v[cy, cx]: break
-                visited_v[cy, cx] = True
-                nx, ny = cx, cy + 1
-            elif cdir == 2: 
-                if visited_h[cy, cx-1]: break
-                visited_h[cy, cx-1] = True
-                nx, ny = cx - 1, cy
-            elif cdir == 3: 
-                if visited_v[cy-1, cx]: break
-                visited_v[cy-1, cx] = True
-                nx, ny = cx, cy - 1
-            
-            # Check if Node
-            if (ny, nx) in final_vertices:
-                return nx, ny, p1, p2
-            
-            # Find next dir
-            # Skip reverse direction
-            rev = (cdir + 2) % 4
-            found = False
-            for d in range(4):
-                if d == rev: continue
-                has = False
-                if d==0: has = H_pad[ny, nx+1]
-                elif d==1: has = V_pad[ny+1, nx]
-                elif d==2: has = H_pad[ny, nx]
-                elif d==3: has = V_pad[ny, nx]
-                
-                if has:
-                    cdir = d
-                    cx, cy = nx, ny
-                    found = True
-                    break
-            if not found: return nx, ny, p1, p2
-
-        return cx, cy, p1, p2
-
-    # Trace from Nodes
-    for y, x in node_indices:
-        # Check Right (0) and Down (1) only to avoid duplicates?
-        # No, a node can have multiple edges starting.
-        # H_pad is boolean.
-        
-        dirs = []
-        if H_pad[y, x+1]: dirs.append(0)
-        if V_pad[y+1, x]: dirs.append(1)
-        if H_pad[y, x]: dirs.append(2)
-        if V_pad[y, x]: dirs.append(3)
-        
-        for d in dirs:
-            # Check if visited
-            is_vis = False
-            if d==0: is_vis = visited_h[y, x]
-            elif d==1: is_vis = visited_v[y, x]
-            elif d==2: is_vis = visited_h[y, x-1]
-            elif d==3: is_vis = visited_v[y-1, x]
-            
-            if not is_vis:
-                ex, ey, p1, p2 = trace(y, x, d)
-                v1 = final_vertices[(y,x)]
-                v2 = final_vertices[(ey, ex)]
-                
-                eid = edge_id_counter
-                edge_id_counter += 1
-                final_edges.append({"id": eid, "v1": v1, "v2": v2})
-                
-                if p1 != -1: adj_provinces[p1].add(eid)
-                if p2 != -1: adj_provinces[p2].add(eid)
-
-    # Detect Islands (Loops without nodes)
-    # Scan horizontal segments
-    for y in range(h+1):
-        for x in range(w):
-            if H_segs[y, x] and not visited_h[y, x]:
-                # Found unvisited loop. Force a node.
-                if (y,x) not in final_vertices:
-                    vid = len(final_vertices)
-                    final_vertices[(y,x)] = vid
-                    # node_indices.append((y,x)) 
-                
-                ex, ey, p1, p2 = trace(y, x, 0)
-                v1 = final_vertices[(y,x)]
-                eid = edge_id_counter
-                edge_id_counter += 1
-                final_edges.append({"id": eid, "v1": v1, "v2": v1})
-                if p1 != -1: adj_provinces[p1].add(eid)
-                if p2 != -1: adj_provinces[p2].add(eid)
-
-    # Format Output
-    out_verts = [{"id": v, "x": k[1], "y": k[0]} for k, v in final_vertices.items()]
-    out_provs = []
-    
-    for i, d in enumerate(metadata):
-        pid = d.get("province_id", f"chk-{i}")
-        edges = list(adj_provinces[i])
-        out_provs.append({"id": pid, "edges": edges})
-        
-    return {
-        "vertices": out_verts,
-        "edges": final_edges,
-        "provinces": out_provs
-    }
+
+    return H_segs, V_segs
+
+
+def _segment_sides(index_map, segs, n_h, hy, hx, vy, vx):
+    """Returns the provinces on both sides of the given segments (-1 = outside the map)."""
+    h, w = index_map.shape
+    p1 = np.full(segs.size, -1, np.int64)
+    p2 = np.full(segs.size, -1, np.int64)
+
+    is_h = segs < n_h
+    hs = segs[is_h]
+    y, x = hy[hs], hx[hs]
+    above = np.where(y > 0, index_map[np.maximum(y - 1, 0), x], -1)
+    below = np.where(y < h, index_map[np.minimum(y, h - 1), x], -1)
+    p1[is_h] = above
+    p2[is_h] = below
+
+    vs = segs[~is_h] - n_h
+    y, x = vy[vs], vx[vs]
+    left = np.where(x > 0, index_map[y, np.maximum(x - 1, 0)], -1)
+    right = np.where(x < w, index_map[y, np.minimum(x, w - 1)], -1)
+    p1[~is_h] = left
+    p2[~is_h] = right
+
+    return p1, p2
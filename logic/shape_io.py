@@ -0,0 +1,151 @@
+import json
+import struct
+import numpy as np
+from logic.progress import as_progress
+
+# Items formatted (JSON) or converted (binary) per write
+WRITE_CHUNK = 65536
+
+# Binary shapes file (.shapes), all little-endian:
+#   header    magic, version, n_vertices, n_edges, n_provinces, n_province_edges, ids_bytes
+#   int32     vertex_xy        (n_vertices, 2)
+#   int32     edge_vertices    (n_edges, 2)
+#   uint8     edge_flags       (n_edges)  bit 0: river
+#   int64     province_starts  (n_provinces + 1)
+#   int32     province_edges   (n_province_edges)
+#   utf-8     province ids, one per line
+# Every section starts on an 8 byte boundary (zero padded).
+SHAPES_MAGIC = b"OGSSHAPE"
+SHAPES_VERSION = 1
+_HEADER = struct.Struct("<8sI4xQQQQQ")
+
+EDGE_RIVER = 1
+
+_SECTIONS = (
+    ("vertex_xy", "<i4", 2),
+    ("edge_vertices", "<i4", 2),
+    ("edge_flags", "u1", 1),
+    ("province_starts", "<i8", 1),
+    ("province_edges", "<i4", 1),
+)
+
+
+def write_shapes_json(path, shapes, is_river=None, progress=None):
+    """
+    Writes the shape arrays (see shape_extractor.shapes_to_arrays) as the
+    provinces.json layout, a few thousand items at a time, so the graph is
+    never held as Python dicts. The file is the same as json.dump of the
+    dict form with an "is_river" flag on every edge.
+    """
+    progress = as_progress(progress)
+    vertex_xy = np.asarray(shapes["vertex_xy"])
+    edge_vertices = np.asarray(shapes["edge_vertices"])
+    starts = np.asarray(shapes["province_starts"])
+    province_edges = np.asarray(shapes["province_edges"])
+    province_ids = shapes["province_ids"]
+    if is_river is None:
+        is_river = np.zeros(len(edge_vertices), bool)
+
+    n_v, n_e, n_p = len(vertex_xy), len(edge_vertices), len(province_ids)
+    total = max(n_v + n_e + n_p, 1)
+
+    def vertices(i0, i1):
+        xs, ys = vertex_xy[i0:i1].T.tolist()
+        return [f'{{"id": {i}, "x": {x}, "y": {y}}}' for i, x, y in zip(range(i0, i1), xs, ys)]
+
+    def edges(i0, i1):
+        v1, v2 = edge_vertices[i0:i1].T.tolist()
+        flags = ["true" if r else "false" for r in is_river[i0:i1].tolist()]
+        return [f'{{"id": {i}, "v1": {a}, "v2": {b}, "is_river": {r}}}'
+                for i, a, b, r in zip(range(i0, i1), v1, v2, flags)]
+
+    def provinces(i0, i1):
+        bounds = starts[i0:i1 + 1].tolist()
+        edge_lists = province_edges[bounds[0]:bounds[-1]].tolist()
+        base = bounds[0]
+        return [f'{{"id": {json.dumps(province_ids[i])}, "edges": '
+                f'[{", ".join(map(str, edge_lists[a - base:b - base]))}]}}'
+                for i, a, b in zip(range(i0, i1), bounds[:-1], bounds[1:])]
+
+    with open(path, "w", encoding="utf-8") as f:
+        done = 0
+        for key, count, format_items in (("vertices", n_v, vertices),
+                                         ("edges", n_e, edges),
+                                         ("provinces", n_p, provinces)):
+            f.write(f'{"{" if key == "vertices" else ", "}"{key}": [')
+            for i0 in range(0, count, WRITE_CHUNK):
+                i1 = min(i0 + WRITE_CHUNK, count)
+                if i0:
+                    f.write(", ")
+                f.write(", ".join(format_items(i0, i1)))
+                done += i1 - i0
+                progress.update(done / total)
+            f.write("]")
+        f.write("}")
+
+    progress.update(1.0)
+    return path
+
+
+def write_shapes_binary(path, shapes, is_river=None):
+    """Writes the shape arrays in the binary .shapes layout (see SHAPES_MAGIC)."""
+    n_e = len(shapes["edge_vertices"])
+    flags = np.zeros(n_e, np.uint8)
+    if is_river is not None:
+        flags[np.asarray(is_river, bool)] |= EDGE_RIVER
+    ids = "\n".join(shapes["province_ids"]).encode("utf-8")
+
+    sections = dict(shapes, edge_flags=flags)
+    header = _HEADER.pack(SHAPES_MAGIC, SHAPES_VERSION, len(shapes["vertex_xy"]), n_e,
+                          len(shapes["province_ids"]), len(shapes["province_edges"]), len(ids))
+
+    with open(path, "wb") as f:
+        f.write(header)
+        for name, dtype, _ in _SECTIONS:
+            _pad(f)
+            # Large arrays are converted a slice at a time
+            array = sections[name]
+            for i0 in range(0, len(array), WRITE_CHUNK):
+                f.write(np.ascontiguousarray(array[i0:i0 + WRITE_CHUNK], dtype).tobytes())
+        _pad(f)
+        f.write(ids)
+    return path
+
+
+def load_shapes_binary(path):
+    """
+    Opens a .shapes file without reading its arrays: they are read-only
+    memory maps of the file. Returns the shape arrays (as shapes_to_arrays
+    makes them) plus "edge_flags"; rivers are edge_flags & EDGE_RIVER.
+    """
+    with open(path, "rb") as f:
+        magic, version, n_v, n_e, n_p, n_pe, ids_bytes = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != SHAPES_MAGIC:
+            raise ValueError(f"Not a shapes file: {path}")
+        if version > SHAPES_VERSION:
+            raise ValueError(f"Shapes file version {version} is newer than this tool.")
+
+        shapes = {}
+        offset = _HEADER.size
+        for (name, dtype, width), count in zip(_SECTIONS, (n_v, n_e, n_e, n_p + 1, n_pe)):
+            offset = _align(offset)
+            shape = (count, width) if width > 1 else (count,)
+            if count:
+                shapes[name] = np.memmap(path, dtype, "r", offset, shape)
+            else:
+                shapes[name] = np.zeros(shape, dtype)
+            offset += count * width * np.dtype(dtype).itemsize
+
+        f.seek(_align(offset))
+        ids = f.read(ids_bytes).decode("utf-8")
+
+    shapes["province_ids"] = ids.split("\n") if n_p else []
+    return shapes
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def _pad(f):
+    f.write(b"\0" * (_align(f.tell()) - f.tell()))
@@ -2,69 +2,35 @@ import config
 import numpy as np
 from collections import deque
 from PIL import Image
-from scipy.ndimage import distance_transform_edt
+from scipy.spatial import cKDTree
+from logic.adjacency import adjacency_lists, build_adjacency
+from logic.border_fill import check_filled, fill_borders
+from logic.color_allocator import ColorAllocator
+from logic.image_store import color_plane
+from logic.mask_cache import get_masks
 from logic.numb_gen import NumberSeries
+from logic.progress import as_progress
+from logic.seed_sampler import generate_jitter_seeds
 
-used_colors = set()
+# How often the long running loops report progress
+PROGRESS_INTERVAL = 65536
+PROGRESS_ROWS = 256
 
 
-def generate_territory_map(main_layout):
-    used_colors.clear()
-    main_layout.progress.setVisible(True)
-    main_layout.progress.setValue(10)
+def build_territory_map(boundary_image, land_image, province_image, province_data,
+                        land_points, sea_points, progress=None, index_map=None, adjacency=None,
+                        seed=None):
+    """
+    Generates territories on top of existing provinces without touching the UI.
+    Passing the province index map skips decoding province_image, passing the
+    cached province adjacency skips rebuilding it for the graph engine.
+    Returns (territory_image, metadata, terrain_province_map).
+    """
+    progress = as_progress(progress)
+    progress.update(0.0)
 
-    boundary_image = main_layout.boundary_image_display.get_image()
-    land_image = main_layout.land_image_display.get_image()
-
-    if boundary_image is None and land_image is None:
-        raise ValueError(
-            "Need at least boundary OR ocean image to determine map size.")
-
-    # BOUNDARY MASK
-    if boundary_image is not None:
-        b_arr = np.array(boundary_image, copy=False)
-
-        if b_arr.ndim == 3:
-            r, g, b = config.BOUNDARY_COLOR
-            boundary_mask = (
-                (b_arr[..., 0] == r) &
-                (b_arr[..., 1] == g) &
-                (b_arr[..., 2] == b)
-            )
-        else:
-            (val,) = config.BOUNDARY_COLOR[:1]
-            boundary_mask = (b_arr == val)
-
-        map_h, map_w = boundary_mask.shape
-    else:
-        boundary_mask = None
-
-    if land_image is not None:
-        o_arr = np.array(land_image, copy=False)
-        sea_mask = is_sea_color(o_arr)
-        land_mask = ~sea_mask
-
-        if boundary_mask is None:
-            map_h, map_w = sea_mask.shape
-    else:
-        if boundary_mask is None:
-            raise ValueError("Could not determine map size.")
-
-        sea_mask = np.zeros((map_h, map_w), dtype=bool)
-        land_mask = np.ones((map_h, map_w), dtype=bool)
-
-    if boundary_mask is None:
-        land_fill = land_mask
-        land_border = sea_mask
-
-        sea_fill = sea_mask
-        sea_border = land_mask
-    else:
-        land_fill = land_mask & ~boundary_mask
-        land_border = boundary_mask | sea_mask
-
-        sea_fill = sea_mask & ~boundary_mask
-        sea_border = boundary_mask | land_mask
+    # MASKS (usually still cached from the province run)
+    masks = get_masks(boundary_image, land_image)
 
     # NUMBER SERIES FOR TERRITORIES
     series = NumberSeries(
@@ -72,197 +38,304 @@ def generate_territory_map(main_layout):
         config.TERRITORY_ID_START,
         config.TERRITORY_ID_END
     )
+    allocator = ColorAllocator()
+    rng = np.random.default_rng(seed)
 
     # GENERATE TERRITORIES
-    land_points = main_layout.territory_land_slider.value()
-    sea_points = main_layout.territory_ocean_slider.value()
+    if sea_points > 0 and land_image is None:
+        sea_points = 0
+
+    if config.TERRITORY_ENGINE == "graph" and index_map is not None:
+        if adjacency is None:
+            adjacency = build_adjacency(index_map, province_data, masks["boundary_mask"])
+        metadata, terrain_province_map = create_graph_territories(
+            index_map, province_data, adjacency, land_points, sea_points,
+            series, allocator, progress.sub(0.05, 0.5), rng
+        )
+    else:
+        metadata, terrain_province_map = create_pixel_territories(
+            masks, land_points, sea_points, province_data, series, allocator,
+            progress.sub(0.05, 0.5), rng
+        )
 
-    start_index = 0
+    # Attach province_ids to territory metadata
+    for d in metadata:
+        tid = d["territory_id"]
+        d["province_ids"] = terrain_province_map.get(tid, [])
 
-    land_map, land_meta, next_index = create_territory_map(
-        land_fill, land_border, land_points, start_index, "land", series
+    # Build province-based territory image
+    progress.update(0.5)
+    territory_province_image = build_province_based_territory_image(
+        province_image,
+        province_data,
+        metadata,
+        progress.sub(0.5, 1.0),
+        index_map
     )
 
-    main_layout.progress.setValue(50)
+    return territory_province_image, metadata, terrain_province_map
 
-    if sea_points > 0 and land_image is not None:
-        sea_map, sea_meta, _ = create_territory_map(
-            sea_fill, sea_border, sea_points, next_index, "ocean", series
-        )
-    else:
-        sea_map = np.full((map_h, map_w), -1, np.int32)
-        sea_meta = []
 
-    metadata = land_meta + sea_meta
+def create_pixel_territories(masks, land_points, sea_points, province_data, series, allocator,
+                             progress=None, rng=None):
+    """
+    Floods land and sea territories over the pixels at territory density in
+    one pass, then puts every province into the territory under its centroid.
+    """
+    progress = as_progress(progress)
 
-    # Build raw territory image (not displayed)
-    territory_image = combine_maps(
-        land_map, sea_map, metadata, land_mask, sea_mask
+    combined, metadata = create_territory_map(
+        masks, land_points, sea_points, series, allocator,
+        progress.sub(0.0, 0.8), rng
     )
-
-    # Build lookup from color -> territory_id
-    color_to_id = {}
-    for d in metadata:
-        color_to_id[(d["R"], d["G"], d["B"])] = d["territory_id"]
+    fill_borders(combined, [(masks["land_border"], masks["land_mask"]),
+                            (masks["sea_border"], masks["sea_mask"])],
+                 progress.sub(0.8, 0.95))
+    check_filled(combined, "territory")
 
     # Build territory -> province list
     terrain_province_map = {}
-
-    province_data = main_layout.province_data
-    territory_pixels = territory_image.load()
+    h, w = combined.shape
 
     for province in province_data:
-        x = province["x"]
-        y = province["y"]
+        x = min(max(int(province["x"]), 0), w - 1)
+        y = min(max(int(province["y"]), 0), h - 1)
 
-        r, g, b = territory_pixels[x, y]
-        tid = color_to_id.get((r, g, b))
-        if tid is None:
+        d = metadata.get(int(combined[y, x]))
+        if d is None:
             continue
 
         terrain_province_map.setdefault(
-            tid, []).append(province["province_id"])
-
-    # Attach province_ids to territory metadata
-    for d in metadata:
-        tid = d["territory_id"]
-        d["province_ids"] = terrain_province_map.get(tid, [])
-
-    # Build province-based territory image
-    province_image = main_layout.province_image_display.get_image()
-    territory_province_image = build_province_based_territory_image(
-        province_image,
-        province_data,
-        metadata
-    )
-
-    # Display THIS instead of the raw territory map
-    main_layout.territory_image_display.set_image(territory_province_image)
-    main_layout.territory_data = metadata
-
-    main_layout.progress.setValue(100)
-    main_layout.terrain_province_map = terrain_province_map
+            d["territory_id"], []).append(province["province_id"])
+
+    progress.update(1.0)
+    return list(metadata.values()), terrain_province_map
+
+
+def create_graph_territories(index_map, province_data, adjacency, land_points, sea_points,
+                             series, allocator, progress=None, rng=None):
+    """
+    Grows territories over the province adjacency graph instead of the pixels.
+
+    Land and ocean provinces are grouped separately. Provinces that cannot be
+    reached from any seed (islands, enclosed lakes) join the territory with
+    the nearest centroid of the same type. Provinces of a type without any
+    territories (density 0) join the nearest territory of either type, as
+    their pixels do in the pixel engine.
+    """
+    progress = as_progress(progress)
+    h, w = index_map.shape
+    n = len(province_data)
+
+    # Provinces touching only across boundary lines are not connected
+    pairs = adjacency["pairs"][adjacency["open_length"] > 0]
+
+    ptypes = np.array([p["province_type"] for p in province_data])
+    pairs = pairs[ptypes[pairs[:, 0]] == ptypes[pairs[:, 1]]]
+    indptr, neighbours = adjacency_lists(pairs, n)
+    ptr_list = indptr.tolist()
+    nbr_list = neighbours.tolist()
+
+    # Pixel counts weight the territory centroids
+    valid = index_map[index_map >= 0]
+    sizes = np.bincount(valid, minlength=n).astype(np.float64)
+    px = np.array([p["x"] for p in province_data], np.float64)
+    py = np.array([p["y"] for p in province_data], np.float64)
+
+    owner = np.full(n, -1, np.int64)
+    metadata = []
+    rng = np.random.default_rng(rng)
+
+    for ptype, num_points in (("land", land_points), ("ocean", sea_points)):
+        members = np.flatnonzero(ptypes == ptype)
+        if num_points <= 0 or not members.size:
+            continue
 
-    # print(terrain_province_map)
-    main_layout.button_exp_terr_img.setEnabled(True)
-    main_layout.button_exp_terr_csv.setEnabled(True)
-    main_layout.button_exp_terr_json.setEnabled(True)
-    return territory_province_image, metadata
+        seeds = _spread_seed_provinces(members, px, py, w, h, num_points, rng)
+
+        colors = allocator.allocate(ptype, len(seeds)).tolist()
+
+        q = deque()
+        for province_index, (r, g, b) in zip(seeds, colors):
+            tid = series.get_id()
+            if tid is None:
+                break
+
+            index = len(metadata)
+            metadata.append({
+                "territory_id": tid,
+                "territory_type": ptype,
+                "R": r, "G": g, "B": b,
+            })
+            owner[province_index] = index
+            q.append(int(province_index))
+
+        # Plain lists are much faster than NumPy scalars in this loop
+        owned = owner.tolist()
+        while q:
+            current = q.popleft()
+            for nb in nbr_list[ptr_list[current]:ptr_list[current + 1]]:
+                if owned[nb] == -1:
+                    owned[nb] = owned[current]
+                    q.append(nb)
+        owner = np.array(owned, np.int64)
+
+        # Unreachable provinces join the nearest territory of their type
+        _join_nearest(owner, members, px, py)
+
+    # Whatever is left had no territories of its type to join
+    _join_nearest(owner, np.arange(n), px, py)
+    progress.update(0.9)
+
+    # Territory centroids and province lists
+    count = len(metadata)
+    assigned = np.flatnonzero(owner >= 0)
+    weight = np.bincount(owner[assigned], weights=sizes[assigned], minlength=count)
+    sum_x = np.bincount(owner[assigned], weights=px[assigned] * sizes[assigned], minlength=count)
+    sum_y = np.bincount(owner[assigned], weights=py[assigned] * sizes[assigned], minlength=count)
 
+    terrain_province_map = {}
+    for province_index in assigned:
+        tid = metadata[owner[province_index]]["territory_id"]
+        terrain_province_map.setdefault(tid, []).append(province_data[province_index]["province_id"])
 
-def build_province_based_territory_image(province_image, province_data, territory_data):
+    # Plain floats, like the pixel engine (they round and save the same way)
+    for d, x, y in zip(metadata, (sum_x / np.maximum(weight, 1.0)).tolist(),
+                       (sum_y / np.maximum(weight, 1.0)).tolist()):
+        d["x"] = x
+        d["y"] = y
 
-    p_arr = np.array(province_image, copy=False)
-    h, w, _ = p_arr.shape
+    progress.update(1.0)
+    return metadata, terrain_province_map
 
-    # Build lookup: province_id -> territory color
-    province_to_territory_color = {}
 
-    for terr in territory_data:
-        tcolor = (terr["R"], terr["G"], terr["B"])
-        for pid in terr["province_ids"]:
-            province_to_territory_color[pid] = tcolor
+def _join_nearest(owner, members, px, py):
+    """Gives the members without an owner (-1) the owner of the nearest owned member, in place."""
+    orphans = members[owner[members] == -1]
+    reached = members[owner[members] >= 0]
+    if orphans.size and reached.size:
+        _, nearest = cKDTree(np.column_stack((px[reached], py[reached]))).query(
+            np.column_stack((px[orphans], py[orphans])))
+        owner[orphans] = owner[reached[nearest]]
 
-    # Build lookup: province color -> province_id
-    color_to_pid = {}
-    for p in province_data:
-        color_to_pid[(p["R"], p["G"], p["B"])] = p["province_id"]
 
-    out = np.zeros((h, w, 3), np.uint8)
+def _spread_seed_provinces(members, px, py, w, h, num_points, rng):
+    """
+    Picks up to num_points seed provinces spread over the map.
 
-    for y in range(h):
-        for x in range(w):
-            rgb = tuple(p_arr[y, x])
-            pid = color_to_pid.get(rgb)
-            if pid is None:
-                continue
+    Provinces are ordered cell by cell along a serpentine path over a grid,
+    cut into num_points equal runs, and one random province is taken per run.
+    """
+    num_points = min(num_points, members.size)
+    grid = max(1, int(np.ceil(np.sqrt(num_points))))
 
-            terr_color = province_to_territory_color.get(pid)
-            if terr_color is None:
-                continue
+    gx = np.minimum((px[members] * grid / w).astype(np.int64), grid - 1)
+    gy = np.minimum((py[members] * grid / h).astype(np.int64), grid - 1)
+    gx = np.where(gy % 2 == 0, gx, grid - 1 - gx)
+    ordered = members[np.argsort(gy * grid + gx, kind="stable")]
 
-            out[y, x] = terr_color
+    bounds = np.linspace(0, ordered.size, num_points + 1).astype(np.int64)
+    picks = bounds[:-1] + (rng.random(num_points) * (bounds[1:] - bounds[:-1])).astype(np.int64)
+    return ordered[picks]
 
-    return Image.fromarray(out)
 
+def build_province_based_territory_image(province_image, province_data, territory_data, progress=None,
+                                        index_map=None):
+    """
+    Paints every province in the color of its territory.
 
-# BASIC UTILITIES
+    With the province index map from generate_province_map this is a single
+    LUT gather. Without it, province colors are decoded from province_image.
+    """
+    progress = as_progress(progress)
 
-def is_sea_color(arr):
-    r, g, b = config.OCEAN_COLOR
-    return (arr[..., 0] == r) & (arr[..., 1] == g) & (arr[..., 2] == b)
+    # Build lookup: province index -> territory color.
+    # Row 0 is for index -1 (unassigned pixels) and stays black.
+    pid_to_index = {p["province_id"]: i for i, p in enumerate(province_data)}
+    color_lut = np.zeros((len(province_data) + 1, 3), np.uint8)
 
+    for terr in territory_data:
+        tcolor = (terr["R"], terr["G"], terr["B"])
+        for pid in terr["province_ids"]:
+            index = pid_to_index.get(pid)
+            if index is not None:
+                color_lut[index + 1] = tcolor
 
-def _color_from_id(index: int, ptype: str, used_colors=used_colors):
-    rng = np.random.default_rng(index + 1)
-    while True:
-        if ptype == "ocean":
-            r = rng.integers(0, 60)
-            g = rng.integers(0, 80)
-            b = rng.integers(100, 180)
-        else:
-            r, g, b = map(int, rng.integers(0, 256, 3))
+    if index_map is None:
+        index_map = decode_province_indices(province_image, province_data)
 
-        color = (int(r), int(g), int(b))
-        if color not in used_colors:
-            used_colors.add(color)
-            return color
+    h, w = index_map.shape
+    out = np.empty((h, w, 3), np.uint8)
 
+    for y0 in range(0, h, PROGRESS_ROWS):
+        y1 = min(y0 + PROGRESS_ROWS, h)
+        out[y0:y1] = color_lut[index_map[y0:y1] + 1]
+        progress.update(y1 / h)
 
-def generate_jitter_seeds(mask: np.ndarray, num_points: int):
-    if num_points <= 0:
-        return []
+    return Image.fromarray(out)
 
-    h, w = mask.shape
-    grid = max(1, int(np.sqrt(num_points)))
 
-    cell_h = h / grid
-    cell_w = w / grid
-    rng = np.random.default_rng()
-    seeds = []
+def decode_province_indices(province_image, province_data):
+    """Recovers the province index map (-1 = no province) from rendered colors."""
+    plane = color_plane(province_image)
+    h, w = plane.shape
 
-    for gy in range(grid):
-        y0 = int(gy * cell_h)
-        y1 = int((gy + 1) * cell_h)
+    # Build lookup: packed province color -> province index
+    keys = np.array([(p["R"] << 16) | (p["G"] << 8) | p["B"] for p in province_data], np.uint32)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
 
-        for gx in range(grid):
-            x0 = int(gx * cell_w)
-            x1 = int((gx + 1) * cell_w)
+    index_map = np.full((h, w), -1, np.int32)
+    if not keys.size:
+        return index_map
 
-            cell = mask[y0:y1, x0:x1]
-            ys, xs = np.where(cell)
+    for y0 in range(0, h, PROGRESS_ROWS):
+        packed = plane.packed(y0, y0 + PROGRESS_ROWS)
 
-            if xs.size == 0:
-                continue
+        pos = np.searchsorted(sorted_keys, packed)
+        pos[pos == sorted_keys.size] = 0
+        found = sorted_keys[pos] == packed
+        index_map[y0:y0 + PROGRESS_ROWS][found] = order[pos[found]]
 
-            i = rng.integers(xs.size)
-            seeds.append((x0 + xs[i], y0 + ys[i]))
+    return index_map
 
-    return seeds
 
+def create_territory_map(masks, land_points, sea_points, series, allocator,
+                         progress=None, rng=None):
+    """
+    Seeds land and sea territories and grows them all in one pass over a
+    shared index map (masks comes from mask_cache.get_masks).
+    Returns (index_map, metadata by index); border pixels are still -1.
+    """
+    progress = as_progress(progress)
+    domain = masks["domain"]
 
-def create_territory_map(fill_mask, border_mask, num_points, start_index, ptype, series):
-    if num_points <= 0 or not fill_mask.any():
-        empty = np.full(fill_mask.shape, -1, np.int32)
-        return empty, [], start_index
-
-    seeds = generate_jitter_seeds(fill_mask, num_points)
-    seeds = [(x, y) for x, y in seeds if fill_mask[y, x]]
+    seeds = []
+    ptypes = []
+    colors = []
+    for fill_mask, num_points, ptype in ((masks["land_fill"], land_points, "land"),
+                                         (masks["sea_fill"], sea_points, "ocean")):
+        if num_points <= 0 or not fill_mask.any():
+            continue
+        found = generate_jitter_seeds(fill_mask, num_points, rng)
+        found = [(x, y) for x, y in found if fill_mask[y, x]]
+        seeds += found
+        ptypes += [ptype] * len(found)
+        colors += allocator.allocate(ptype, len(found)).tolist()
 
     if not seeds:
-        empty = np.full(fill_mask.shape, -1, np.int32)
-        return empty, [], start_index
+        return np.full(domain.shape, -1, np.int32), {}
 
-    pmap, metadata = flood_fill(fill_mask, seeds, start_index, ptype, series)
-    assign_borders(pmap, border_mask)
+    pmap, metadata = flood_fill(domain, seeds, 0, ptypes, series, colors, progress.sub(0.0, 0.95))
     finalize_metadata(metadata)
+    progress.update(1.0)
 
-    next_index = len(metadata)
-    return pmap, list(metadata.values()), next_index
+    return pmap, metadata
 
 
-def flood_fill(fill_mask, seeds, start_index, ptype, series):
-    h, w = fill_mask.shape
+def flood_fill(domain, seeds, start_index, ptypes, series, colors, progress=None):
+    progress = as_progress(progress)
+    h, w = domain.shape
     pmap = np.full((h, w), -1, np.int32)
 
     metadata = {}
@@ -279,88 +352,47 @@ def flood_fill(fill_mask, seeds, start_index, ptype, series):
 
         pmap[sy, sx] = index
 
-        r, g, b = _color_from_id(index, ptype)
+        r, g, b = colors[i]
         metadata[index] = {
             "territory_id": tid,
-            "territory_type": ptype,
+            "territory_type": ptypes[i],
             "R": r, "G": g, "B": b,
             "sum_x": sx,
             "sum_y": sy,
             "count": 1
         }
 
-        q.append((sx, sy, index))
+        q.append((sx, sy, index, domain[sy, sx]))
+
+    total = max(1, int(np.count_nonzero(domain)))
+    done = 0
 
     while q:
-        x, y, index = q.popleft()
+        x, y, index, own = q.popleft()
         d = metadata[index]
 
+        done += 1
+        if done % PROGRESS_INTERVAL == 0:
+            progress.update(done / total)
+
         for dx, dy in neighbors:
             nx = x + dx
             ny = y + dy
 
             if 0 <= nx < w and 0 <= ny < h:
-                if pmap[ny, nx] == -1 and fill_mask[ny, nx]:
+                if pmap[ny, nx] == -1 and domain[ny, nx] == own:
                     pmap[ny, nx] = index
                     d["sum_x"] += nx
                     d["sum_y"] += ny
                     d["count"] += 1
-                    q.append((nx, ny, index))
+                    q.append((nx, ny, index, own))
 
     return pmap, metadata
 
 
-def assign_borders(pmap, border_mask):
-    valid = pmap >= 0
-    if not valid.any() or not border_mask.any():
-        return
-
-    _, (ny, nx) = distance_transform_edt(~valid, return_indices=True)
-    bm = border_mask
-    pmap[bm] = pmap[ny[bm], nx[bm]]
-
-
 def finalize_metadata(metadata):
     for d in metadata.values():
         c = d["count"]
         d["x"] = d["sum_x"] / c
         d["y"] = d["sum_y"] / c
         del d["sum_x"], d["sum_y"], d["count"]
-
-
-def combine_maps(land_map, sea_map, metadata, land_mask, sea_mask):
-    if land_map is not None and land_map.size > 0:
-        h, w = land_map.shape
-    else:
-        h, w = sea_map.shape
-
-    combined = np.full((h, w), -1, np.int32)
-
-    if land_map is not None:
-        lm = (land_map >= 0) & land_mask
-        combined[lm] = land_map[lm]
-
-    if sea_map is not None:
-        sm = (sea_map >= 0) & sea_mask
-        combined[sm] = sea_map[sm]
-
-    if (combined >= 0).any():
-        valid = combined >= 0
-        _, (ny, nx) = distance_transform_edt(~valid, return_indices=True)
-        missing = combined < 0
-        combined[missing] = combined[ny[missing], nx[missing]]
-
-    out = np.zeros((h, w, 3), np.uint8)
-
-    if not metadata:
-        return Image.fromarray(out)
-
-    color_lut = np.zeros((len(metadata), 3), np.uint8)
-
-    for index, d in enumerate(metadata):
-        color_lut[index] = (d["R"], d["G"], d["B"])
-
-    valid = combined >= 0
-    out[valid] = color_lut[combined[valid]]
-
-    return Image.fromarray(out)
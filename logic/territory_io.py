@@ -0,0 +1,58 @@
+import json
+
+# Bundled territories file (.jsonl), utf-8 JSON lines:
+#   line 1    header {"format", "version", "count", "index"}, where index maps
+#             every territory_id to [offset, length] of its line, counted in
+#             bytes from the end of the header line
+#   line 2..  one territory per line: {"territory_id", "provinces", "neighbors"}
+# A client reads the whole file at once and splits it on newlines, or reads
+# the header and seeks to single territories.
+TERRITORIES_FORMAT = "ogs-map-tool territories"
+TERRITORIES_VERSION = 1
+
+
+def write_territories_jsonl(path, territories):
+    """Writes territories (dicts with a "territory_id") as one JSON lines file with an offset index."""
+    lines = [json.dumps(t, separators=(",", ":")).encode("utf-8") + b"\n" for t in territories]
+
+    index = {}
+    offset = 0
+    for territory, line in zip(territories, lines):
+        index[territory["territory_id"]] = [offset, len(line)]
+        offset += len(line)
+
+    header = {"format": TERRITORIES_FORMAT, "version": TERRITORIES_VERSION,
+              "count": len(lines), "index": index}
+    with open(path, "wb") as f:
+        f.write(json.dumps(header, separators=(",", ":")).encode("utf-8") + b"\n")
+        f.write(b"".join(lines))
+    return path
+
+
+def load_territories_jsonl(path):
+    """Reads every territory of a file written by write_territories_jsonl, in one read."""
+    with open(path, "rb") as f:
+        data = f.read()
+    header_line, _, body = data.partition(b"\n")
+    _check_header(json.loads(header_line), path)
+    return [json.loads(line) for line in body.splitlines()]
+
+
+def load_territory(path, territory_id):
+    """Reads one territory through the offset index, or None if it is not in the file."""
+    with open(path, "rb") as f:
+        header_line = f.readline()
+        header = json.loads(header_line)
+        _check_header(header, path)
+        entry = header["index"].get(territory_id)
+        if entry is None:
+            return None
+        f.seek(len(header_line) + entry[0])
+        return json.loads(f.read(entry[1]))
+
+
+def _check_header(header, path):
+    if header.get("format") != TERRITORIES_FORMAT:
+        raise ValueError(f"Not a territories file: {path}")
+    if header.get("version", 0) > TERRITORIES_VERSION:
+        raise ValueError(f"Territories file version {header['version']} is newer than this tool.")
@@ -2,6 +2,11 @@ import config
 from PyQt6.QtWidgets import QLabel, QToolTip
 from PyQt6.QtGui import QPixmap, QImage, QMouseEvent
 from PyQt6.QtCore import Qt, QPoint
+from logic.image_store import preview_image
+
+# Largest preview a display keeps, see ImageDisplay.set_image
+PREVIEW_SIZE = (config.DISPLAY_SIZE_WIDTH * config.PREVIEW_SCALE,
+                config.DISPLAY_SIZE_HEIGHT * config.PREVIEW_SCALE)
 
 
 class ImageDisplay(QLabel):
@@ -13,7 +18,8 @@ class ImageDisplay(QLabel):
         self.setStyleSheet("background-color: #333")
         self.setMouseTracking(True)
 
-        self._image = None
+        self._image = None  # preview, see set_image
+        self._size = (0, 0)
         self._index_map = None
         self._metadata = None
         self._pixmap_scale = 1.0
@@ -23,14 +29,23 @@ class ImageDisplay(QLabel):
         self._index_map = index_map
         self._metadata = metadata
 
-    def set_image(self, image):
-        self._image = image
+    def set_image(self, image, size=None):
+        """
+        Shows image. The widget only keeps a preview of at most PREVIEW_SCALE
+        times the display size; size is the full (w, h) the image stands
+        for when it is already a preview, so tooltips map to full pixels.
+        """
+        self._size = size or image.size
+        self._image = preview_image(image, PREVIEW_SIZE)
+        self._render()
+
+    def _render(self):
         # Ensure image is RGBA for QImage
-        if image.mode != "RGBA":
+        if self._image.mode != "RGBA":
             # Handle P, L, RGB, etc.
-            display_img = image.convert("RGBA")
+            display_img = self._image.convert("RGBA")
         else:
-            display_img = image
+            display_img = self._image
             
         qimage = QImage(
             display_img.tobytes("raw", "RGBA"),
@@ -45,13 +60,11 @@ class ImageDisplay(QLabel):
 
         self.setPixmap(pixmap)
         
-        # Calculate scaling and offset for mouse mapping
-        if self._image.width > 0 and self._image.height > 0:
-             scale_w = pixmap.width() / self._image.width
-             scale_h = pixmap.height() / self._image.height
-             # Maintain aspect ratio means we use the min scale? 
-             # QImage scaled with KeepAspectRatio uses same scale for both dims.
-             self._pixmap_scale = scale_w # or scale_h, should be same
+        # Calculate scaling and offset for mouse mapping (full resolution pixels)
+        width, height = self._size
+        if width > 0 and height > 0:
+             # KeepAspectRatio uses the same scale for both dims.
+             self._pixmap_scale = pixmap.width() / width
              
              # The pixmap is centered in the label.
              # Calculate offset
@@ -91,7 +104,7 @@ class ImageDisplay(QLabel):
         
     def resizeEvent(self, event):
         if self._image:
-             self.set_image(self._image)
+             self._render()
         super().resizeEvent(event)
 
     def get_image(self):
@@ -3,19 +3,23 @@ import json
 import os
 from PyQt6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QProgressBar, QTabWidget, QLabel, QMenuBar, QFileDialog
 from PyQt6.QtGui import QAction
-from logic.province_generator import generate_province_map
-from logic.territory_generator import generate_territory_map
-from logic.import_module import import_image
+from logic.import_module import import_image, open_image
+from logic.image_store import image_size, preview_image
+from logic.project import MapProject, prepare_input
+from logic.project_bundle import is_bundle, load_bundle, release_bundle, save_bundle
 from logic.export_module import export_image, export_provinces_csv, export_territories_csv, export_territories_json, export_province_shapes_json, export_all_project
 from ui.buttons import create_slider, create_button
-from ui.image_display import ImageDisplay
-from PIL import Image
+from ui.image_display import PREVIEW_SIZE, ImageDisplay
+from ui.task_worker import TaskWorker
 
 
 class MainWindow(QWidget):
     def __init__(self):
         super().__init__()
 
+        # GENERATION INPUTS AND RESULTS
+        self.project = MapProject()
+
         # PROJECT STATE
         self.project_state = {
             "inputs": {
@@ -57,34 +61,43 @@ class MainWindow(QWidget):
         save_action.triggered.connect(self.save_project)
         file_menu.addAction(save_action)
 
-        load_action = QAction("Load Project", self)
-        load_action.triggered.connect(self.load_project)
-        file_menu.addAction(load_action)
+        self.load_action = QAction("Load Project", self)
+        self.load_action.triggered.connect(self.load_project)
+        file_menu.addAction(self.load_action)
 
         file_menu.addSeparator()
 
-        export_all_action = QAction("Export All", self)
-        export_all_action.triggered.connect(lambda: export_all_project(self))
-        file_menu.addAction(export_all_action)
+        self.export_all_action = QAction("Export All", self)
+        self.export_all_action.triggered.connect(lambda: export_all_project(self))
+        self.export_all_action.setEnabled(False)
+        file_menu.addAction(self.export_all_action)
 
         main_layout.addWidget(self.menu_bar)
 
         self.tabs = QTabWidget()
         main_layout.addWidget(self.tabs, stretch=1)
 
+        progress_row = QHBoxLayout()
+        main_layout.addLayout(progress_row)
+
         self.progress = QProgressBar()
         self.progress.setVisible(False)
-        main_layout.addWidget(self.progress)
+        progress_row.addWidget(self.progress, stretch=1)
         self.progress.setMinimum(0)
         self.progress.setMaximum(100)
         self.progress.setValue(0)
 
+        self.button_cancel = create_button(progress_row,
+                                           "Cancel",
+                                           lambda: self.cancel_tasks())
+        self.button_cancel.setVisible(False)
+
+        # Background tasks (generation and exports), newest last
+        self.workers = []
+
         self.label_version = QLabel("Version "+config.VERSION)
         main_layout.addWidget(self.label_version)
 
-        self.shape_data = None
-        self.river_edges = None
-
         # TAB1 LAND IMAGE
         self.land_tab = QWidget()
         self.land_image_display = ImageDisplay()
@@ -93,9 +106,9 @@ class MainWindow(QWidget):
         self.tabs.addTab(self.land_tab, "Land Image")
 
         # Buttons
-        create_button(land_tab_layout,
-                      "Import Land Image",
-                      lambda: self.import_and_track_image("Import Land Image", self.land_image_display, "land_image_path"))
+        self.button_import_land = create_button(land_tab_layout,
+                                                "Import Land Image",
+                                                lambda: self.import_and_track_image("Import Land Image", self.land_image_display, "land_image_path"))
 
         # TAB2 BOUNDARY IMAGE
         self.boundary_tab = QWidget()
@@ -105,9 +118,9 @@ class MainWindow(QWidget):
         self.tabs.addTab(self.boundary_tab, "Boundary Image")
 
         # Buttons
-        create_button(boundary_tab_layout,
-                      "Import Boundary Image",
-                      lambda: self.import_and_track_image("Import Boundary Image", self.boundary_image_display, "boundary_image_path"))
+        self.button_import_boundary = create_button(boundary_tab_layout,
+                                                    "Import Boundary Image",
+                                                    lambda: self.import_and_track_image("Import Boundary Image", self.boundary_image_display, "boundary_image_path"))
 
         # TAB3 BIOME IMAGE
         self.biome_tab = QWidget()
@@ -128,9 +141,9 @@ class MainWindow(QWidget):
         self.tabs.addTab(self.heightmap_tab, "Heightmap Image")
         
         # Buttons
-        create_button(heightmap_tab_layout,
-                      "Import Heightmap",
-                      lambda: self.import_and_track_image("Import Heightmap", self.heightmap_image_display, "heightmap_image_path"))
+        self.button_import_heightmap = create_button(heightmap_tab_layout,
+                                                     "Import Heightmap",
+                                                     lambda: self.import_and_track_image("Import Heightmap", self.heightmap_image_display, "heightmap_image_path"))
 
         # TAB3 PROVINCE IMAGE
         self.province_tab = QWidget()
@@ -174,7 +187,7 @@ class MainWindow(QWidget):
         self.button_exp_prov_img = create_button(button_row,
                                                  "Export Province Map",
                                                  lambda: self.export_and_track(export_image, "province_map_image_path",
-                                                                      self.province_image_display.get_image(),
+                                                                      self.project.province_image,
                                                                       "Export Province Map"))
         self.button_exp_prov_img.setEnabled(False)
 
@@ -218,13 +231,13 @@ class MainWindow(QWidget):
 
         self.button_gen_territories = create_button(territory_tab_layout,
                                                     "Generate Territories",
-                                                    lambda: generate_territory_map(self))
+                                                    lambda: self.run_territory_generation())
         self.button_gen_territories.setEnabled(False)
 
         self.button_exp_terr_img = create_button(button_territory_row,
                                                  "Export Territory Map",
                                                  lambda: self.export_and_track(export_image, "territory_map_image_path",
-                                                                      self.territory_image_display.get_image(),
+                                                                      self.project.territory_image,
                                                                       "Export Territory Map"))
         self.button_exp_terr_img.setEnabled(False)
 
@@ -240,7 +253,7 @@ class MainWindow(QWidget):
         self.button_exp_biome_map = create_button(button_biome_map_row,
                                                   "Export Biome Map",
                                                   lambda: self.export_and_track(export_image, "biome_map_image_path",
-                                                                         self.biome_map_display.get_image(),
+                                                                         self.project.biome_map_image,
                                                                          "Export Biome Map"))
         self.button_exp_biome_map.setEnabled(False)
 
@@ -262,43 +275,174 @@ class MainWindow(QWidget):
         self.update_setting("territory_ocean_density", self.territory_ocean_slider.value())
 
 
+    def run_task(self, name, task, on_success=None, kind=None):
+        """
+        Runs task(progress) on a worker thread, on_success gets its result
+        unless another project has been loaded in the meantime.
+        kind "generation" marks tasks that rewrite the project's results.
+        """
+        worker = TaskWorker(name, task, self, kind)
+        project = self.project
+        worker.progress_changed.connect(lambda value: self._on_task_progress(worker, value))
+        worker.succeeded.connect(lambda result: self._on_task_succeeded(worker, result, on_success, project))
+        worker.failed.connect(lambda error: print(f"{worker.name} failed: {error}"))
+        worker.cancelled.connect(lambda: print(f"{worker.name} cancelled."))
+        worker.finished.connect(lambda: self._on_task_finished(worker))
+
+        self.workers.append(worker)
+        self.progress.setValue(0)
+        self.progress.setFormat(f"{name}: %p%")
+        self.progress.setVisible(True)
+        self.button_cancel.setVisible(True)
+        worker.start()
+        self._update_buttons()
+        return worker
+
+    def cancel_tasks(self):
+        for worker in self.workers:
+            worker.cancel()
+
+    def _on_task_progress(self, worker, value):
+        # The bar follows the newest task
+        if self.workers and self.workers[-1] is worker:
+            self.progress.setValue(value)
+
+    def _on_task_succeeded(self, worker, result, on_success, project):
+        print(f"{worker.name} finished.")
+        if on_success is not None and project is self.project:
+            on_success(result)
+
+    def _on_task_finished(self, worker):
+        self.workers.remove(worker)
+        worker.deleteLater()
+        if not self.workers:
+            self.progress.setVisible(False)
+            self.button_cancel.setVisible(False)
+        self._update_buttons()
+
+    def _is_generating(self):
+        return any(worker.kind == "generation" for worker in self.workers)
+
+    def _update_buttons(self):
+        # Generation rewrites the results exports and saves read, so it
+        # waits for every other task and blocks exports while it runs;
+        # imports and loads would change the inputs underneath it
+        generating = self._is_generating()
+        project = self.project
+        has_inputs = project.land_image is not None or project.boundary_image is not None
+        self.button_gen_prov.setEnabled(has_inputs and not self.workers)
+        self.button_gen_territories.setEnabled(project.province_data is not None and not self.workers)
+
+        has_provinces = project.province_data is not None and not generating
+        has_territories = project.territory_data is not None and not generating
+        self.button_exp_prov_img.setEnabled(has_provinces)
+        self.button_exp_biome_map.setEnabled(has_provinces)
+        self.button_exp_prov_csv.setEnabled(has_provinces)
+        self.button_exp_prov_shapes.setEnabled(has_provinces)
+        self.button_exp_terr_img.setEnabled(has_territories)
+        self.button_exp_terr_csv.setEnabled(has_territories)
+        self.button_exp_terr_json.setEnabled(has_territories)
+        self.export_all_action.setEnabled(has_provinces)
+
+        for button in (self.button_import_land, self.button_import_boundary,
+                       self.button_import_biome, self.button_import_heightmap):
+            button.setEnabled(not generating)
+        self.load_action.setEnabled(not generating)
+
     def run_generation(self):
-        # Wrapper to handle the multiple return values
-        _, metadata, index_map = generate_province_map(self)
-        
+        self.run_task("Generating provinces",
+                      self.project.generate_provinces,
+                      self._on_provinces_generated, kind="generation")
+
+    def _on_provinces_generated(self, result):
+        province_image, biome_map_image, _, _ = result
+
+        self.province_image_display.set_image(province_image)
+        self.biome_map_display.set_image(biome_map_image)
+        self._set_interactive_data()
+
+    def _set_interactive_data(self):
         # Set interactive data for tooltips
+        index_map, metadata = self.project.index_map, self.project.province_data
         self.province_image_display.set_interactive_data(index_map, metadata)
         self.biome_map_display.set_interactive_data(index_map, metadata)
 
+    def run_territory_generation(self):
+        self.run_task("Generating territories",
+                      self.project.generate_territories,
+                      self._on_territories_generated, kind="generation")
+
+    def _on_territories_generated(self, result):
+        territory_image, _ = result
+
+        self.territory_image_display.set_image(territory_image)
+
+    def closeEvent(self, event):
+        self.cancel_tasks()
+        for worker in list(self.workers):
+            worker.wait()
+        super().closeEvent(event)
+
     def import_and_track_image(self, title, display, state_key):
-        path, image = import_image(self, title, display)
+        path = import_image(self, title)
         if path:
-            self.project_state["inputs"][state_key] = path
-            print(f"Imported {title} from {path}")
+            self._import_input(state_key, path, display, f"Imported {title} from {path}")
+
+    def _import_input(self, key, path, display, message):
+        # Large inputs take a while to decode into planes, so that and the
+        # preview run in the background; the project takes the input on the GUI thread
+        def prepare(progress):
+            image = prepare_input(key, path, progress)
+            return image, preview_image(image, PREVIEW_SIZE), image_size(image)
+
+        def loaded(result):
+            image, preview, size = result
+            self.project_state["inputs"][key] = path
+            self.project.load_input(key, path, image)
+            display.set_image(preview, size)
+            print(message)
+            self._update_buttons()
+
+        self.run_task(f"Importing {os.path.basename(path)}", prepare, loaded)
 
     def update_setting(self, key, value):
         self.project_state["settings"][key] = int(value)
+        self.project.settings[key] = int(value)
         # print(f"Setting {key} updated to {value}")
 
     def export_and_track(self, export_func, state_key, *args):
         # Call export function with optional args (images etc)
         # Some export functions take only 'self' (main_layout), others take args
-        
-        path = None
-        if args:
-            path = export_func(self, *args)
-        else:
-            path = export_func(self)
-            
-        if path:
-            self.project_state["outputs"][state_key] = path
-            print(f"Exported to {path}, saved to state.")
+        # The path is only kept once the background export has written it
+        def track(path):
+            if path:
+                self.project_state["outputs"][state_key] = path
+                print(f"Exported to {path}, saved to state.")
+
+        export_func(self, *args, on_success=track)
 
     def save_project(self):
-        path, _ = QFileDialog.getSaveFileName(self, "Save Project", "", "JSON Files (*.json)")
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Save Project", "", "Project Bundles (*.ogsproj);;JSON Files (*.json)")
         if not path:
             return
-        
+
+        # Bundles also keep every generation result
+        if is_bundle(path):
+            project = self.project
+            state = self.project_state
+            # Saving over the bundle the project was loaded from: the
+            # tooltips must let go of the arrays mapped from it as well
+            if release_bundle(project, path):
+                self._set_interactive_data()
+
+            def saved(_):
+                self._set_interactive_data()
+                print(f"Project saved to {path}")
+
+            self.run_task("Saving project", lambda progress: save_bundle(project, path, state), saved)
+            return
+
         try:
             with open(path, "w") as f:
                 json.dump(self.project_state, f, indent=4)
@@ -307,10 +451,15 @@ class MainWindow(QWidget):
             print(f"Error saving project: {e}")
 
     def load_project(self):
-        path, _ = QFileDialog.getOpenFileName(self, "Load Project", "", "JSON Files (*.json)")
+        path, _ = QFileDialog.getOpenFileName(
+            self, "Load Project", "", "Projects (*.ogsproj *.json);;Project Bundles (*.ogsproj);;JSON Files (*.json)")
         if not path:
             return
-            
+
+        if is_bundle(path):
+            self._load_bundle(path)
+            return
+
         try:
             with open(path, "r") as f:
                 state = json.load(f)
@@ -334,8 +483,7 @@ class MainWindow(QWidget):
             self.territory_ocean_slider.setValue(settings.get("territory_ocean_density", config.OCEAN_TERRITORIES_DEFAULT))
 
             # Enable gen button if inputs exist
-            if any(inputs.values()):
-                 self.button_gen_prov.setEnabled(True)
+            self._update_buttons()
 
             # Restore output previews if files exist
             # Note: We cannot easily restore full state (metadata, shapes) just from output images.
@@ -350,22 +498,71 @@ class MainWindow(QWidget):
         except Exception as e:
             print(f"Error loading project: {e}")
 
+    def _load_bundle(self, path):
+        # Loading the inputs takes a while, so the bundle and the input
+        # previews load in the background; the project is swapped once done
+        def load(progress):
+            project, state = load_bundle(path, progress)
+            previews = {}
+            for key, image in (("land_image_path", project.land_image),
+                               ("boundary_image_path", project.boundary_image),
+                               ("biome_image_path", project.biome_image),
+                               ("heightmap_image_path", project.heightmap_image)):
+                if image is not None:
+                    previews[key] = (preview_image(image, PREVIEW_SIZE), image_size(image))
+            return project, state, previews
+
+        def loaded(result):
+            project, state, previews = result
+            # Cancelled tasks still hold the old project; their results are
+            # dropped (see run_task), and they must stop before it goes away
+            self.cancel_tasks()
+            for worker in list(self.workers):
+                worker.wait()
+            self.project = project
+            self.project_state = state or {"inputs": {}, "settings": {}, "outputs": {}}
+            self.project_state["inputs"] = dict(project.input_paths)
+            self.project_state["settings"] = dict(project.settings)
+
+            # Inputs are already loaded, the displays only show them
+            for key, display in (("land_image_path", self.land_image_display),
+                                 ("boundary_image_path", self.boundary_image_display),
+                                 ("biome_image_path", self.biome_image_display),
+                                 ("heightmap_image_path", self.heightmap_image_display)):
+                if key in previews:
+                    display.set_image(*previews[key])
+
+            settings = project.settings
+            self.land_slider.setValue(settings["land_province_density"])
+            self.ocean_slider.setValue(settings["ocean_province_density"])
+            self.river_threshold_slider.setValue(settings["river_threshold"])
+            self.territory_land_slider.setValue(settings["territory_land_density"])
+            self.territory_ocean_slider.setValue(settings["territory_ocean_density"])
+
+            # Results come back ready to export
+            if project.province_data is not None:
+                self._on_provinces_generated((project.province_image, project.biome_map_image,
+                                              project.province_data, project.index_map))
+            if project.territory_data is not None:
+                self._on_territories_generated((project.territory_image, project.territory_data))
+            self._update_buttons()
+
+            print(f"Project loaded from {path}")
+
+        self.run_task(f"Loading {os.path.basename(path)}", load, loaded)
+
     def _load_input_image(self, path, display, key):
         if path and os.path.exists(path):
-            try:
-                image = Image.open(path)
-                display.set_image(image)
-                # Ensure path is in state (in case we loaded a file with missing keys)
-                self.project_state["inputs"][key] = path
-            except Exception as e:
-                print(f"Failed to load input {path}: {e}")
+            # Ensure path is in state (in case we loaded a file with missing keys)
+            self._import_input(key, path, display, f"Loaded input {path}")
         elif path:
              print(f"Input file not found: {path}")
 
     def _load_preview_image(self, path, display):
         if path and os.path.exists(path):
-            try:
-                image = Image.open(path)
-                display.set_image(image)
-            except Exception as e:
-                print(f"Failed to load preview {path}: {e}")
+            def load(progress):
+                image = open_image(path)
+                return preview_image(image, PREVIEW_SIZE), image.size
+
+            self.run_task(f"Loading {os.path.basename(path)}", load,
+                          lambda result: display.set_image(*result))
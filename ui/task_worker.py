@@ -0,0 +1,39 @@
+import threading
+import traceback
+from PyQt6.QtCore import QThread, pyqtSignal
+from logic.progress import GenerationCancelled, Progress
+
+
+class TaskWorker(QThread):
+    """
+    Runs task(progress) off the GUI thread.
+    Results, errors and progress come back through the signals below.
+    kind tells tasks apart, e.g. "generation" (see MainWindow.run_task).
+    """
+
+    progress_changed = pyqtSignal(int)
+    succeeded = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, name, task, parent=None, kind=None):
+        super().__init__(parent)
+        self.name = name
+        self.kind = kind
+        self.task = task
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        progress = Progress(self.progress_changed.emit, self.cancel_event)
+        try:
+            result = self.task(progress)
+        except GenerationCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            traceback.print_exc()
+            self.failed.emit(str(e))
+        else:
+            self.succeeded.emit(result)